@@ -0,0 +1,39 @@
+"""add vk_groups
+
+Revision ID: 2ba741657ece
+Revises: 940a5bd3e22b
+Create Date: 2026-10-18 10:38:33.694359
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2ba741657ece'
+down_revision = '940a5bd3e22b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('vk_groups',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('screen_name', sa.String(), nullable=False),
+    sa.Column('last_vk_post_id', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('last_fetched_at', sa.DateTime(), nullable=True),
+    sa.Column('error_streak', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.add_column('channels', sa.Column('vk_group_ref', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_channels_vk_group_ref'), 'channels', ['vk_group_ref'], unique=False)
+    op.create_foreign_key('channels_vk_group_ref_fkey', 'channels', 'vk_groups', ['vk_group_ref'], ['id'])
+
+
+def downgrade():
+    op.drop_constraint('channels_vk_group_ref_fkey', 'channels', type_='foreignkey')
+    op.drop_index(op.f('ix_channels_vk_group_ref'), table_name='channels')
+    op.drop_column('channels', 'vk_group_ref')
+    op.drop_table('vk_groups')
@@ -0,0 +1,26 @@
+"""add channels resolve backoff columns
+
+Revision ID: 3b9e1f6a7c25
+Revises: c7d52e8f3a16
+Create Date: 2026-10-18 21:04:37.815290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e1f6a7c25'
+down_revision = 'c7d52e8f3a16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('channels', sa.Column('resolve_error_streak', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('channels', sa.Column('resolve_retry_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('channels', 'resolve_retry_at')
+    op.drop_column('channels', 'resolve_error_streak')
@@ -0,0 +1,36 @@
+"""add deliveries
+
+Revision ID: 425adb6fd9e0
+Revises: 2ba741657ece
+Create Date: 2026-10-18 11:02:14.318652
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '425adb6fd9e0'
+down_revision = '2ba741657ece'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('deliveries',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('channel_id', sa.String(), nullable=False),
+    sa.Column('vk_post_id', sa.Integer(), nullable=False),
+    sa.Column('post', sa.Text(), nullable=False),
+    sa.Column('delivered_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('channel_id', 'vk_post_id', name='deliveries_channel_id_vk_post_id_key')
+    )
+    op.create_index(op.f('ix_deliveries_delivered_at'), 'deliveries', ['delivered_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_deliveries_delivered_at'), table_name='deliveries')
+    op.drop_table('deliveries')
@@ -0,0 +1,26 @@
+"""add vk_groups.retry_at
+
+Revision ID: 5f0c2d8a7b19
+Revises: d41a9c07e3b5
+Create Date: 2026-10-18 12:48:09.519342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0c2d8a7b19'
+down_revision = 'd41a9c07e3b5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('vk_groups', sa.Column('retry_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_vk_groups_retry_at'), 'vk_groups', ['retry_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_vk_groups_retry_at'), table_name='vk_groups')
+    op.drop_column('vk_groups', 'retry_at')
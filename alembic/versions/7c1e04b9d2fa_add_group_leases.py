@@ -0,0 +1,41 @@
+"""add group_leases
+
+Revision ID: 7c1e04b9d2fa
+Revises: 425adb6fd9e0
+Create Date: 2026-10-18 11:24:51.072913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e04b9d2fa'
+down_revision = '425adb6fd9e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('group_leases',
+    sa.Column('vk_group_id', sa.String(), nullable=False),
+    sa.Column('worker_id', sa.String(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('vk_group_id')
+    )
+    op.create_index(op.f('ix_group_leases_worker_id'), 'group_leases', ['worker_id'], unique=False)
+    op.create_table('repost_worker_heartbeats',
+    sa.Column('worker_id', sa.String(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('worker_id')
+    )
+
+
+def downgrade():
+    op.drop_table('repost_worker_heartbeats')
+    op.drop_index(op.f('ix_group_leases_worker_id'), table_name='group_leases')
+    op.drop_table('group_leases')
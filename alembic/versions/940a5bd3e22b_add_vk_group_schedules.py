@@ -0,0 +1,32 @@
+"""add vk_group_schedules
+
+Revision ID: 940a5bd3e22b
+Revises: 2e8d45ad3ac3
+Create Date: 2026-10-18 10:36:29.553333
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '940a5bd3e22b'
+down_revision = '2e8d45ad3ac3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('vk_group_schedules',
+    sa.Column('vk_group_id', sa.String(), nullable=False),
+    sa.Column('poll_interval', sa.Integer(), nullable=False),
+    sa.Column('next_poll_at', sa.DateTime(), nullable=False),
+    sa.Column('last_post_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('vk_group_id')
+    )
+
+
+def downgrade():
+    op.drop_table('vk_group_schedules')
@@ -0,0 +1,33 @@
+"""add conversation_states
+
+Revision ID: 9a3e61f0c8d2
+Revises: 5f0c2d8a7b19
+Create Date: 2026-10-18 13:21:37.604418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a3e61f0c8d2'
+down_revision = '5f0c2d8a7b19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation_states',
+    sa.Column('user_id', sa.String(), nullable=False),
+    sa.Column('state', sa.Text(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index(op.f('ix_conversation_states_expires_at'), 'conversation_states', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_conversation_states_expires_at'), table_name='conversation_states')
+    op.drop_table('conversation_states')
@@ -0,0 +1,36 @@
+"""add channels lookup indexes
+
+Revision ID: b83f5e2a61c4
+Revises: 7c1e04b9d2fa
+Create Date: 2026-10-18 11:48:07.529164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83f5e2a61c4'
+down_revision = '7c1e04b9d2fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY doesn't block writes of the running bot, but can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_channels_owner_id_created_at', 'channels', ['owner_id', 'created_at'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_disabled_channels_owner_id_created_at', 'disabled_channels', ['owner_id', 'created_at'],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index(op.f('ix_disabled_channels_channel_id'), 'disabled_channels', ['channel_id'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_disabled_channels_channel_id'), table_name='disabled_channels',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_disabled_channels_owner_id_created_at', table_name='disabled_channels',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_channels_owner_id_created_at', table_name='channels', postgresql_concurrently=True)
@@ -0,0 +1,26 @@
+"""add vk_groups callback columns
+
+Revision ID: c7d52e8f3a16
+Revises: e6b27d4c1a90
+Create Date: 2026-10-18 18:21:43.207615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d52e8f3a16'
+down_revision = 'e6b27d4c1a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('vk_groups', sa.Column('callback_secret', sa.String(), nullable=True))
+    op.add_column('vk_groups', sa.Column('callback_confirmation_code', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('vk_groups', 'callback_confirmation_code')
+    op.drop_column('vk_groups', 'callback_secret')
@@ -0,0 +1,33 @@
+"""add telegram_files
+
+Revision ID: d41a9c07e3b5
+Revises: b83f5e2a61c4
+Create Date: 2026-10-18 12:17:42.886120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41a9c07e3b5'
+down_revision = 'b83f5e2a61c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('telegram_files',
+    sa.Column('vk_attachment_id', sa.String(), nullable=False),
+    sa.Column('file_id', sa.String(), nullable=False),
+    sa.Column('last_used_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('vk_attachment_id')
+    )
+    op.create_index(op.f('ix_telegram_files_last_used_at'), 'telegram_files', ['last_used_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_telegram_files_last_used_at'), table_name='telegram_files')
+    op.drop_table('telegram_files')
@@ -0,0 +1,26 @@
+"""add channels.title
+
+Revision ID: e6b27d4c1a90
+Revises: 9a3e61f0c8d2
+Create Date: 2026-10-18 13:52:14.287135
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b27d4c1a90'
+down_revision = '9a3e61f0c8d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('channels', sa.Column('title', sa.String(), nullable=True))
+    op.add_column('disabled_channels', sa.Column('title', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('disabled_channels', 'title')
+    op.drop_column('channels', 'title')
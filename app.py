@@ -1,32 +1,72 @@
 import os
 
 import logging
-from prometheus_client import start_http_server
 
-from vk_channelify import models, run_manage_worker, run_repost_worker
+from vk_channelify import models, metrics, profiling, run_manage_worker, run_repost_worker, run_async_repost_worker, \
+    PollScheduler, GroupLeases, VkTokenPool, MemoryStateStore, DbStateStore
 
 
 if __name__ == '__main__':
     telegram_token = os.getenv('TELEGRAM_TOKEN')
     vk_token = os.getenv('VK_TOKEN')
+    vk_tokens = [token.strip() for token in os.getenv('VK_TOKENS', '').split(',') if token.strip()]  # overrides VK_TOKEN
     db_url = os.getenv('DATABASE_URL')
+    db_pool_size = int(os.getenv('DB_POOL_SIZE', 5))
+    db_max_overflow = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    db_pool_timeout = int(os.getenv('DB_POOL_TIMEOUT', 30))
+    db_pool_recycle = int(os.getenv('DB_POOL_RECYCLE', -1))  # seconds, -1 keeps connections forever
+    db_pool_pre_ping = bool(int(os.getenv('DB_POOL_PRE_PING', False)))
+    db_pgbouncer = bool(int(os.getenv('DB_PGBOUNCER', False)))  # no pooling here, PgBouncer pools connections
     use_webhook = bool(int(os.getenv('USE_WEBHOOK', False)))
     webhook_domain = os.getenv('WEBHOOK_DOMAIN', '127.0.0.1')
     webhook_port = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', 80)))
+    vk_callback_path = os.getenv('VK_CALLBACK_PATH')  # e.g. /vk_callback, served by the webhook server
     vk_thread_delay = int(os.getenv('REPOST_DELAY', 15 * 60))  # 15 minutes
     metrics_port = int(os.getenv('METRICS_PORT', 9090))
+    metrics_labels = os.getenv('METRICS_LABELS', 'full')  # full, hash or drop channel and group ids
+    metrics_label_buckets = int(os.getenv('METRICS_LABEL_BUCKETS', 64))
+    profiling_enabled = bool(int(os.getenv('PROFILING_ENABLED', False)))  # /debug/ endpoints on the metrics port
+    repost_engine = os.getenv('REPOST_ENGINE', 'thread')  # thread or asyncio
+    repost_concurrency = int(os.getenv('REPOST_CONCURRENCY', 8))
+    http_pool_size = int(os.getenv('HTTP_POOL_SIZE', 8))
+    poll_scheduler = os.getenv('POLL_SCHEDULER', 'fixed')  # fixed or adaptive
+    poll_min_interval = int(os.getenv('POLL_MIN_INTERVAL', 2 * 60))  # 2 minutes
+    poll_max_interval = int(os.getenv('POLL_MAX_INTERVAL', 2 * 60 * 60))  # 2 hours
+    repost_sharding = os.getenv('REPOST_SHARDING', 'none')  # none or leases
+    repost_worker_id = os.getenv('REPOST_WORKER_ID')  # hostname and pid by default
+    repost_lease_duration = int(os.getenv('REPOST_LEASE_DURATION', 10 * 60))  # 10 minutes
+    conversation_state_store = os.getenv('CONVERSATION_STATE_STORE', 'memory')  # memory or db
+    conversation_state_ttl = int(os.getenv('CONVERSATION_STATE_TTL', 60 * 60))  # 1 hour
+    conversation_state_max_size = int(os.getenv('CONVERSATION_STATE_MAX_SIZE', 10000))
 
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
 
+    metrics.configure_label_cardinality(metrics_labels, metrics_label_buckets)
     try:
-        start_http_server(metrics_port)
-        logger.info('Prometheus metrics server started on port {}'.format(metrics_port))
+        profiling.start_metrics_server(metrics_port, profiling_enabled)
+        logger.info('Prometheus metrics server started on port {}{}'.format(
+            metrics_port, ' with profiling endpoints' if profiling_enabled else ''))
     except Exception as e:
         logger.warning('Failed to start Prometheus metrics server: {}'.format(e))
 
-    db_session_maker = models.make_session_maker(db_url)
-    telegram_updater = run_manage_worker(telegram_token, db_session_maker, use_webhook, webhook_domain, webhook_port)
-    repost_thread = run_repost_worker(vk_thread_delay, vk_token, telegram_token, db_session_maker)
+    db_session_maker = models.make_session_maker(db_url, db_pool_size, db_max_overflow, db_pool_timeout, db_pool_recycle,
+                                                 db_pool_pre_ping, db_pgbouncer)
+    scheduler = PollScheduler(poll_min_interval, poll_max_interval) if poll_scheduler == 'adaptive' else None
+    if vk_tokens:
+        vk_token = VkTokenPool(vk_tokens)
+    leases = GroupLeases(repost_worker_id, repost_lease_duration) if repost_sharding == 'leases' else None
+    if conversation_state_store == 'db':
+        users_state = DbStateStore(db_session_maker, conversation_state_ttl)
+    else:
+        users_state = MemoryStateStore(conversation_state_ttl, conversation_state_max_size)
+    telegram_updater = run_manage_worker(telegram_token, db_session_maker, use_webhook, webhook_domain, webhook_port,
+                                         users_state, vk_callback_path)
+    if repost_engine == 'asyncio':
+        repost_thread = run_async_repost_worker(vk_thread_delay, vk_token, telegram_token, db_session_maker,
+                                                repost_concurrency, http_pool_size, scheduler, leases)
+    else:
+        repost_thread = run_repost_worker(vk_thread_delay, vk_token, telegram_token, db_session_maker,
+                                          pool_size=http_pool_size, scheduler=scheduler, leases=leases)
 
     telegram_updater.idle()
@@ -0,0 +1,198 @@
+"""Local stand-ins for api.vk.ru and the Telegram Bot API, so the repost worker can be benchmarked offline.
+
+Each server runs in its own process, so its work doesn't count against the measured process. Both answer with
+a configurable latency, and can be limited to a number of requests per second. GET /stats returns what they have
+served as JSON.
+"""
+import abc
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from vk_channelify.rate_limit import TokenBucket
+
+WALL_GET_CALL_RE = re.compile(r'API\.wall\.get\((\{.*?\})\)')
+POST_URL_RE = re.compile(r'vk\.ru/wall(-?\d+)_\d+')
+
+
+class FakeServerHandler(BaseHTTPRequestHandler):
+    # Keeps connections alive like the real APIs do, so connection reuse is measured too
+    protocol_version = 'HTTP/1.1'
+    # Responses are written in several parts, Nagle's algorithm would hold them back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self.send_json(200, self.server.stats)
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode() if length else ''
+        time.sleep(self.server.latency)
+
+        with self.server.stats_lock:
+            self.server.stats['requests'] += 1
+        is_limited = self.server.rate_limiter is not None and self.server.rate_limiter.reserve() > 0
+        status, response = self.server.respond(self, url, body, is_limited)
+        self.send_json(status, response)
+
+    def send_json(self, status, response):
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(ThreadingHTTPServer, metaclass=abc.ABCMeta):
+    daemon_threads = True
+
+    def __init__(self, latency=0, requests_per_second=0):
+        super().__init__(('127.0.0.1', 0), FakeServerHandler)
+        self.latency = latency
+        # Unlike the client's TokenBucket the server doesn't wait, it rejects what's over the limit
+        self.rate_limiter = TokenBucket(requests_per_second, capacity=requests_per_second) \
+            if requests_per_second else None
+        self.stats = {'requests': 0, 'rate_limited': 0}
+        self.stats_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def respond(self, handler, url, body, is_limited):
+        """Returns (HTTP status, JSON response) of a request. `is_limited` is true if it is over the rate limit."""
+
+
+class FakeVkServer(FakeServer):
+    """Answers execute requests of wall.get calls. Every group has `posts_per_group` posts on its wall with ids up to
+    `latest_post_id`, a wall.get call fails with `error_rate` probability. Records when every wall was served first,
+    so delivery latency can be measured from then."""
+
+    def __init__(self, latest_post_id, posts_per_group, error_rate=0, **kwargs):
+        super().__init__(**kwargs)
+        self.latest_post_id = latest_post_id
+        self.posts_per_group = posts_per_group
+        self.error_rate = error_rate
+        self.stats.update({'wall_get_calls': 0, 'wall_get_errors': 0, 'wall_get_times': dict()})
+
+    def respond(self, handler, url, body, is_limited):
+        if is_limited:
+            with self.stats_lock:
+                self.stats['rate_limited'] += 1
+            return 200, {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}}
+
+        if url.path != '/method/execute':
+            return 200, {'error': {'error_code': 3, 'error_msg': 'Unknown method passed'}}
+
+        code = parse_qs(body)['code'][0]
+        response = []
+        execute_errors = []
+        for call in WALL_GET_CALL_RE.findall(code):
+            params = json.loads(call)
+            if random.random() < self.error_rate:
+                response.append(False)
+                execute_errors.append({'method': 'wall.get', 'error_code': 10, 'error_msg': 'Internal server error'})
+            else:
+                response.append({'count': self.posts_per_group, 'items': self.make_posts(params)})
+                with self.stats_lock:
+                    self.stats['wall_get_times'].setdefault(str(params.get('owner_id', -1)), time.time())
+
+        with self.stats_lock:
+            self.stats['wall_get_calls'] += len(response)
+            self.stats['wall_get_errors'] += len(execute_errors)
+        j = {'response': response}
+        if execute_errors:
+            j['execute_errors'] = execute_errors
+        return 200, j
+
+    def make_posts(self, params):
+        owner_id = params.get('owner_id', -1)
+        offset = params.get('offset', 0)
+        first_post_id = self.latest_post_id - offset
+        last_post_id = max(self.latest_post_id - self.posts_per_group, first_post_id - params.get('count', 10))
+        now = int(time.time())
+        return [{'id': post_id, 'owner_id': owner_id, 'date': now - (self.latest_post_id - post_id) * 60,
+                 'text': 'Пост {} #benchmark'.format(post_id)}
+                for post_id in range(first_post_id, last_post_id, -1)]
+
+
+class FakeTelegramServer(FakeServer):
+    """Answers Bot API sends with a message, or with 429 Too Many Requests over the rate limit. Records when every
+    message arrived and the owner of the VK wall its post is from, so delivery latency can be measured."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stats.update({'messages': 0, 'message_times': []})
+
+    def respond(self, handler, url, body, is_limited):
+        if is_limited:
+            with self.stats_lock:
+                self.stats['rate_limited'] += 1
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                         'parameters': {'retry_after': 1}}
+
+        method = url.path.rsplit('/', 1)[-1]
+        params = json.loads(body) if body else dict()
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Benchmark',
+                                                'username': 'benchmark_bot'}}
+        if method == 'getChat':
+            chat_id = int(params.get('chat_id', 0))
+            return 200, {'ok': True, 'result': {'id': chat_id, 'type': 'channel',
+                                                'title': 'Channel {}'.format(chat_id)}}
+
+        post_url = POST_URL_RE.search(params.get('text') or params.get('caption') or '')
+        with self.stats_lock:
+            self.stats['messages'] += 1
+            self.stats['message_times'].append([post_url.group(1) if post_url else None, time.time()])
+            message_id = self.stats['messages']
+        return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()),
+                                            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'channel'},
+                                            'text': params.get('text', '')}}
+
+
+def serve(server_cls, kwargs, ports):
+    server = server_cls(**kwargs)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(server_cls, **kwargs):
+    """Starts the server in a daemon process and returns (process, base url)."""
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(server_cls, kwargs, ports), daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:{}'.format(ports.get(timeout=10))
+
+
+def get_stats(base_url):
+    return requests.get(base_url + '/stats').json()
+
+
+class RedirectingHTTPAdapter(HTTPAdapter):
+    """Sends requests for `prefix` to `base_url`, so code with hard-coded API urls talks to a fake server."""
+
+    def __init__(self, prefix, base_url, *args, **kwargs):
+        self.prefix = prefix
+        self.base_url = base_url
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        request.url = self.base_url + request.url[len(self.prefix):]
+        return super().send(request, *args, **kwargs)
@@ -0,0 +1,239 @@
+"""Feeds the manage worker dispatcher with /new, /filter_by_hashtag and /recover conversations of many simulated
+users at once, answering its Bot API requests with a local fake server, and prints the results as JSON:
+
+    python -m benchmarks.manage_dispatcher > results.json
+
+Every user goes through one conversation, the users take turns, so all their conversations are open at the same
+time like on a busy day. Command latency comes from the telegram_command_duration_seconds histogram and covers
+the handler only, update latency also covers the wait in the dispatcher's queue.
+
+Set up with environment variables:
+
+    BENCHMARK_USERS                 simulated users, 1000 by default
+    BENCHMARK_UPDATES_PER_SECOND    rate updates arrive at, as fast as possible by default
+    BENCHMARK_UNTITLED_SHARE        share of channels without a stored title, fetched with getChat, 0
+    BENCHMARK_STATE_STORE           memory or db, where conversation states are kept
+    BENCHMARK_TELEGRAM_LATENCY      seconds the fake Telegram takes per request, 0.02
+    BENCHMARK_TIMEOUT               seconds to wait for the dispatcher to handle all updates, 600
+    BENCHMARK_DATABASE_URL          database to seed, a temporary SQLite file by default. Its tables are dropped!
+"""
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import telegram
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from telegram.ext import TypeHandler, Updater
+from telegram.utils.request import Request
+
+from benchmarks.fake_servers import FakeTelegramServer, get_stats, start_server
+from benchmarks.repost_throughput import get_commit, get_percentile
+from vk_channelify import manage_worker, metrics, models
+from vk_channelify.conversation_state import DbStateStore, MemoryStateStore
+from vk_channelify.models import Channel, DisabledChannel
+
+CHANNELS_PER_USER = 3
+COMMANDS = ('new', 'filter_by_hashtag', 'recover')
+BACKLOG_SAMPLE_INTERVAL = 0.05
+
+
+def read_config():
+    return {
+        'users': int(os.getenv('BENCHMARK_USERS', 1000)),
+        'updates_per_second': float(os.getenv('BENCHMARK_UPDATES_PER_SECOND', 0)),
+        'untitled_share': float(os.getenv('BENCHMARK_UNTITLED_SHARE', 0)),
+        'state_store': os.getenv('BENCHMARK_STATE_STORE', 'memory'),
+        'telegram_latency': float(os.getenv('BENCHMARK_TELEGRAM_LATENCY', 0.02)),
+        'timeout': float(os.getenv('BENCHMARK_TIMEOUT', 600)),
+    }
+
+
+def get_user_id(user):
+    return 1000 + user
+
+
+def get_channel_id(user, channel):
+    return '-100{}'.format(user * 10 + channel)
+
+
+def get_channel_title(channel_id):
+    # The fake server answers getChat with the same title, so fetched titles match too
+    return 'Channel {}'.format(channel_id)
+
+
+def seed(db, config):
+    channels = []
+    disabled_channels = []
+    for user in range(config['users']):
+        for channel in range(CHANNELS_PER_USER):
+            channel_id = get_channel_id(user, channel)
+            title = None if random.random() < config['untitled_share'] else get_channel_title(channel_id)
+            channels.append({'channel_id': channel_id, 'vk_group_id': 'club{}'.format(user),
+                             'owner_id': str(get_user_id(user)), 'title': title})
+        disabled_channels.append({'channel_id': '-200{}'.format(user), 'vk_group_id': 'club{}'.format(user),
+                                  'owner_id': str(get_user_id(user))})
+    db.bulk_insert_mappings(Channel, channels)
+    db.bulk_insert_mappings(DisabledChannel, disabled_channels)
+    db.commit()
+
+
+def make_message(user, text=None, forward_from_chat=None):
+    user_id = get_user_id(user)
+    message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': 'user{}'.format(user)},
+               'text': text if text is not None else 'Пост'}
+    if text is not None and text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    if forward_from_chat is not None:
+        message['forward_from_chat'] = forward_from_chat
+        message['forward_date'] = message['date']
+    return message
+
+
+def make_conversation(user, command):
+    """Returns the messages a user sends to go through the conversation of `command`."""
+    if command == 'new':
+        channel_id = int('-300{}'.format(user))
+        return [make_message(user, '/new'),
+                make_message(user, 'https://vk.ru/club{}'.format(user)),
+                make_message(user, 'Я сделал'),
+                make_message(user, forward_from_chat={'id': channel_id, 'type': 'channel',
+                                                      'title': get_channel_title(channel_id)})]
+    if command == 'filter_by_hashtag':
+        return [make_message(user, '/filter_by_hashtag'),
+                make_message(user, get_channel_title(get_channel_id(user, 0))),
+                make_message(user, '#news, #sport')]
+    return [make_message(user, '/recover'),
+            make_message(user, 'club{} (-200{})'.format(user, user))]
+
+
+def make_updates(users, bot):
+    """Interleaves the users' conversations, each user sends a message in turn."""
+    conversations = [make_conversation(user, COMMANDS[user % len(COMMANDS)]) for user in range(users)]
+    updates = []
+    for step in range(max(len(conversation) for conversation in conversations)):
+        for conversation in conversations:
+            if step < len(conversation):
+                update_id = len(updates) + 1
+                updates.append(telegram.Update.de_json({'update_id': update_id, 'message': conversation[step]}, bot))
+    return updates
+
+
+def get_histogram_quantile(histogram, command, quantile):
+    """Estimates a quantile from the histogram buckets by linear interpolation, like PromQL's histogram_quantile."""
+    buckets = [(float(sample.labels['le']), sample.value) for sample in histogram.collect()[0].samples
+               if sample.name.endswith('_bucket') and sample.labels['command'] == command]
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank = quantile * buckets[-1][1]
+    lower_bound, lower_count = 0, 0
+    for upper_bound, count in buckets:
+        if count >= rank:
+            if upper_bound == float('inf'):
+                return lower_bound
+            return lower_bound + (upper_bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = upper_bound, count
+
+
+def main():
+    config = read_config()
+    db_url = os.getenv('BENCHMARK_DATABASE_URL') or 'sqlite:///{}'.format(
+        os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite'))
+
+    telegram_process, telegram_url = start_server(FakeTelegramServer, latency=config['telegram_latency'])
+
+    engine = create_engine(db_url)
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    # Seeds with a connection of its own, SQLite connections can't move to the dispatcher thread
+    db = sessionmaker(bind=engine)()
+    seed(db, config)
+    db.close()
+    engine.dispose()
+    db_session_maker = models.make_session_maker(db_url)
+
+    bot = telegram.Bot('123:benchmark', base_url=telegram_url + '/bot', request=Request(con_pool_size=8))
+    if config['state_store'] == 'db':
+        users_state = DbStateStore(db_session_maker, 60 * 60)
+    else:
+        users_state = MemoryStateStore()
+    updater = Updater(bot=bot, persistence=users_state.persistence)
+    dp = updater.dispatcher
+    manage_worker.add_handlers(dp, db_session_maker, users_state)
+
+    updates = make_updates(config['users'], bot)
+    enqueued_at = dict()
+    update_latencies = []
+    errors = []
+    all_handled = threading.Event()
+
+    def on_handled(update, context):
+        # In a later group, so it runs after the manage worker's handlers are done with the update
+        update_latencies.append(time.perf_counter() - enqueued_at[update.update_id])
+        if len(update_latencies) == len(updates):
+            all_handled.set()
+
+    dp.add_handler(TypeHandler(telegram.Update, on_handled), group=1)
+    dp.add_error_handler(lambda update, context: errors.append(context.error))
+
+    backlog_samples = []
+
+    def sample_backlog():
+        while not all_handled.wait(BACKLOG_SAMPLE_INTERVAL):
+            backlog_samples.append(dp.update_queue.qsize())
+
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=dp.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    threading.Thread(target=sample_backlog, name='backlog_sampler', daemon=True).start()
+
+    print('Feeding {} updates of {} users...'.format(len(updates), config['users']), file=sys.stderr)
+    start_time = time.perf_counter()
+    for i, update in enumerate(updates):
+        if config['updates_per_second']:
+            delay = start_time + i / config['updates_per_second'] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        enqueued_at[update.update_id] = time.perf_counter()
+        dp.update_queue.put(update)
+    timed_out = not all_handled.wait(config['timeout'])
+    all_handled.set()
+    duration = time.perf_counter() - start_time
+
+    dp.stop()
+    updater.job_queue.stop()
+    telegram_stats = get_stats(telegram_url)
+    telegram_process.terminate()
+
+    update_latencies.sort()
+    histogram = metrics.telegram_command_duration_seconds
+    results = {
+        'duration_seconds': duration,
+        'timed_out': timed_out,
+        'updates': len(updates),
+        'updates_handled': len(update_latencies),
+        'updates_per_second': len(update_latencies) / duration,
+        'errors': len(errors),
+        'telegram_requests': telegram_stats['requests'],
+        'telegram_requests_per_second': telegram_stats['requests'] / duration,
+        'update_latency_p50_seconds': get_percentile(update_latencies, 50),
+        'update_latency_p99_seconds': get_percentile(update_latencies, 99),
+        'commands': {command: {'latency_p50_seconds': get_histogram_quantile(histogram, command, 0.5),
+                               'latency_p99_seconds': get_histogram_quantile(histogram, command, 0.99)}
+                     for command in COMMANDS},
+        'backlog_max': max(backlog_samples, default=0),
+        'backlog_mean': sum(backlog_samples) / len(backlog_samples) if backlog_samples else 0,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    print(json.dumps({'commit': get_commit(), 'config': config, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
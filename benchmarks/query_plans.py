@@ -0,0 +1,106 @@
+"""Seeds the channel tables with BENCHMARK_ROWS rows and checks that the manage and repost worker queries use
+indexes and how long they take.
+
+Run it against a scratch PostgreSQL database, its tables are dropped and created again:
+
+    BENCHMARK_DATABASE_URL=postgresql://localhost/vk_channelify_benchmark python -m benchmarks.query_plans
+
+Exits with 1 if a query scans a whole table.
+"""
+import os
+import statistics
+import sys
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+
+from vk_channelify import models
+from vk_channelify.models import Channel, DisabledChannel, estimate_count
+
+# Rows per owner, so a user has a handful of channels like real ones do
+CHANNELS_PER_OWNER = 5
+
+
+def seed(db, rows):
+    for table in ('channels', 'disabled_channels'):
+        db.execute(text('''
+            INSERT INTO {} (channel_id, vk_group_id, last_vk_post_id, owner_id, created_at, updated_at)
+            SELECT '-100' || i, 'group' || i, 0, (i / :channels_per_owner)::text,
+                   now() - i * interval '1 second', now()
+            FROM generate_series(1, :rows) AS i
+        '''.format(table)), {'rows': rows, 'channels_per_owner': CHANNELS_PER_OWNER})
+    db.commit()
+    db.execute(text('ANALYZE channels'))
+    db.execute(text('ANALYZE disabled_channels'))
+    db.commit()
+
+
+def make_queries(db, rows):
+    owner_id = str(rows // CHANNELS_PER_OWNER // 2)
+    channel_id = '-100{}'.format(rows // 2)
+    return {
+        'filter_by_hashtag channels': db.query(Channel).filter(Channel.owner_id == owner_id)
+            .order_by(Channel.created_at.desc()),
+        'recover disabled channels': db.query(DisabledChannel).filter(DisabledChannel.owner_id == owner_id)
+            .order_by(DisabledChannel.created_at.desc()),
+        'disabled channel by id': db.query(DisabledChannel).filter(DisabledChannel.channel_id == channel_id),
+    }
+
+
+def explain(db, query):
+    sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+    return db.execute(text('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql)).scalar()[0]['Plan']
+
+
+def find_seq_scans(plan):
+    seq_scans = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for subplan in plan.get('Plans', []):
+        seq_scans.extend(find_seq_scans(subplan))
+    return seq_scans
+
+
+def measure(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(durations)
+
+
+def main():
+    db_url = os.environ['BENCHMARK_DATABASE_URL']
+    rows = int(os.getenv('BENCHMARK_ROWS', 1000000))
+    repeat = int(os.getenv('BENCHMARK_REPEAT', 20))
+
+    engine = create_engine(db_url)
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+
+    print('Seeding {} channels and {} disabled channels...'.format(rows, rows))
+    seed(db, rows)
+
+    has_seq_scans = False
+    for name, query in make_queries(db, rows).items():
+        plan = explain(db, query)
+        seq_scans = find_seq_scans(plan)
+        has_seq_scans = has_seq_scans or bool(seq_scans)
+        latency = measure(lambda: query.all(), repeat)
+        print('{:<30} {:>8.2f} ms  {}{}'.format(name, latency, plan['Node Type'],
+                                                '  SEQ SCAN on {}'.format(', '.join(seq_scans)) if seq_scans else ''))
+
+    count_latency = measure(lambda: db.query(DisabledChannel).count(), repeat)
+    estimate_latency = measure(lambda: estimate_count(db, DisabledChannel), repeat)
+    print('{:<30} {:>8.2f} ms'.format('disabled channels COUNT(*)', count_latency))
+    print('{:<30} {:>8.2f} ms  ({} rows)'.format('disabled channels estimate', estimate_latency,
+                                                estimate_count(db, DisabledChannel)))
+
+    db.close()
+    return 1 if has_seq_scans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""Runs repost worker iterations end to end against local fake VK and Telegram servers and prints the results
+as JSON, so they can be compared across commits:
+
+    python -m benchmarks.repost_throughput > results.json
+
+Set up with environment variables:
+
+    BENCHMARK_CHANNELS              channels to seed, 1000 by default
+    BENCHMARK_CHANNELS_PER_GROUP    channels sharing a VK group, 2
+    BENCHMARK_NEW_POSTS             new posts per group, 3
+    BENCHMARK_ENGINE                thread or asyncio
+    BENCHMARK_CONCURRENCY           concurrency of the asyncio engine, 8
+    BENCHMARK_VK_LATENCY            seconds the fake VK takes per request, 0.05
+    BENCHMARK_VK_ERROR_RATE         share of wall.get calls failing, 0
+    BENCHMARK_VK_RATE_LIMIT         requests per second the fake VK allows, unlimited by default
+    BENCHMARK_TELEGRAM_LATENCY      seconds the fake Telegram takes per request, 0.02
+    BENCHMARK_TELEGRAM_RATE_LIMIT   requests per second the fake Telegram allows, unlimited by default
+    BENCHMARK_CLIENT_VK_RPS         VK requests per second the worker allows itself, 3 like in production
+    BENCHMARK_CLIENT_TELEGRAM_RPS   Telegram sends per second the worker allows itself, 30 like in production
+    BENCHMARK_DATABASE_URL          database to seed, a temporary SQLite file by default. Its tables are dropped!
+
+Peak RSS is the one of the worker process, the fake servers run in their own processes.
+"""
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from telegram.utils.request import Request
+import telegram
+
+from benchmarks.fake_servers import FakeTelegramServer, FakeVkServer, RedirectingHTTPAdapter, get_stats, \
+    start_server
+from vk_channelify import async_repost_worker, models, repost_worker
+from vk_channelify.models import Channel, VkGroup
+from vk_channelify.rate_limit import TokenBucket
+from vk_channelify.send_scheduler import SendScheduler
+from vk_channelify.sessions import make_vk_session
+
+# Cursor of the seeded channels, posts above it are new
+SEEDED_LAST_POST_ID = 1000
+
+
+def read_config():
+    return {
+        'channels': int(os.getenv('BENCHMARK_CHANNELS', 1000)),
+        'channels_per_group': int(os.getenv('BENCHMARK_CHANNELS_PER_GROUP', 2)),
+        'new_posts': int(os.getenv('BENCHMARK_NEW_POSTS', 3)),
+        'engine': os.getenv('BENCHMARK_ENGINE', 'thread'),
+        'concurrency': int(os.getenv('BENCHMARK_CONCURRENCY', 8)),
+        'vk_latency': float(os.getenv('BENCHMARK_VK_LATENCY', 0.05)),
+        'vk_error_rate': float(os.getenv('BENCHMARK_VK_ERROR_RATE', 0)),
+        'vk_rate_limit': float(os.getenv('BENCHMARK_VK_RATE_LIMIT', 0)),
+        'telegram_latency': float(os.getenv('BENCHMARK_TELEGRAM_LATENCY', 0.02)),
+        'telegram_rate_limit': float(os.getenv('BENCHMARK_TELEGRAM_RATE_LIMIT', 0)),
+        'client_vk_rps': float(os.getenv('BENCHMARK_CLIENT_VK_RPS', repost_worker.VK_REQUESTS_PER_SECOND)),
+        'client_telegram_rps': float(os.getenv('BENCHMARK_CLIENT_TELEGRAM_RPS', 30)),
+    }
+
+
+def seed(db, config):
+    groups_count = max(1, config['channels'] // config['channels_per_group'])
+    db.bulk_insert_mappings(VkGroup, [{'id': group_id, 'screen_name': 'club{}'.format(group_id),
+                                       'last_vk_post_id': SEEDED_LAST_POST_ID}
+                                      for group_id in range(1, groups_count + 1)])
+    db.bulk_insert_mappings(Channel, [{'channel_id': str(-1000000000000 - i),
+                                       'vk_group_id': 'club{}'.format(i % groups_count + 1),
+                                       'vk_group_ref': i % groups_count + 1, 'last_vk_post_id': SEEDED_LAST_POST_ID,
+                                       'owner_id': str(i), 'title': 'Channel {}'.format(i)}
+                                      for i in range(config['channels'])])
+    db.commit()
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percentile - 1]
+
+
+def main():
+    config = read_config()
+    db_url = os.getenv('BENCHMARK_DATABASE_URL') or 'sqlite:///{}'.format(
+        os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite'))
+
+    vk_process, vk_url = start_server(FakeVkServer, latest_post_id=SEEDED_LAST_POST_ID + config['new_posts'],
+                                      posts_per_group=SEEDED_LAST_POST_ID + config['new_posts'],
+                                      error_rate=config['vk_error_rate'], latency=config['vk_latency'],
+                                      requests_per_second=config['vk_rate_limit'])
+    telegram_process, telegram_url = start_server(FakeTelegramServer, latency=config['telegram_latency'],
+                                                  requests_per_second=config['telegram_rate_limit'])
+
+    engine = create_engine(db_url)
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine, expire_on_commit=False)()
+    seed(db, config)
+
+    pool_size = max(config['concurrency'], 8)
+    vk_session = make_vk_session(pool_size)
+    vk_session.mount('https://api.vk.ru/', RedirectingHTTPAdapter('https://api.vk.ru', vk_url,
+                                                                   pool_maxsize=pool_size))
+    bot = telegram.Bot('123:benchmark', base_url=telegram_url + '/bot', request=Request(con_pool_size=pool_size))
+    repost_worker.vk_rate_limiter = TokenBucket(config['client_vk_rps'])
+    send_scheduler = SendScheduler(global_rate=config['client_telegram_rps'])
+
+    print('Running an iteration over {} channels...'.format(config['channels']), file=sys.stderr)
+    start_time = time.time()
+    iteration_error = None
+    try:
+        if config['engine'] == 'asyncio':
+            async_repost_worker.run_worker_iteration('benchmark', '123:benchmark', db, config['concurrency'], bot=bot,
+                                                     vk_session=vk_session, send_scheduler=send_scheduler)
+        else:
+            repost_worker.run_worker_iteration('benchmark', '123:benchmark', db, bot=bot, vk_session=vk_session,
+                                               send_scheduler=send_scheduler)
+    except Exception as e:
+        # Like the worker thread does, the failed iteration is reported and what it got through is still measured
+        iteration_error = '{}: {}'.format(type(e).__name__, e)
+    duration = time.time() - start_time
+    db.close()
+
+    vk_stats, telegram_stats = get_stats(vk_url), get_stats(telegram_url)
+    vk_process.terminate()
+    telegram_process.terminate()
+
+    # From when the fake VK served the post's wall first to when its message arrived, the wait for the iteration to
+    # get to the group isn't counted
+    wall_get_times = vk_stats['wall_get_times']
+    delivery_latencies = sorted(message_time - wall_get_times[owner_id]
+                                for owner_id, message_time in telegram_stats['message_times']
+                                if owner_id in wall_get_times)
+    requests_count = vk_stats['requests'] + telegram_stats['requests']
+    results = {
+        'duration_seconds': duration,
+        'iteration_error': iteration_error,
+        'posts_sent': telegram_stats['messages'],
+        'posts_per_second': telegram_stats['messages'] / duration,
+        'vk_requests': vk_stats['requests'],
+        'vk_wall_get_errors': vk_stats['wall_get_errors'],
+        'vk_rate_limited': vk_stats['rate_limited'],
+        'telegram_requests': telegram_stats['requests'],
+        'telegram_rate_limited': telegram_stats['rate_limited'],
+        'requests_per_second': requests_count / duration,
+        'delivery_latency_p50_seconds': get_percentile(delivery_latencies, 50),
+        'delivery_latency_p99_seconds': get_percentile(delivery_latencies, 99),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    print(json.dumps({'commit': get_commit(), 'config': config, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from vk_channelify import models
+
+
+@pytest.fixture
+def db_session_maker():
+    """Sessions of a new in-memory SQLite database with all tables."""
+    engine = create_engine('sqlite://')
+    models.Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(db_session_maker):
+    db = db_session_maker()
+    yield db
+    db.close()
@@ -0,0 +1,16 @@
+from vk_channelify.models import Channel, Delivery
+
+
+def add_channels(db, *channels_kwargs):
+    channels = [Channel(owner_id='1', **kwargs) for kwargs in channels_kwargs]
+    db.add_all(channels)
+    db.commit()
+    return channels
+
+
+def get_last_vk_post_id(db, channel_id):
+    return db.query(Channel.last_vk_post_id).filter_by(channel_id=channel_id).scalar()
+
+
+def get_pending_post_ids(db, channel_id):
+    return [delivery.vk_post_id for delivery in db.query(Delivery).filter_by(channel_id=channel_id, delivered_at=None)]
@@ -0,0 +1,138 @@
+import asyncio
+import pytest
+import threading
+from unittest.mock import Mock, patch
+import telegram
+from hamcrest import assert_that, equal_to, has_length
+
+from vk_channelify.models import Channel, DisabledChannel
+
+from vk_channelify.async_repost_worker import run_worker_iteration, send_post_when_allowed
+from vk_channelify.send_scheduler import SendScheduler
+from vk_channelify.vk_errors import VkError, VkWallAccessDeniedError
+from tests.helpers import add_channels, get_last_vk_post_id, get_pending_post_ids
+
+
+@patch('vk_channelify.async_repost_worker.Request')
+@patch('vk_channelify.async_repost_worker.telegram.Bot')
+@patch('vk_channelify.repost_worker.fetch_groups_posts')
+@patch('vk_channelify.repost_worker.metrics')
+class TestRunWorkerIteration:
+    @pytest.fixture(autouse=True)
+    def mock_resolve(self):
+        with patch('vk_channelify.repost_worker.resolve_channels_vk_groups') as mock_resolve:
+            yield mock_resolve
+
+    def test_iteration_sends_posts_in_order_per_channel(self, mock_metrics, mock_fetch, mock_bot_class, mock_request, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        first, second = add_channels(db, dict(channel_id='-1001', vk_group_id='group1', last_vk_post_id=10),
+                                     dict(channel_id='-1002', vk_group_id='group2', last_vk_post_id=0))
+        mock_fetch.return_value = {
+            'group1': [{'id': 12, 'owner_id': -1, 'text': 'b'}, {'id': 11, 'owner_id': -1, 'text': 'a'}],
+            'group2': [{'id': 5, 'owner_id': -2, 'text': 'c'}]
+        }
+
+        run_worker_iteration('vk_token', 'tg_token', db, concurrency=4)
+
+        first_texts = [c[0][1] for c in mock_bot.send_message.call_args_list if c[0][0] == '-1001']
+        assert_that(first_texts, equal_to(['https://vk.ru/wall-1_11\n\na', 'https://vk.ru/wall-1_12\n\nb']))
+        assert_that(get_last_vk_post_id(db, '-1001'), equal_to(12))
+        assert_that(get_last_vk_post_id(db, '-1002'), equal_to(5))
+        mock_request.assert_called_once_with(con_pool_size=4)
+
+    @patch('vk_channelify.repost_worker.disable_channel')
+    def test_iteration_disables_channel_on_unauthorized(self, mock_disable, mock_metrics, mock_fetch, mock_bot_class, mock_request, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        mock_bot.send_message.side_effect = telegram.error.Unauthorized('Unauthorized')
+        channel, = add_channels(db, dict(channel_id='-1001', vk_group_id='group1', last_vk_post_id=10))
+        mock_fetch.return_value = {'group1': [{'id': 11, 'owner_id': -1, 'text': 'a'}]}
+
+        disabled_channel_ids = []
+        mock_disable.side_effect = lambda channel, db, bot: disabled_channel_ids.append(channel.channel_id)
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(disabled_channel_ids, equal_to(['-1001']))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([11]))
+
+    def test_iteration_delivers_other_groups_when_group_fails(self, mock_metrics, mock_fetch, mock_bot_class, mock_request, db_session_maker):
+        # Batches commit while others are sending, so channels mustn't expire, like in run_worker
+        db = db_session_maker(expire_on_commit=False)
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        add_channels(db, *[dict(channel_id=str(i), vk_group_id='group{}'.format(i), last_vk_post_id=10)
+                           for i in range(30)])
+
+        def fetch(groups, vk_service_code, session, page_params):
+            return {group: VkError(10, 'Internal server error', []) if group == 'group0'
+                    else [{'id': 11, 'owner_id': -1, 'text': 'a'}] for group in groups}
+
+        mock_fetch.side_effect = fetch
+
+        run_worker_iteration('vk_token', 'tg_token', db, send_scheduler=SendScheduler(global_rate=10000))
+
+        assert_that(mock_fetch.call_count, equal_to(2))
+        assert_that(mock_bot.send_message.call_count, equal_to(29))
+        assert_that(get_last_vk_post_id(db, '0'), equal_to(10))
+
+    def test_iteration_notifies_owner_of_disabled_channel_off_loop(self, mock_metrics, mock_fetch, mock_bot_class, mock_request, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        add_channels(db, dict(channel_id='-1001', vk_group_id='closedgroup', last_vk_post_id=10))
+        mock_fetch.return_value = {'closedgroup': VkWallAccessDeniedError(15, 'Access denied', [])}
+        sending_threads = []
+        mock_bot.send_message.side_effect = lambda *args: sending_threads.append(threading.get_ident())
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(db.query(DisabledChannel).count(), equal_to(1))
+        assert_that(sending_threads, has_length(4))
+        assert_that(threading.get_ident() not in sending_threads, equal_to(True))
+
+    def test_iteration_finishes_other_channels_before_raising(self, mock_metrics, mock_fetch, mock_bot_class, mock_request, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+
+        def send_message(chat_id, text):
+            if chat_id == '-1001':
+                raise telegram.error.NetworkError('Connection reset by peer')
+
+        mock_bot.send_message.side_effect = send_message
+        failing, healthy = add_channels(db, dict(channel_id='-1001', vk_group_id='group1', last_vk_post_id=0),
+                                        dict(channel_id='-1002', vk_group_id='group1', last_vk_post_id=0))
+        mock_fetch.return_value = {'group1': [{'id': 1, 'owner_id': -1, 'text': 'a'}]}
+
+        with pytest.raises(telegram.error.NetworkError):
+            run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(get_pending_post_ids(db, '-1002'), equal_to([]))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([1]))
+
+
+@patch('vk_channelify.send_scheduler.metrics')
+@patch('vk_channelify.repost_worker.metrics')
+class TestSendPostWhenAllowed:
+    def test_reserves_and_retries_every_message_of_post(self, mock_metrics, mock_scheduler_metrics):
+        mock_bot = Mock()
+        mock_bot.send_document.side_effect = [telegram.error.RetryAfter(0), Mock()]
+        send_scheduler = SendScheduler()
+        send_scheduler.reserve = Mock(wraps=send_scheduler.reserve)
+        channel = Channel(channel_id='-1001', vk_group_id='group1')
+        # The text is too long for a caption, so it goes before the document
+        post = {'id': 1, 'owner_id': -1, 'text': 'a' * 2000,
+                'attachments': [{'type': 'doc', 'doc': {'owner_id': -1, 'id': 2, 'url': 'https://vk.ru/doc-1_2'}}]}
+
+        async def run_blocking(func):
+            return func()
+
+        sent_methods = []
+
+        asyncio.run(send_post_when_allowed(channel, post, mock_bot, run_blocking, send_scheduler,
+                                           sent_methods=sent_methods))
+
+        assert_that(mock_bot.send_message.call_count, equal_to(1))
+        assert_that(mock_bot.send_document.call_count, equal_to(2))
+        assert_that(send_scheduler.reserve.call_count, equal_to(3))
+        assert_that(sent_methods, equal_to(['send_message', 'send_document']))
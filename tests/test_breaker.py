@@ -0,0 +1,50 @@
+import datetime
+from unittest.mock import patch
+from hamcrest import assert_that, equal_to
+
+from vk_channelify.breaker import get_retry_at, select_closed_groups
+from vk_channelify.models import VkGroup
+
+NOW = datetime.datetime(2026, 10, 18, 12, 0)
+
+
+class TestGetRetryAt:
+    def test_keeps_breaker_closed_below_threshold(self):
+        assert_that(get_retry_at(2, NOW, threshold=3), equal_to(None))
+
+    def test_doubles_delay_after_every_failure(self):
+        retry_ats = [get_retry_at(error_streak, NOW, threshold=3, base_delay=60, jitter=lambda: 1)
+                     for error_streak in (3, 4, 5)]
+
+        assert_that([(retry_at - NOW).total_seconds() for retry_at in retry_ats], equal_to([60, 120, 240]))
+
+    def test_caps_delay_and_jitters_it_down_to_half(self):
+        retry_at = get_retry_at(30, NOW, threshold=3, base_delay=60, max_delay=3600, jitter=lambda: 0)
+
+        assert_that((retry_at - NOW).total_seconds(), equal_to(1800))
+
+
+class TestSelectClosedGroups:
+    def test_skips_groups_until_their_retry_at(self, db):
+        db.add_all([
+            VkGroup(id=1, screen_name='ok'),
+            VkGroup(id=2, screen_name='open', error_streak=5, retry_at=NOW + datetime.timedelta(minutes=1)),
+            VkGroup(id=3, screen_name='half_open', error_streak=5, retry_at=NOW - datetime.timedelta(minutes=1)),
+        ])
+        db.commit()
+
+        groups = select_closed_groups(['club1', 'club2', 'club3', 'unresolved'], db, now=NOW)
+
+        assert_that(groups, equal_to(['club1', 'club3', 'unresolved']))
+
+    @patch('vk_channelify.breaker.metrics')
+    def test_counts_all_open_breakers(self, mock_metrics, db):
+        db.add_all([
+            VkGroup(id=1, screen_name='open', error_streak=5, retry_at=NOW + datetime.timedelta(minutes=1)),
+            VkGroup(id=2, screen_name='open_elsewhere', error_streak=5, retry_at=NOW + datetime.timedelta(minutes=1)),
+        ])
+        db.commit()
+
+        select_closed_groups(['club1'], db, now=NOW)
+
+        mock_metrics.open_breakers_gauge.set.assert_called_once_with(2)
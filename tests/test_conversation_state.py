@@ -0,0 +1,121 @@
+import datetime
+from queue import Queue
+from unittest.mock import Mock, patch
+import telegram
+from hamcrest import assert_that, equal_to, is_
+from telegram.ext import Dispatcher
+
+from vk_channelify import manage_worker
+from vk_channelify.conversation_state import DbStateStore, MemoryStateStore
+from vk_channelify.models import ConversationState
+
+NOW = datetime.datetime(2026, 10, 18, 12, 0)
+
+
+def make_replica(db_session_maker):
+    users_state = DbStateStore(db_session_maker)
+    dp = Dispatcher(Mock(username='vk_channelify_bot', defaults=None), Queue(), persistence=users_state.persistence)
+    manage_worker.add_handlers(dp, db_session_maker, users_state)
+    return dp
+
+
+def make_message_update(dp, update_id, text):
+    message = {'message_id': update_id, 'date': 1700000000, 'text': text,
+               'chat': {'id': 12345, 'type': 'private'},
+               'from': {'id': 12345, 'is_bot': False, 'first_name': 'User'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return telegram.Update.de_json({'update_id': update_id, 'message': message}, dp.bot)
+
+
+@patch('vk_channelify.conversation_state.datetime')
+class TestMemoryStateStore:
+    def test_expires_states_after_ttl(self, mock_datetime):
+        mock_datetime.datetime.utcnow.return_value = NOW
+        mock_datetime.timedelta = datetime.timedelta
+        users_state = MemoryStateStore(ttl=60)
+        users_state[1] = {'vk_domain': 'mygroup'}
+
+        mock_datetime.datetime.utcnow.return_value = NOW + datetime.timedelta(seconds=30)
+        assert_that(users_state[1], equal_to({'vk_domain': 'mygroup'}))
+        mock_datetime.datetime.utcnow.return_value = NOW + datetime.timedelta(seconds=120)
+        assert_that(1 in users_state, is_(False))
+
+    def test_drops_least_recently_used_states(self, mock_datetime):
+        mock_datetime.datetime.utcnow.return_value = NOW
+        mock_datetime.timedelta = datetime.timedelta
+        users_state = MemoryStateStore(max_size=2)
+        users_state[1] = {'vk_domain': 'first'}
+        users_state[2] = {'vk_domain': 'second'}
+        assert_that(users_state[1], equal_to({'vk_domain': 'first'}))
+
+        users_state[3] = {'vk_domain': 'third'}
+
+        assert_that([user_id in users_state for user_id in (1, 2, 3)], equal_to([True, False, True]))
+        assert_that(len(users_state), equal_to(2))
+
+    def test_evicts_expired_states_on_write(self, mock_datetime):
+        mock_datetime.datetime.utcnow.return_value = NOW
+        mock_datetime.timedelta = datetime.timedelta
+        users_state = MemoryStateStore(ttl=60)
+        users_state[1] = {'vk_domain': 'abandoned'}
+
+        mock_datetime.datetime.utcnow.return_value = NOW + datetime.timedelta(seconds=120)
+        users_state[2] = {'vk_domain': 'new'}
+
+        assert_that(len(users_state), equal_to(1))
+
+
+class TestDbStateStore:
+    def test_shares_states_between_stores(self, db_session_maker):
+        DbStateStore(db_session_maker)[1] = {'channels': {'Канал': '-1001'}}
+
+        users_state = DbStateStore(db_session_maker)
+
+        assert_that(users_state[1], equal_to({'channels': {'Канал': '-1001'}}))
+        del users_state[1]
+        assert_that(1 in users_state, is_(False))
+
+    def test_ignores_and_deletes_expired_states(self, db_session_maker):
+        db = db_session_maker()
+        db.add(ConversationState(user_id='1', state='{}', expires_at=datetime.datetime.utcnow()))
+        db.commit()
+        users_state = DbStateStore(db_session_maker)
+
+        assert_that(1 in users_state, is_(False))
+        users_state[2] = {'vk_domain': 'mygroup'}
+        assert_that([state.user_id for state in db.query(ConversationState)], equal_to(['2']))
+
+
+    @patch('vk_channelify.conversation_state.time.monotonic')
+    @patch('vk_channelify.conversation_state.metrics')
+    def test_counts_states_for_gauge_once_per_interval(self, mock_metrics, mock_monotonic, db_session_maker):
+        users_state = DbStateStore(db_session_maker, gauge_interval=60)
+        mock_monotonic.return_value = 1000
+
+        users_state[1] = {'vk_domain': 'first'}
+        users_state[2] = {'vk_domain': 'second'}
+        mock_monotonic.return_value = 1060
+        users_state[3] = {'vk_domain': 'third'}
+
+        assert_that([c[0][0] for c in mock_metrics.conversation_states_gauge.set.call_args_list], equal_to([1, 3]))
+
+@patch('vk_channelify.manage_worker.metrics')
+class TestDbConversationPersistence:
+    def test_continues_conversation_on_another_replica(self, mock_metrics, db_session_maker):
+        first_replica, second_replica = make_replica(db_session_maker), make_replica(db_session_maker)
+
+        first_replica.process_update(make_message_update(first_replica, 1, '/new'))
+        second_replica.process_update(make_message_update(second_replica, 2, 'https://vk.ru/mygroup'))
+
+        assert_that(DbStateStore(db_session_maker)[12345], equal_to({'vk_domain': 'mygroup'}))
+        second_replica.bot.send_message.assert_called()
+
+    def test_ends_conversation_for_every_replica(self, mock_metrics, db_session_maker):
+        first_replica, second_replica = make_replica(db_session_maker), make_replica(db_session_maker)
+        first_replica.process_update(make_message_update(first_replica, 1, '/new'))
+
+        second_replica.process_update(make_message_update(second_replica, 2, '/cancel'))
+        first_replica.process_update(make_message_update(first_replica, 3, 'https://vk.ru/mygroup'))
+
+        assert_that(12345 in DbStateStore(db_session_maker), is_(False))
@@ -0,0 +1,59 @@
+from unittest.mock import Mock
+from hamcrest import assert_that, equal_to, is_, none, contains_inanyorder
+
+from vk_channelify.hashtags import HashtagIndex, extract_hashtags, format_hashtag_filter, parse_hashtag_filter
+
+
+class TestParseHashtagFilter:
+    def test_no_filter(self):
+        assert_that(parse_hashtag_filter(None), is_(none()))
+
+    def test_hashtags_are_normalised(self):
+        assert_that(parse_hashtag_filter('#News, update ,#НОВОСТИ'), equal_to({'#news', '#update', '#новости'}))
+
+    def test_empty_filter_means_no_filter(self):
+        assert_that(parse_hashtag_filter(' , #'), is_(none()))
+
+    def test_format_is_parsed_back(self):
+        hashtags = parse_hashtag_filter('#b,#a')
+
+        assert_that(format_hashtag_filter(hashtags), equal_to('#a,#b'))
+        assert_that(parse_hashtag_filter(format_hashtag_filter(hashtags)), equal_to(hashtags))
+
+
+class TestExtractHashtags:
+    def test_whole_hashtags_are_extracted(self):
+        assert_that(extract_hashtags('About #Category and #cat.'), equal_to({'#category', '#cat'}))
+
+    def test_community_hashtag_is_found_by_plain_hashtag(self):
+        assert_that(extract_hashtags('#news@durov'), equal_to({'#news', '#news@durov'}))
+
+
+class TestHashtagIndex:
+    def test_unfiltered_channels_get_every_post(self):
+        channel = Mock(hashtag_filter=None)
+
+        assert_that(HashtagIndex([channel]).find_channels(set()), equal_to([channel]))
+
+    def test_single_hashtag_match(self):
+        channel = Mock(hashtag_filter='#news')
+
+        assert_that(HashtagIndex([channel]).find_channels(extract_hashtags('Post with #news')), equal_to([channel]))
+
+    def test_single_hashtag_no_match(self):
+        channel = Mock(hashtag_filter='#news')
+
+        assert_that(HashtagIndex([channel]).find_channels(extract_hashtags('Post with #other')), equal_to([]))
+
+    def test_prefix_of_hashtag_does_not_match(self):
+        channel = Mock(hashtag_filter='#cat')
+
+        assert_that(HashtagIndex([channel]).find_channels(extract_hashtags('Post with #category')), equal_to([]))
+
+    def test_multiple_hashtags_match_channel_once(self):
+        channel = Mock(hashtag_filter='#news, #update')
+        other_channel = Mock(hashtag_filter='#update')
+
+        channels = HashtagIndex([channel, other_channel]).find_channels(extract_hashtags('#news and #update'))
+
+        assert_that(channels, contains_inanyorder(channel, other_channel))
@@ -0,0 +1,74 @@
+import datetime
+from unittest.mock import patch
+from hamcrest import assert_that, equal_to, empty, has_length
+
+from vk_channelify.leases import GroupLeases
+from vk_channelify.models import GroupLease
+
+NOW = datetime.datetime(2026, 1, 1, 12, 0)
+GROUPS = ['group{}'.format(i) for i in range(10)]
+
+
+@patch('vk_channelify.leases.metrics')
+class TestGroupLeases:
+    def test_single_worker_leases_every_group(self, mock_metrics, db):
+        leased_groups = GroupLeases('a').claim(GROUPS, db, now=NOW)
+
+        assert_that(sorted(leased_groups), equal_to(GROUPS))
+
+    def test_workers_split_groups_after_new_worker_joins(self, mock_metrics, db):
+        first, second = GroupLeases('a'), GroupLeases('b')
+        first.claim(GROUPS, db, now=NOW)
+
+        # The new worker finds everything leased, but its heartbeat makes the first one give up half
+        assert_that(second.claim(GROUPS, db, now=NOW), empty())
+        first_groups = first.claim(GROUPS, db, now=NOW)
+        second_groups = second.claim(GROUPS, db, now=NOW)
+
+        assert_that(first_groups, has_length(5))
+        assert_that(second_groups, has_length(5))
+        assert_that(sorted(first_groups + second_groups), equal_to(GROUPS))
+
+    def test_keeps_own_groups_between_claims(self, mock_metrics, db):
+        first, second = GroupLeases('a'), GroupLeases('b')
+        first.claim(GROUPS, db, now=NOW)
+        second.claim(GROUPS, db, now=NOW)
+        first_groups = first.claim(GROUPS, db, now=NOW)
+        second.claim(GROUPS, db, now=NOW)
+
+        assert_that(first.claim(GROUPS, db, now=NOW + datetime.timedelta(minutes=1)), equal_to(first_groups))
+
+    def test_takes_over_groups_of_dead_worker(self, mock_metrics, db):
+        dead, alive = GroupLeases('a', duration=60), GroupLeases('b', duration=60)
+        dead.claim(GROUPS, db, now=NOW)
+
+        leased_groups = alive.claim(GROUPS, db, now=NOW + datetime.timedelta(seconds=61))
+
+        assert_that(sorted(leased_groups), equal_to(GROUPS))
+
+    def test_renew_extends_own_leases(self, mock_metrics, db):
+        worker = GroupLeases('a', duration=60)
+        worker.claim(GROUPS, db, now=NOW)
+
+        worker.renew(db, now=NOW + datetime.timedelta(seconds=50))
+
+        expires_at = {lease.expires_at for lease in db.query(GroupLease)}
+        assert_that(expires_at, equal_to({NOW + datetime.timedelta(seconds=110)}))
+        other_groups = GroupLeases('b', duration=60).claim(GROUPS, db, now=NOW + datetime.timedelta(seconds=61))
+        assert_that(other_groups, empty())
+
+    def test_workers_renewing_while_sleeping_share_groups_across_iterations(self, mock_metrics, db):
+        first, second = GroupLeases('a'), GroupLeases('b')
+        leased_groups = {}
+
+        # Iterations are 15 minutes apart, longer than the 10 minute leases, the workers renew while sleeping
+        for second_of_day in range(0, 60 * 60, 10):
+            now = NOW + datetime.timedelta(seconds=second_of_day)
+            for worker, offset in ((first, 0), (second, 2 * 60)):
+                if (second_of_day - offset) % (15 * 60) == 0:
+                    leased_groups[worker.worker_id] = worker.claim(GROUPS, db, now=now)
+                elif (second_of_day - offset) % int(worker.renew_interval) == 0:
+                    worker.renew(db, now=now)
+
+        assert_that(leased_groups['a'], has_length(5))
+        assert_that(leased_groups['b'], has_length(5))
@@ -9,6 +9,10 @@ from vk_channelify.manage_worker import (
     new_in_state_asked_channel_access,
     new_in_state_asked_channel_message,
     cancel_new,
+    filter_by_hashtag,
+    make_db_session,
+    filter_by_hashtag_in_state_asked_hashtags,
+    update_channel_title,
     del_state,
     ASKED_VK_GROUP_LINK_IN_NEW,
     ASKED_CHANNEL_ACCESS_IN_NEW,
@@ -16,6 +20,8 @@ from vk_channelify.manage_worker import (
 )
 from telegram.ext import ConversationHandler
 
+from vk_channelify.models import Channel, DisabledChannel
+
 
 class TestDelState:
     def test_deletes_user_state_if_exists(self):
@@ -105,9 +111,32 @@ class TestNewInStateAskedChannelMessage:
 
         assert_that(result, equal_to(ConversationHandler.END))
         db.add.assert_called_once()
-        db.commit.assert_called_once()
+        assert_that(db.commit.call_count, equal_to(2))
         context.bot.send_message.assert_called_once()
 
+    @patch('vk_channelify.manage_worker.metrics')
+    def test_commits_deleting_disabled_channel_before_telegram_calls(self, mock_metrics, db_session_maker):
+        db = db_session_maker()
+        db.add(DisabledChannel(channel_id='-100123456', vk_group_id='mygroup', owner_id='12345'))
+        db.commit()
+        update = Mock()
+        context = Mock()
+        update.message.from_user.id = 12345
+        update.message.from_user.username = 'testuser'
+        update.message.forward_from_chat.id = -100123456
+        update.message.forward_from_chat.title = 'Мой канал'
+        users_state = {12345: {'vk_domain': 'mygroup'}}
+        handler_db = db_session_maker()
+        is_in_transaction = []
+        context.bot.send_message.side_effect = lambda *args: is_in_transaction.append(handler_db.in_transaction())
+
+        new_in_state_asked_channel_message(update, context, db_session_maker=Mock(return_value=handler_db),
+                                           users_state=users_state)
+
+        assert_that(is_in_transaction, equal_to([False]))
+        assert_that(db.query(DisabledChannel).count(), equal_to(0))
+        assert_that(db.query(Channel).count(), equal_to(1))
+
     @patch('vk_channelify.manage_worker.metrics')
     @patch('vk_channelify.manage_worker.Channel')
     def test_rolls_back_on_error(self, mock_channel, mock_metrics):
@@ -140,3 +169,73 @@ class TestCancelNew:
 
         assert_that(result, equal_to(ConversationHandler.END))
         assert_that(12345 not in users_state, is_(True))
+
+
+class TestFilterByHashtagInStateAskedHashtags:
+    @patch('vk_channelify.manage_worker.metrics')
+    def test_saves_filter_of_channel_from_state(self, mock_metrics):
+        update = Mock()
+        context = Mock()
+        update.message.from_user.id = 12345
+        update.message.text = '#news, #Cats'
+        users_state = {12345: {'channels': {'Канал': '-1001'}, 'channel_id': '-1001'}}
+        db = Mock()
+        channel = db.query.return_value.get.return_value
+        db_session_maker = Mock(return_value=db)
+
+        result = filter_by_hashtag_in_state_asked_hashtags(update, context, db_session_maker=db_session_maker,
+                                                           users_state=users_state)
+
+        assert_that(result, equal_to(ConversationHandler.END))
+        db.query.return_value.get.assert_called_once_with('-1001')
+        assert_that(channel.hashtag_filter, equal_to('#cats,#news'))
+        db.commit.assert_called_once()
+        assert_that(12345 not in users_state, is_(True))
+
+
+class TestFilterByHashtag:
+    @patch('vk_channelify.manage_worker.metrics')
+    def test_builds_keyboard_from_stored_titles(self, mock_metrics, db_session_maker):
+        db = db_session_maker()
+        db.add_all([Channel(channel_id='-1001', vk_group_id='first', owner_id='12345', title='Первый'),
+                    Channel(channel_id='-1002', vk_group_id='second', owner_id='12345')])
+        db.commit()
+        update = Mock()
+        context = Mock()
+        update.message.from_user.id = 12345
+        context.bot.get_chat.return_value.title = 'Второй'
+        users_state = {}
+
+        filter_by_hashtag(update, context, db_session_maker=db_session_maker, users_state=users_state)
+
+        context.bot.get_chat.assert_called_once_with(chat_id='-1002')
+        assert_that(users_state[12345], equal_to({'channels': {'Первый': '-1001', 'Второй': '-1002'}}))
+        assert_that(db_session_maker().query(Channel).get('-1002').title, equal_to('Второй'))
+
+
+class TestUpdateChannelTitle:
+    def test_stores_new_title_of_channel(self, db_session_maker):
+        db = db_session_maker()
+        db.add(Channel(channel_id='-1001', vk_group_id='mygroup', owner_id='12345', title='Старый'))
+        db.commit()
+        update = Mock()
+        update.effective_chat.id = -1001
+        update.effective_chat.title = 'Новый'
+
+        update_channel_title(update, Mock(), db_session_maker=db_session_maker)
+
+        assert_that(db_session_maker().query(Channel).get('-1001').title, equal_to('Новый'))
+
+
+class TestMakeDbSession:
+    def test_closes_session_when_handler_raises(self):
+        db = Mock()
+
+        @make_db_session
+        def handler(update, context, db):
+            raise ValueError('Handler error')
+
+        with pytest.raises(ValueError):
+            handler(Mock(), Mock(), db_session_maker=Mock(return_value=db))
+
+        db.close.assert_called_once()
@@ -0,0 +1,145 @@
+import datetime
+from unittest.mock import Mock
+from hamcrest import assert_that, equal_to, has_length
+from telegram.error import BadRequest
+
+from vk_channelify.media import Attachment, TelegramFileCache, get_post_attachments, send_post_messages
+from vk_channelify.models import TelegramFile
+
+
+def make_photo(photo_id):
+    return Attachment('photo-1_{}'.format(photo_id), 'photo', 'https://vk.ru/photo{}.jpg'.format(photo_id))
+
+
+def make_message(file_id):
+    message = Mock()
+    message.photo = [Mock(file_id='small'), Mock(file_id=file_id)]
+    message.document.file_id = file_id
+    return message
+
+
+def make_call():
+    """Mocks the call of Bot methods, every sent attachment gets a file id like file-1."""
+    sent_count = [0]
+
+    def call(method, chat_id, media, **kwargs):
+        if method == 'send_message':
+            return Mock()
+        if method == 'send_media_group':
+            messages = []
+            for _ in media:
+                sent_count[0] += 1
+                messages.append(make_message('file-{}'.format(sent_count[0])))
+            return messages
+        sent_count[0] += 1
+        return make_message('file-{}'.format(sent_count[0]))
+
+    return Mock(side_effect=call)
+
+
+class TestGetPostAttachments:
+    def test_returns_largest_photo_sizes_and_documents(self):
+        post = {'attachments': [
+            {'type': 'photo', 'photo': {'owner_id': -1, 'id': 10, 'sizes': [
+                {'url': 'https://vk.ru/s.jpg', 'width': 75, 'height': 50},
+                {'url': 'https://vk.ru/x.jpg', 'width': 604, 'height': 403},
+                {'url': 'https://vk.ru/m.jpg', 'width': 130, 'height': 87},
+            ]}},
+            {'type': 'link', 'link': {'url': 'https://example.com'}},
+            {'type': 'doc', 'doc': {'owner_id': -1, 'id': 20, 'url': 'https://vk.ru/doc20'}},
+        ]}
+
+        assert_that(get_post_attachments(post), equal_to([
+            Attachment('photo-1_10', 'photo', 'https://vk.ru/x.jpg'),
+            Attachment('doc-1_20', 'document', 'https://vk.ru/doc20'),
+        ]))
+
+    def test_returns_nothing_for_text_post(self):
+        assert_that(get_post_attachments({'text': 'Пост'}), equal_to([]))
+
+
+class TestSendPostMessages:
+    def test_sends_text_only_post_as_message(self):
+        call = make_call()
+
+        send_post_messages(call, '-1001', 'Пост', [])
+
+        call.assert_called_once_with('send_message', '-1001', 'Пост')
+
+    def test_sends_text_as_caption_of_photo(self):
+        call = make_call()
+
+        send_post_messages(call, '-1001', 'Пост', [make_photo(1)])
+
+        call.assert_called_once_with('send_photo', '-1001', 'https://vk.ru/photo1.jpg', caption='Пост')
+
+    def test_sends_long_text_before_photos(self):
+        call = make_call()
+        text = 'Пост' * 1000
+
+        send_post_messages(call, '-1001', text, [make_photo(1)])
+
+        methods = [c[0][0] for c in call.call_args_list]
+        assert_that(methods, equal_to(['send_message', 'send_photo']))
+        assert_that(call.call_args_list[1][1], equal_to({'caption': None}))
+
+    def test_sends_photos_as_albums(self):
+        call = make_call()
+
+        send_post_messages(call, '-1001', 'Пост', [make_photo(photo_id) for photo_id in range(12)])
+
+        methods = [c[0][0] for c in call.call_args_list]
+        assert_that(methods, equal_to(['send_media_group', 'send_media_group']))
+        first_album = call.call_args_list[0][0][2]
+        assert_that(first_album, has_length(10))
+        assert_that([getattr(media, 'caption', None) for media in first_album], equal_to(['Пост'] + [None] * 9))
+
+    def test_reuses_file_ids_for_other_channels(self):
+        call = make_call()
+        file_cache = TelegramFileCache()
+
+        send_post_messages(call, '-1001', 'Пост', [make_photo(1)], file_cache)
+        send_post_messages(call, '-1002', 'Пост', [make_photo(1)], file_cache)
+
+        call.assert_called_with('send_photo', '-1002', 'file-1', caption='Пост')
+
+    def test_falls_back_to_text_when_attachments_are_rejected(self):
+        call = Mock(side_effect=[BadRequest('Wrong file identifier/http url specified'), Mock()])
+        file_cache = TelegramFileCache()
+        file_cache.put('photo-1_1', 'stale-file')
+
+        send_post_messages(call, '-1001', 'Пост', [make_photo(1)], file_cache)
+
+        call.assert_called_with('send_message', '-1001', 'Пост')
+        assert_that(file_cache.get('photo-1_1'), equal_to(None))
+
+
+class TestTelegramFileCache:
+    def test_evicts_least_recently_used_file_ids(self):
+        file_cache = TelegramFileCache(max_size=2)
+        file_cache.put('photo-1_1', 'file-1')
+        file_cache.put('photo-1_2', 'file-2')
+        file_cache.get('photo-1_1')
+
+        file_cache.put('photo-1_3', 'file-3')
+
+        assert_that(file_cache.get('photo-1_1'), equal_to('file-1'))
+        assert_that(file_cache.get('photo-1_2'), equal_to(None))
+
+    def test_saves_only_max_size_file_ids(self, db):
+        now = datetime.datetime.utcnow()
+        db.add_all([TelegramFile(vk_attachment_id='photo-1_{}'.format(i), file_id='old-{}'.format(i),
+                                 last_used_at=now - datetime.timedelta(days=i)) for i in range(1, 4)])
+        db.commit()
+        file_cache = TelegramFileCache(max_size=2)
+
+        file_cache.load(db)
+        file_cache.put('photo-1_9', 'file-9')
+        file_cache.save(db)
+
+        file_ids = {file.vk_attachment_id: file.file_id for file in db.query(TelegramFile)}
+        assert_that(file_ids, equal_to({'photo-1_1': 'old-1', 'photo-1_9': 'file-9'}))
+
+        reloaded_cache = TelegramFileCache()
+        reloaded_cache.load(db)
+        assert_that(reloaded_cache.get('photo-1_9'), equal_to('file-9'))
@@ -0,0 +1,59 @@
+import pytest
+from hamcrest import assert_that, equal_to, has_length
+from prometheus_client import CollectorRegistry, Counter
+
+from vk_channelify import metrics
+from vk_channelify.metrics import BoundedLabels, configure_label_cardinality
+
+
+def make_counter():
+    registry = CollectorRegistry()
+    counter = BoundedLabels(Counter('sent_total', 'Sent posts', ['status', 'channel_id'], registry=registry))
+    return counter, registry
+
+
+def get_samples(registry):
+    return {tuple(sorted(sample.labels.items())): sample.value
+            for metric in registry.collect() for sample in metric.samples if sample.name == 'sent_total'}
+
+
+@pytest.fixture(autouse=True)
+def restore_label_cardinality():
+    yield
+    configure_label_cardinality('full')
+
+
+class TestConfigureLabelCardinality:
+    def test_keeps_ids_by_default(self):
+        counter, registry = make_counter()
+
+        counter.labels(status='success', channel_id='-1001').inc()
+
+        assert_that(get_samples(registry), equal_to({(('channel_id', '-1001'), ('status', 'success')): 1}))
+
+    def test_hashes_ids_into_buckets_keeping_totals(self):
+        configure_label_cardinality('hash', buckets=4)
+        counter, registry = make_counter()
+
+        for channel_id in range(1000):
+            counter.labels(status='success', channel_id=str(channel_id)).inc()
+
+        samples = get_samples(registry)
+        assert_that(len(samples) <= 4, equal_to(True))
+        assert_that(sum(samples.values()), equal_to(1000))
+
+    def test_drops_ids_but_keeps_other_labels(self):
+        configure_label_cardinality('drop')
+        counter, registry = make_counter()
+
+        counter.labels(status='success', channel_id='-1001').inc()
+        counter.labels(status='error', channel_id='-1002').inc()
+
+        assert_that(get_samples(registry), has_length(2))
+        assert_that(get_samples(registry)[(('channel_id', ''), ('status', 'error'))], equal_to(1))
+
+    def test_rejects_unknown_mode(self):
+        with pytest.raises(ValueError):
+            configure_label_cardinality('top')
+
+        assert_that(metrics.label_cardinality['mode'], equal_to('full'))
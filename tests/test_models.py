@@ -0,0 +1,35 @@
+from unittest.mock import patch
+from hamcrest import assert_that, equal_to
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool
+
+from vk_channelify.models import TimedQueuePool, make_session_maker
+
+
+@patch('vk_channelify.models.metrics')
+class TestMakeSessionMaker:
+    def test_tracks_checked_out_connections_and_wait_time(self, mock_metrics, tmp_path):
+        db_session_maker = make_session_maker('sqlite:///{}'.format(tmp_path / 'db.sqlite'), pool_size=2)
+        db = db_session_maker()
+
+        db.execute(text('SELECT 1'))
+        db.close()
+
+        assert_that(type(db_session_maker.kw['bind'].pool), equal_to(TimedQueuePool))
+        mock_metrics.db_pool_checked_out_gauge.inc.assert_called_once()
+        mock_metrics.db_pool_checked_out_gauge.dec.assert_called_once()
+        mock_metrics.db_pool_wait_seconds.observe.assert_called_once()
+
+    def test_leaves_pooling_to_pgbouncer(self, mock_metrics, tmp_path):
+        db_session_maker = make_session_maker('sqlite:///{}'.format(tmp_path / 'db.sqlite'), pgbouncer=True)
+
+        assert_that(type(db_session_maker.kw['bind'].pool), equal_to(NullPool))
+
+    def test_observes_commit_duration(self, mock_metrics, tmp_path):
+        db_session_maker = make_session_maker('sqlite:///{}'.format(tmp_path / 'db.sqlite'))
+        db = db_session_maker()
+
+        db.execute(text('SELECT 1'))
+        db.commit()
+
+        mock_metrics.db_commit_duration_seconds.observe.assert_called_once()
@@ -0,0 +1,66 @@
+import datetime
+from unittest.mock import patch
+from hamcrest import assert_that, equal_to
+
+from vk_channelify.models import Channel, Delivery
+from vk_channelify.outbox import DeliveredBatch, enqueue_deliveries, fetch_pending_deliveries, prune_deliveries
+
+
+def make_post(post_id):
+    return {'id': post_id, 'owner_id': -1, 'text': 'Пост {}'.format(post_id)}
+
+
+class TestEnqueueDeliveries:
+    def test_skips_posts_already_enqueued_for_channel(self, db):
+        enqueue_deliveries([('-1001', make_post(11))], db)
+
+        enqueue_deliveries([('-1001', make_post(11)), ('-1001', make_post(12)), ('-1002', make_post(11))], db)
+
+        pairs = sorted(db.query(Delivery.channel_id, Delivery.vk_post_id))
+        assert_that(pairs, equal_to([('-1001', 11), ('-1001', 12), ('-1002', 11)]))
+
+
+    def test_skips_pairs_repeated_in_batch(self, db):
+        enqueue_deliveries([('-1001', make_post(11)), ('-1001', make_post(11))], db)
+
+        assert_that(db.query(Delivery).count(), equal_to(1))
+
+
+class TestFetchPendingDeliveries:
+    def test_returns_pending_posts_of_channels_oldest_first(self, db):
+        enqueue_deliveries([('-1001', make_post(12)), ('-1001', make_post(11)), ('-1002', make_post(5))], db)
+
+        deliveries_by_channel = fetch_pending_deliveries(['-1001'], db)
+
+        posts = [post for _, post in deliveries_by_channel['-1001']]
+        assert_that(posts, equal_to([make_post(11), make_post(12)]))
+        assert_that(list(deliveries_by_channel), equal_to(['-1001']))
+
+
+class TestDeliveredBatch:
+    def test_marks_deliveries_once_batch_is_full(self, db):
+        enqueue_deliveries([('-1001', make_post(post_id)) for post_id in range(1, 4)], db)
+        delivery_ids = [delivery_id for delivery_id, _ in fetch_pending_deliveries(['-1001'], db)['-1001']]
+        delivered = DeliveredBatch(db, size=2)
+
+        with patch.object(db, 'commit', wraps=db.commit) as mock_commit:
+            for delivery_id in delivery_ids:
+                delivered.add(delivery_id)
+            assert_that(mock_commit.call_count, equal_to(1))
+
+            delivered.flush()
+            assert_that(mock_commit.call_count, equal_to(2))
+
+        assert_that(fetch_pending_deliveries(['-1001'], db), equal_to(dict()))
+
+
+class TestPruneDeliveries:
+    def test_deletes_old_delivered_and_orphaned_deliveries(self, db):
+        db.add(Channel(channel_id='-1001', vk_group_id='group', owner_id='1'))
+        enqueue_deliveries([('-1001', make_post(1)), ('-1001', make_post(2)), ('-1002', make_post(3))], db)
+        db.query(Delivery).filter_by(vk_post_id=1).update({'delivered_at': datetime.datetime(2020, 1, 1)})
+        db.commit()
+
+        prune_deliveries(db)
+
+        assert_that([delivery.vk_post_id for delivery in db.query(Delivery)], equal_to([2]))
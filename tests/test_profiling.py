@@ -0,0 +1,151 @@
+import marshal
+import threading
+import time
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+from hamcrest import assert_that, contains_string, equal_to, greater_than
+
+from vk_channelify import profiling
+from vk_channelify.profiling import ProfileCapture, ProfilingBusyError, format_profile, make_profiling_app
+
+
+def busy_function(seconds):
+    end_time = time.perf_counter() + seconds
+    while time.perf_counter() < end_time:
+        pass
+    return 'done'
+
+
+def call_app(app, path, query=''):
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+    setup_testing_defaults(environ)
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+
+    body = b''.join(app(environ, start_response))
+    return response['status'], body
+
+
+class TestProfileCapture:
+    def test_runs_calls_without_profiling_when_no_capture_is_open(self):
+        capture = ProfileCapture()
+
+        assert_that(capture.run(busy_function, 0), equal_to('done'))
+
+    def test_profiles_next_calls_with_cprofile(self):
+        capture = ProfileCapture()
+        capture.start('cprofile', calls=1)
+
+        capture.run(busy_function, 0.01)
+
+        assert_that(capture.wait(0), equal_to(True))
+        _, body = format_profile(capture.stop())
+        assert_that(body.decode(), contains_string('busy_function'))
+
+    def test_dumps_stats_for_pstats(self):
+        capture = ProfileCapture()
+        capture.start('cprofile', calls=1)
+        capture.run(busy_function, 0.01)
+
+        _, body = format_profile(capture.stop(), 'pstats')
+
+        function_names = [function[2] for function in marshal.loads(body)]
+        assert_that('busy_function' in function_names, equal_to(True))
+
+    def test_samples_collapsed_stacks(self):
+        capture = ProfileCapture(sample_interval=0.001)
+        capture.start('sample', calls=1)
+
+        capture.run(busy_function, 0.05)
+
+        stacks = capture.stop()
+        assert_that(len(stacks), greater_than(0))
+        _, body = format_profile(stacks)
+        assert_that(body.decode(), contains_string('busy_function'))
+
+    def test_allows_one_capture_at_a_time(self):
+        capture = ProfileCapture()
+        capture.start('cprofile')
+
+        with pytest.raises(ProfilingBusyError):
+            capture.start('sample')
+
+        capture.stop()
+        capture.start('sample')
+        capture.stop()
+
+    def test_leaves_out_calls_still_running_when_capture_stops(self):
+        capture = ProfileCapture()
+        capture.start('cprofile', calls=1)
+        started, release = threading.Event(), threading.Event()
+        worker = threading.Thread(target=capture.run, args=(lambda: [started.set(), release.wait(5)],))
+        worker.start()
+        started.wait(5)
+
+        assert_that(capture.wait(0), equal_to(False))
+        result = capture.stop()
+        capture.start('cprofile', calls=1)
+        release.set()
+        worker.join()
+
+        assert_that(format_profile(result)[1], equal_to(b'No calls were profiled'))
+        assert_that(capture.wait(0), equal_to(False))
+        capture.stop()
+
+    def test_profiles_concurrent_calls(self):
+        capture = ProfileCapture()
+        capture.start('cprofile', calls=4)
+        workers = [threading.Thread(target=capture.run, args=(busy_function, 0.01)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert_that(capture.wait(0), equal_to(True))
+        _, body = format_profile(capture.stop(), 'pstats')
+        call_counts = {function[2]: stats[1] for function, stats in marshal.loads(body).items()}
+        assert_that(call_counts['busy_function'], equal_to(4))
+
+    def test_rejects_unknown_mode(self):
+        with pytest.raises(ValueError):
+            ProfileCapture().start('perf')
+
+
+class TestMakeProfilingApp:
+    def test_passes_other_paths_to_metrics_app(self):
+        def metrics_app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'metrics']
+
+        assert_that(call_app(make_profiling_app(metrics_app), '/metrics'), equal_to(('200 OK', b'metrics')))
+
+    def test_dumps_thread_stacks(self):
+        status, body = call_app(make_profiling_app(None), '/debug/threads')
+
+        assert_that(status, equal_to('200 OK'))
+        assert_that(body.decode(), contains_string(threading.current_thread().name))
+
+    def test_profiles_next_repost_iterations(self):
+        worker = threading.Thread(target=lambda: [time.sleep(0.05),
+                                                  profiling.repost_iterations.run(busy_function, 0.01)])
+        worker.start()
+
+        status, body = call_app(make_profiling_app(None), '/debug/profile/repost', 'iterations=1&timeout=5')
+        worker.join()
+
+        assert_that(status, equal_to('200 OK'))
+        assert_that(body.decode(), contains_string('busy_function'))
+
+    def test_rejects_bad_parameters(self):
+        status, _ = call_app(make_profiling_app(None), '/debug/profile/manage', 'seconds=soon')
+
+        assert_that(status, equal_to('400 Bad Request'))
+
+    def test_returns_notice_when_no_iteration_finished_in_time(self):
+        status, body = call_app(make_profiling_app(None), '/debug/profile/repost', 'timeout=0.01')
+
+        assert_that(status, equal_to('200 OK'))
+        assert_that(body, equal_to(b'No calls were profiled'))
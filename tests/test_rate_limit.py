@@ -0,0 +1,46 @@
+from unittest.mock import patch
+from hamcrest import assert_that, equal_to, close_to
+
+from vk_channelify.rate_limit import TokenBucket
+
+
+class TestTokenBucket:
+    @patch('vk_channelify.rate_limit.time.monotonic')
+    def test_first_acquisitions_up_to_capacity_are_free(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=3, capacity=2)
+
+        assert_that(bucket.reserve(), equal_to(0))
+        assert_that(bucket.reserve(), equal_to(0))
+
+    @patch('vk_channelify.rate_limit.time.monotonic')
+    def test_reservations_beyond_capacity_are_spaced_by_rate(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=4)
+
+        delays = [bucket.reserve() for _ in range(3)]
+
+        assert_that(delays[0], equal_to(0))
+        assert_that(delays[1], close_to(0.25, 1e-9))
+        assert_that(delays[2], close_to(0.5, 1e-9))
+
+    @patch('vk_channelify.rate_limit.time.monotonic')
+    def test_tokens_refill_over_time(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2)
+        bucket.reserve()
+
+        mock_monotonic.return_value = 100.5
+
+        assert_that(bucket.reserve(), equal_to(0))
+
+    @patch('vk_channelify.rate_limit.time.sleep')
+    @patch('vk_channelify.rate_limit.time.monotonic')
+    def test_acquire_sleeps_for_reserved_delay(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2)
+
+        bucket.acquire()
+        bucket.acquire()
+
+        mock_sleep.assert_called_once_with(0.5)
@@ -1,98 +1,755 @@
+import datetime
 import pytest
 from unittest.mock import Mock, patch
 import telegram
-from hamcrest import assert_that, equal_to, is_, none, has_length
+from hamcrest import assert_that, equal_to, is_, none, has_length, less_than_or_equal_to
 
 from vk_channelify.repost_worker import (
+    VK_EXECUTE_MAX_CALLS,
     extract_group_id_if_has,
-    is_passing_hashtag_filter,
-    fetch_group_posts,
+    fetch_groups_posts,
+    iterate_batches,
+    group_channels_by_vk_group,
+    normalize_group,
+    fetch_groups_info,
+    fetch_groups_new_posts,
+    estimate_wall_page_size,
+    get_group_cursor,
+    select_channels_new_posts,
+    resolve_channels_vk_groups,
+    request_vk,
+    send_post,
+    update_vk_groups_stats,
+    get_vk_group_key,
     disable_channel,
-    run_worker_iteration
+    update_channels_gauges,
+    run_worker_iteration,
+    select_unpushed_groups,
+    wait_delivering_pushed_posts,
+    pushed_posts
 )
 from vk_channelify.vk_errors import VkError, VkWallAccessDeniedError
+from vk_channelify.models import Channel, DisabledChannel, Delivery, VkGroup
+from vk_channelify.outbox import enqueue_deliveries
+from vk_channelify.send_scheduler import SendScheduler
+from vk_channelify.vk_tokens import VkTokenPool
+from tests.helpers import add_channels, get_last_vk_post_id, get_pending_post_ids
 
 
 class TestRunWorkerIteration:
+    @pytest.fixture(autouse=True)
+    def mock_resolve(self):
+        with patch('vk_channelify.repost_worker.resolve_channels_vk_groups') as mock_resolve:
+            yield mock_resolve
+
     @patch('vk_channelify.repost_worker.telegram.Bot')
-    @patch('vk_channelify.repost_worker.fetch_group_posts')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
     @patch('vk_channelify.repost_worker.metrics')
-    def test_iteration_sends_new_posts(self, mock_metrics, mock_fetch, mock_bot_class):
+    def test_iteration_sends_new_posts(self, mock_metrics, mock_fetch, mock_bot_class, db):
         mock_bot = Mock()
         mock_bot_class.return_value = mock_bot
-        mock_channel = Mock(channel_id='-100123456', vk_group_id='testgroup', last_vk_post_id=10, hashtag_filter=None)
-        mock_db = Mock()
-        mock_db.query.return_value.count.return_value = 1
-        mock_db.query.return_value.__iter__ = Mock(return_value=iter([mock_channel]))
-        mock_fetch.return_value = [
+        channel, = add_channels(db, dict(channel_id='-100123456', vk_group_id='testgroup', last_vk_post_id=10))
+        mock_fetch.return_value = {'testgroup': [
             {'id': 11, 'owner_id': -123, 'text': 'New post 1'},
             {'id': 12, 'owner_id': -123, 'text': 'New post 2'}
-        ]
+        ]}
 
-        run_worker_iteration('vk_token', 'tg_token', mock_db)
+        run_worker_iteration('vk_token', 'tg_token', db)
 
         assert_that(mock_bot.send_message.call_count, equal_to(2))
-        assert_that(mock_channel.last_vk_post_id, equal_to(12))
+        assert_that(get_last_vk_post_id(db, '-100123456'), equal_to(12))
+        assert_that(db.query(Delivery).filter(Delivery.delivered_at.isnot(None)).count(), equal_to(2))
 
     @patch('vk_channelify.repost_worker.telegram.Bot')
-    @patch('vk_channelify.repost_worker.fetch_group_posts')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
     @patch('vk_channelify.repost_worker.metrics')
-    def test_iteration_skips_old_posts(self, mock_metrics, mock_fetch, mock_bot_class):
+    def test_iteration_skips_old_posts(self, mock_metrics, mock_fetch, mock_bot_class, db):
         mock_bot = Mock()
         mock_bot_class.return_value = mock_bot
-        mock_channel = Mock(channel_id='-100123456', vk_group_id='testgroup', last_vk_post_id=10, hashtag_filter=None)
-        mock_db = Mock()
-        mock_db.query.return_value.count.return_value = 1
-        mock_db.query.return_value.__iter__ = Mock(return_value=iter([mock_channel]))
-        mock_fetch.return_value = [{'id': 9, 'owner_id': -123, 'text': 'Old post'}]
+        add_channels(db, dict(channel_id='-100123456', vk_group_id='testgroup', last_vk_post_id=10))
+        mock_fetch.return_value = {'testgroup': [{'id': 9, 'owner_id': -123, 'text': 'Old post'}]}
 
-        run_worker_iteration('vk_token', 'tg_token', mock_db)
+        run_worker_iteration('vk_token', 'tg_token', db)
 
         mock_bot.send_message.assert_not_called()
 
     @patch('vk_channelify.repost_worker.telegram.Bot')
-    @patch('vk_channelify.repost_worker.fetch_group_posts')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
     @patch('vk_channelify.repost_worker.disable_channel')
     @patch('vk_channelify.repost_worker.metrics')
-    def test_iteration_disables_channel_on_unauthorized(self, mock_metrics, mock_disable, mock_fetch, mock_bot_class):
+    def test_iteration_disables_channel_on_unauthorized(self, mock_metrics, mock_disable, mock_fetch, mock_bot_class, db):
         mock_bot = Mock()
         mock_bot_class.return_value = mock_bot
         mock_bot.send_message.side_effect = telegram.error.Unauthorized('Unauthorized')
-        mock_channel = Mock(channel_id='-100123456', vk_group_id='testgroup', last_vk_post_id=10, hashtag_filter=None)
-        mock_db = Mock()
-        mock_db.query.return_value.count.return_value = 1
-        mock_db.query.return_value.__iter__ = Mock(return_value=iter([mock_channel]))
-        mock_fetch.return_value = [{'id': 11, 'owner_id': -123, 'text': 'New post'}]
+        channel, = add_channels(db, dict(channel_id='-100123456', vk_group_id='testgroup', last_vk_post_id=10))
+        mock_fetch.return_value = {'testgroup': [{'id': 11, 'owner_id': -123, 'text': 'New post'}]}
+
+        disabled_channel_ids = []
+        mock_disable.side_effect = lambda channel, db, bot: disabled_channel_ids.append(channel.channel_id)
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(disabled_channel_ids, equal_to(['-100123456']))
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.disable_channel')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_disables_channel_on_wall_access_denied(self, mock_metrics, mock_disable, mock_fetch, mock_bot_class, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        denied_channel, ok_channel = add_channels(
+            db,
+            dict(channel_id='-100123456', vk_group_id='closedgroup', last_vk_post_id=10),
+            dict(channel_id='-100654321', vk_group_id='testgroup', last_vk_post_id=10))
+        mock_fetch.return_value = {
+            'closedgroup': VkWallAccessDeniedError(15, 'Access denied', []),
+            'testgroup': [{'id': 11, 'owner_id': -123, 'text': 'New post'}]
+        }
+
+        disabled_channel_ids = []
+        mock_disable.side_effect = lambda channel, db, bot: disabled_channel_ids.append(channel.channel_id)
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(disabled_channel_ids, equal_to(['-100123456']))
+        mock_bot.send_message.assert_called_once()
+        assert_that(get_last_vk_post_id(db, '-100654321'), equal_to(11))
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_delivers_other_groups_when_group_fails(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        add_channels(db, *[dict(channel_id=str(i), vk_group_id='group{}'.format(i), last_vk_post_id=10)
+                           for i in range(30)])
+
+        def fetch(groups, vk_service_code, session, page_params):
+            return {group: VkError(10, 'Internal server error', []) if group == 'group0'
+                    else [{'id': 11, 'owner_id': -1, 'text': 'a'}] for group in groups}
+
+        mock_fetch.side_effect = fetch
+
+        run_worker_iteration('vk_token', 'tg_token', db, send_scheduler=SendScheduler(global_rate=10000))
+
+        assert_that(mock_fetch.call_count, equal_to(2))
+        assert_that(mock_bot.send_message.call_count, equal_to(29))
+        assert_that(db.query(Delivery).filter_by(delivered_at=None).count(), equal_to(0))
+        assert_that(get_last_vk_post_id(db, '0'), equal_to(10))
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_fetches_in_batches_of_25(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        add_channels(db, *[dict(channel_id=str(i), vk_group_id='group{}'.format(i), last_vk_post_id=0)
+                           for i in range(30)])
+        mock_fetch.side_effect = lambda groups, vk_service_code, session, page_params: {group: [] for group in groups}
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(mock_fetch.call_count, equal_to(2))
+        assert_that(mock_fetch.call_args_list[0][0][0], has_length(25))
+        assert_that(mock_fetch.call_args_list[1][0][0], has_length(5))
+
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_fetches_shared_group_once(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        behind_channel, up_to_date_channel, filtered_channel = add_channels(
+            db,
+            dict(channel_id='-1001', vk_group_id='club123', last_vk_post_id=10),
+            dict(channel_id='-1002', vk_group_id='public123', last_vk_post_id=11),
+            dict(channel_id='-1003', vk_group_id='club123', last_vk_post_id=0, hashtag_filter='#cats'))
+        mock_fetch.return_value = {'club123': [
+            {'id': 11, 'owner_id': -123, 'text': 'Post about #dogs'},
+            {'id': 12, 'owner_id': -123, 'text': 'Post about #cats'}
+        ]}
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        mock_fetch.assert_called_once()
+        assert_that(mock_fetch.call_args[0][0], equal_to(['club123']))
+        sent_chats = [c[0][0] for c in mock_bot.send_message.call_args_list]
+        assert_that(sent_chats, equal_to(['-1001', '-1002', '-1003', '-1001']))
+        assert_that(get_last_vk_post_id(db, '-1001'), equal_to(12))
+        assert_that(get_last_vk_post_id(db, '-1002'), equal_to(12))
+        assert_that(get_last_vk_post_id(db, '-1003'), equal_to(12))
+
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_polls_only_due_groups(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        add_channels(db,
+                     dict(channel_id='-1001', vk_group_id='duegroup', last_vk_post_id=0),
+                     dict(channel_id='-1002', vk_group_id='latergroup', last_vk_post_id=0))
+        mock_fetch.return_value = {'duegroup': []}
+        scheduler = Mock()
+        scheduler.pop_due_groups.return_value = ['duegroup']
+
+        run_worker_iteration('vk_token', 'tg_token', db, scheduler=scheduler)
+
+        assert_that(mock_fetch.call_args[0][0], equal_to(['duegroup']))
+        scheduler.reschedule.assert_called_once_with('duegroup', [])
+        scheduler.save.assert_called_once_with(db)
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_polls_only_leased_groups(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        add_channels(db,
+                     dict(channel_id='-1001', vk_group_id='ourgroup', last_vk_post_id=0),
+                     dict(channel_id='-1002', vk_group_id='othergroup', last_vk_post_id=0))
+        mock_fetch.return_value = {'ourgroup': []}
+        leases = Mock()
+        leases.claim.return_value = ['ourgroup']
+
+        run_worker_iteration('vk_token', 'tg_token', db, leases=leases)
+
+        assert_that(mock_fetch.call_args[0][0], equal_to(['ourgroup']))
+        leases.renew.assert_called_once_with(db)
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_keeps_only_current_batch_in_session(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        groups_count, channels_per_group = 100, 4
+        db.add_all(VkGroup(id=i, screen_name='group{}'.format(i)) for i in range(groups_count))
+        add_channels(db, *[dict(channel_id='-100{}_{}'.format(i, j), vk_group_id='group{}'.format(i), vk_group_ref=i)
+                           for i in range(groups_count) for j in range(channels_per_group)])
+        db.expunge_all()
+        session_sizes = []
+
+        def fetch(groups, vk_service_code, session, page_params):
+            session_sizes.append(len(db.identity_map))
+            return {group: [{'id': 1, 'owner_id': -1, 'text': 'a'}] for group in groups}
+
+        mock_fetch.side_effect = fetch
+
+        run_worker_iteration('vk_token', 'tg_token', db, send_scheduler=SendScheduler(global_rate=10000))
+
+        assert_that(session_sizes, has_length(groups_count // VK_EXECUTE_MAX_CALLS))
+        assert_that(max(session_sizes), less_than_or_equal_to(VK_EXECUTE_MAX_CALLS * channels_per_group))
+        assert_that(len(db.identity_map), equal_to(0))
+        assert_that(mock_bot_class.return_value.send_message.call_count, equal_to(groups_count * channels_per_group))
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_keeps_unsent_posts_pending(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        mock_bot.send_message.side_effect = [None, telegram.error.TimedOut()]
+        channel, = add_channels(db, dict(channel_id='-1001', vk_group_id='testgroup', last_vk_post_id=10))
+        mock_fetch.return_value = {'testgroup': [
+            {'id': 11, 'owner_id': -123, 'text': 'New post 1'},
+            {'id': 12, 'owner_id': -123, 'text': 'New post 2'}
+        ]}
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(get_last_vk_post_id(db, '-1001'), equal_to(12))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([12]))
+
+    @pytest.mark.parametrize('error', [telegram.error.BadRequest('Message is too long'), telegram.error.RetryAfter(1)])
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_keeps_post_pending_and_goes_on_with_other_channels(self, mock_metrics, mock_fetch, mock_bot_class, error, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+
+        def send_message(chat_id, text):
+            if chat_id == '-1001':
+                raise error
 
-        run_worker_iteration('vk_token', 'tg_token', mock_db)
+        mock_bot.send_message.side_effect = send_message
+        add_channels(db, dict(channel_id='-1001', vk_group_id='group1', last_vk_post_id=0),
+                     dict(channel_id='-1002', vk_group_id='group2', last_vk_post_id=0))
+        mock_fetch.return_value = {'group1': [{'id': 1, 'owner_id': -1, 'text': 'a'}],
+                                   'group2': [{'id': 1, 'owner_id': -2, 'text': 'b'}]}
 
-        mock_disable.assert_called_once_with(mock_channel, mock_db, mock_bot)
+        run_worker_iteration('vk_token', 'tg_token', db, send_scheduler=SendScheduler(max_retries=0))
+
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([1]))
+        assert_that(get_pending_post_ids(db, '-1002'), equal_to([]))
+        assert_that(db.query(Channel).count(), equal_to(2))
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_does_not_send_partly_sent_post_again(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        mock_bot.send_document.side_effect = telegram.error.TimedOut()
+        add_channels(db, dict(channel_id='-1001', vk_group_id='testgroup', last_vk_post_id=10))
+        # The text is too long for a caption, so it goes before the document
+        mock_fetch.return_value = {'testgroup': [
+            {'id': 11, 'owner_id': -123, 'text': 'a' * 2000,
+             'attachments': [{'type': 'doc', 'doc': {'owner_id': -123, 'id': 2, 'url': 'https://vk.ru/doc-123_2'}}]}
+        ]}
+
+        run_worker_iteration('vk_token', 'tg_token', db)
+        run_worker_iteration('vk_token', 'tg_token', db)
+
+        assert_that(mock_bot.send_message.call_count, equal_to(1))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([]))
+
+    @patch('vk_channelify.repost_worker.telegram.Bot')
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_sends_posts_left_pending_once(self, mock_metrics, mock_fetch, mock_bot_class, db):
+        mock_bot = Mock()
+        mock_bot_class.return_value = mock_bot
+        add_channels(db, dict(channel_id='-1001', vk_group_id='testgroup', last_vk_post_id=12))
+        enqueue_deliveries([('-1001', {'id': 12, 'owner_id': -123, 'text': 'Pending post'})], db)
+        mock_fetch.return_value = {'testgroup': [{'id': 12, 'owner_id': -123, 'text': 'Pending post'}]}
 
+        run_worker_iteration('vk_token', 'tg_token', db)
+        run_worker_iteration('vk_token', 'tg_token', db)
 
-class TestFetchGroupPosts:
-    @patch('vk_channelify.repost_worker.requests.get')
+        mock_bot.send_message.assert_called_once_with('-1001', 'https://vk.ru/wall-123_12\n\nPending post')
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([]))
+
+
+class TestFetchGroupsPosts:
+    @patch('vk_channelify.repost_worker.requests.post')
     @patch('vk_channelify.repost_worker.time.sleep')
     @patch('vk_channelify.repost_worker.metrics')
-    def test_fetch_success(self, mock_metrics, mock_sleep, mock_get):
-        mock_get.return_value.json.return_value = {
-            'response': {'items': [{'id': 1, 'text': 'Post 1'}]}
+    def test_fetch_splits_results_by_group(self, mock_metrics, mock_sleep, mock_post):
+        mock_post.return_value.json.return_value = {
+            'response': [{'items': [{'id': 1, 'text': 'Post 1'}]}, {'items': [{'id': 2, 'text': 'Post 2'}]}]
         }
 
-        posts = fetch_group_posts('mygroup', 'test_token')
+        posts_by_group = fetch_groups_posts(['mygroup', 'club123'], 'test_token')
+
+        assert_that(posts_by_group['mygroup'][0]['id'], equal_to(1))
+        assert_that(posts_by_group['club123'][0]['id'], equal_to(2))
+        code = mock_post.call_args[1]['data']['code']
+        assert_that('"domain": "mygroup"' in code, is_(True))
+        assert_that('"owner_id": -123' in code, is_(True))
+
+    @patch('vk_channelify.repost_worker.requests.post')
+    @patch('vk_channelify.repost_worker.time.sleep')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_fetch_maps_execute_errors_to_failed_calls(self, mock_metrics, mock_sleep, mock_post):
+        mock_post.return_value.json.return_value = {
+            'response': [False, {'items': []}, False],
+            'execute_errors': [
+                {'method': 'wall.get', 'error_code': 15, 'error_msg': 'Access denied'},
+                {'method': 'wall.get', 'error_code': 10, 'error_msg': 'Internal server error'}
+            ]
+        }
+
+        posts_by_group = fetch_groups_posts(['closed', 'ok', 'broken'], 'test_token')
+
+        assert_that(isinstance(posts_by_group['closed'], VkWallAccessDeniedError), is_(True))
+        assert_that(posts_by_group['ok'], equal_to([]))
+        assert_that(type(posts_by_group['broken']), equal_to(VkError))
+        assert_that(posts_by_group['broken'].code, equal_to(10))
+
+    @patch('vk_channelify.repost_worker.requests.post')
+    @patch('vk_channelify.repost_worker.time.sleep')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_fetch_raises_on_execute_error(self, mock_metrics, mock_sleep, mock_post):
+        mock_post.return_value.json.return_value = {
+            'error': {'error_code': 5, 'error_msg': 'User authorization failed', 'request_params': []}
+        }
 
-        assert_that(posts, has_length(1))
-        assert_that(posts[0]['id'], equal_to(1))
+        with pytest.raises(VkError):
+            fetch_groups_posts(['mygroup'], 'test_token')
 
-    @patch('vk_channelify.repost_worker.requests.get')
     @patch('vk_channelify.repost_worker.time.sleep')
     @patch('vk_channelify.repost_worker.metrics')
-    def test_fetch_access_denied_error(self, mock_metrics, mock_sleep, mock_get):
-        mock_get.return_value.json.return_value = {
-            'error': {'error_code': 15, 'error_msg': 'Access denied', 'request_params': []}
+    def test_fetch_uses_passed_session(self, mock_metrics, mock_sleep):
+        session = Mock()
+        session.post.return_value.json.return_value = {'response': [{'items': []}]}
+
+        fetch_groups_posts(['mygroup'], 'test_token', session)
+
+        session.post.assert_called_once()
+
+    @patch('vk_channelify.repost_worker.metrics')
+    @patch('vk_channelify.vk_tokens.time.sleep')
+    def test_fetch_retries_calls_failed_because_of_token_with_another_one(self, mock_sleep, mock_metrics):
+        pool = VkTokenPool(['a', 'b'], requests_per_second=100)
+        responses = {
+            'a': {'response': [False, {'items': [{'id': 2}]}],
+                  'execute_errors': [{'method': 'wall.get', 'error_code': 6, 'error_msg': 'Too many requests'}]},
+            'b': {'response': [{'items': [{'id': 1}]}]}
         }
+        session = Mock()
+        session.post.side_effect = lambda url, data: Mock(**{'json.return_value': responses[data['access_token']]})
+
+        posts_by_group = fetch_groups_posts(['limited', 'ok'], pool, session)
+
+        assert_that(posts_by_group, equal_to({'limited': [{'id': 1}], 'ok': [{'id': 2}]}))
+        retry_code = session.post.call_args_list[1][1]['data']['code']
+        assert_that(('"limited"' in retry_code, '"ok"' in retry_code), equal_to((True, False)))
+        assert_that(pool.acquire(), equal_to('b'))
+
+    def test_fetch_rejects_too_many_groups(self):
+        with pytest.raises(ValueError):
+            fetch_groups_posts(['group{}'.format(i) for i in range(26)], 'test_token')
+
+
+def make_wall(post_ids, pinned_post_id=None):
+    posts = [{'id': post_id} for post_id in sorted(post_ids, reverse=True)]
+    if pinned_post_id is not None:
+        posts.insert(0, {'id': pinned_post_id, 'is_pinned': 1})
+    return posts
+
+
+def make_fetch_from_walls(walls):
+    def fetch(groups, vk_service_code, session, page_params):
+        return {group: walls[group][page_params[group]['offset']:][:page_params[group]['count']] for group in groups}
+
+    return fetch
+
 
-        with pytest.raises(VkWallAccessDeniedError):
-            fetch_group_posts('mygroup', 'test_token')
+class TestSendPost:
+    @patch('vk_channelify.repost_worker.time.time')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_observes_send_latency_and_post_freshness(self, mock_metrics, mock_time):
+        mock_time.return_value = 1000300
+        bot = Mock()
+        channel = Mock(channel_id='-1001', vk_group_id='mygroup')
+
+        send_post(channel, {'id': 1, 'owner_id': -1, 'date': 1000000, 'text': 'Пост'}, bot)
+
+        bot.send_message.assert_called_once_with('-1001', 'https://vk.ru/wall-1_1\n\nПост')
+        mock_metrics.telegram_api_request_duration_seconds.labels.assert_called_once_with(method='send_message')
+        mock_metrics.post_delivery_delay_seconds.observe.assert_called_once_with(300)
+
+
+class TestRequestVk:
+    @patch('vk_channelify.repost_worker.metrics')
+    @patch('vk_channelify.vk_tokens.time.sleep')
+    def test_retries_with_another_token_when_token_is_rate_limited(self, mock_sleep, mock_metrics):
+        pool = VkTokenPool(['a', 'b'], requests_per_second=100)
+        responses = {'a': {'error': {'error_code': 29, 'error_msg': 'Rate limit reached'}}, 'b': {'response': []}}
+        used_tokens = []
+
+        def send_request(token):
+            used_tokens.append(token)
+            return Mock(**{'json.return_value': responses[token]})
+
+        j = request_vk('execute', send_request, pool)
+
+        assert_that(j, equal_to({'response': []}))
+        assert_that(sorted(used_tokens), equal_to(['a', 'b']))
+
+
+@patch.dict('vk_channelify.repost_worker.wall_page_sizes', clear=True)
+@patch('vk_channelify.repost_worker.fetch_groups_posts')
+class TestFetchGroupsNewPosts:
+    def test_pages_until_cursor_is_reached(self, mock_fetch):
+        mock_fetch.side_effect = make_fetch_from_walls({'club1': make_wall(range(1, 41))})
+
+        posts_by_group = fetch_groups_new_posts(['club1'], {'club1': 15}, 'vk_token', Mock())
+
+        assert_that(min(post['id'] for post in posts_by_group['club1']) <= 15, is_(True))
+        assert_that(mock_fetch.call_count, equal_to(2))
+        assert_that(mock_fetch.call_args_list[1][0][3]['club1'], equal_to({'count': 100, 'offset': 10}))
+
+    def test_pinned_post_does_not_stop_paging(self, mock_fetch):
+        mock_fetch.side_effect = make_fetch_from_walls({'club1': make_wall(range(1, 41), pinned_post_id=2)})
+
+        posts_by_group = fetch_groups_new_posts(['club1'], {'club1': 15}, 'vk_token', Mock())
+
+        assert_that(mock_fetch.call_count, equal_to(2))
+        # The pinned post is on the wall twice, at the top and in its place
+        assert_that(len(posts_by_group['club1']), equal_to(40))
+
+    def test_fetches_only_latest_page_without_cursor(self, mock_fetch):
+        mock_fetch.side_effect = make_fetch_from_walls({'club1': make_wall(range(1, 41))})
+
+        posts_by_group = fetch_groups_new_posts(['club1'], {'club1': None}, 'vk_token', Mock())
+
+        assert_that(posts_by_group['club1'], has_length(10))
+        assert_that(mock_fetch.call_count, equal_to(1))
+
+    def test_quiet_group_gets_small_page_next_time(self, mock_fetch):
+        mock_fetch.side_effect = make_fetch_from_walls({'club1': make_wall(range(1, 41), pinned_post_id=2)})
+
+        fetch_groups_new_posts(['club1'], {'club1': 40}, 'vk_token', Mock())
+        fetch_groups_new_posts(['club1'], {'club1': 40}, 'vk_token', Mock())
+
+        assert_that(mock_fetch.call_args_list[1][0][3]['club1'], equal_to({'count': 4, 'offset': 0}))
+
+    def test_stops_paging_at_max_posts(self, mock_fetch):
+        mock_fetch.side_effect = make_fetch_from_walls({'club1': make_wall(range(1, 1001))})
+
+        posts_by_group = fetch_groups_new_posts(['club1'], {'club1': 1}, 'vk_token', Mock())
+
+        assert_that(posts_by_group['club1'], has_length(310))
+
+    def test_skips_posts_repeated_when_post_is_published_between_pages(self, mock_fetch):
+        wall = make_wall(range(1, 41))
+
+        def fetch(groups, vk_service_code, session, page_params):
+            if page_params['club1']['offset'] > 0:
+                # A new post pushes the wall down by one, the last post of the first page is fetched again
+                wall.insert(0, {'id': 41})
+            return make_fetch_from_walls({'club1': wall})(groups, vk_service_code, session, page_params)
+
+        mock_fetch.side_effect = fetch
+
+        posts_by_group = fetch_groups_new_posts(['club1'], {'club1': 15}, 'vk_token', Mock())
+
+        post_ids = [post['id'] for post in posts_by_group['club1']]
+        assert_that(sorted(post_ids), equal_to(list(range(1, 41))))
+
+    def test_keeps_first_page_error(self, mock_fetch):
+        error = VkError(10, 'Internal server error', [])
+        mock_fetch.return_value = {'club1': error}
+
+        posts_by_group = fetch_groups_new_posts(['club1'], {'club1': 1}, 'vk_token', Mock())
+
+        assert_that(posts_by_group['club1'], is_(error))
+
+
+class TestEstimateWallPageSize:
+    def test_busy_group_gets_room_for_a_burst(self):
+        assert_that(estimate_wall_page_size(make_wall(range(1, 21)), 10, False), equal_to(20))
+
+    def test_page_size_is_capped(self):
+        assert_that(estimate_wall_page_size(make_wall(range(1, 201)), 1, False), equal_to(100))
+
+
+class TestGetGroupCursor:
+    def test_returns_oldest_cursor_of_existing_channels(self):
+        channels = [Mock(last_vk_post_id=0), Mock(last_vk_post_id=20), Mock(last_vk_post_id=15)]
+
+        assert_that(get_group_cursor(channels), equal_to(15))
+
+    def test_returns_none_for_new_channels(self):
+        assert_that(get_group_cursor([Mock(last_vk_post_id=0)]), is_(none()))
+
+
+class TestSelectChannelsNewPosts:
+    def test_new_channel_gets_only_latest_posts(self):
+        channel = Mock(last_vk_post_id=0, hashtag_filter=None)
+
+        channel_posts = list(select_channels_new_posts([channel], make_wall(range(1, 31))))
+
+        assert_that([post['id'] for _, post in channel_posts], equal_to(list(range(21, 31))))
+
+    def test_posts_go_to_channels_filtering_by_their_hashtags(self):
+        cats_channel = Mock(last_vk_post_id=1, hashtag_filter='#cats')
+        dogs_channel = Mock(last_vk_post_id=1, hashtag_filter='#dogs,#Cats')
+        unfiltered_channel = Mock(last_vk_post_id=1, hashtag_filter=None)
+        posts = [{'id': 2, 'text': 'About #cats'}, {'id': 3, 'text': 'About #dogs'}, {'id': 4, 'text': 'About #category'}]
+
+        channel_posts = [(channel, post['id']) for channel, post in select_channels_new_posts(
+            [cats_channel, dogs_channel, unfiltered_channel], posts)]
+
+        assert_that(sorted(post_id for channel, post_id in channel_posts if channel is cats_channel), equal_to([2]))
+        assert_that(sorted(post_id for channel, post_id in channel_posts if channel is dogs_channel), equal_to([2, 3]))
+        assert_that(sorted(post_id for channel, post_id in channel_posts if channel is unfiltered_channel),
+                    equal_to([2, 3, 4]))
+
+
+class TestFetchGroupsInfo:
+    @patch('vk_channelify.repost_worker.time.sleep')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_maps_infos_to_requested_groups(self, mock_metrics, mock_sleep):
+        session = Mock()
+        session.get.return_value.json.return_value = {'response': [
+            {'id': 1, 'screen_name': 'MyGroup'},
+            {'id': 123, 'screen_name': 'club123'}
+        ]}
+
+        infos_by_group = fetch_groups_info(['mygroup', 'club123', 'unknown'], 'test_token', session)
+
+        assert_that(infos_by_group['mygroup']['id'], equal_to(1))
+        assert_that(infos_by_group['club123']['id'], equal_to(123))
+        assert_that('unknown' in infos_by_group, is_(False))
+        assert_that(session.get.call_args[1]['params']['group_ids'], equal_to('mygroup,123,unknown'))
+
+    @patch('vk_channelify.repost_worker.time.sleep')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_resolves_one_by_one_when_batch_is_rejected(self, mock_metrics, mock_sleep):
+        def get(url, params):
+            response = Mock()
+            if params['group_ids'] == 'good':
+                response.json.return_value = {'response': [{'id': 1, 'screen_name': 'good'}]}
+            else:
+                response.json.return_value = {'error': {'error_code': 100, 'error_msg': 'Invalid group id'}}
+            return response
+
+        session = Mock()
+        session.get.side_effect = get
+
+        infos_by_group = fetch_groups_info(['good', 'bad'], 'test_token', session)
+
+        assert_that(list(infos_by_group), equal_to(['good']))
+
+
+class TestResolveChannelsVkGroups:
+    @patch('vk_channelify.repost_worker.fetch_groups_info')
+    def test_links_channels_to_vk_groups(self, mock_fetch_info, db):
+        by_domain = Channel(channel_id='-1001', vk_group_id='MyGroup', owner_id='1')
+        by_club = Channel(channel_id='-1002', vk_group_id='public123', owner_id='1')
+        unknown = Channel(channel_id='-1003', vk_group_id='unknown', owner_id='1')
+        db.add_all([by_domain, by_club, unknown])
+        db.commit()
+        mock_fetch_info.return_value = {'mygroup': {'id': 1, 'screen_name': 'mygroup'},
+                                        'club123': {'id': 123, 'screen_name': 'club123'}}
+
+        resolve_channels_vk_groups([by_domain, by_club, unknown], 'vk_token', Mock(), db)
+
+        assert_that(by_domain.vk_group_ref, equal_to(1))
+        assert_that(by_club.vk_group_ref, equal_to(123))
+        assert_that(unknown.vk_group_ref, is_(none()))
+        assert_that(db.query(VkGroup).count(), equal_to(2))
+        assert_that(get_vk_group_key(by_domain), equal_to('club1'))
+        assert_that(get_vk_group_key(unknown), equal_to('unknown'))
+
+    @patch('vk_channelify.repost_worker.fetch_groups_info')
+    def test_skips_resolved_channels(self, mock_fetch_info):
+        resolve_channels_vk_groups([Mock(vk_group_ref=1)], 'vk_token', Mock(), Mock())
+
+        mock_fetch_info.assert_not_called()
+
+
+    @patch('vk_channelify.repost_worker.fetch_groups_info')
+    def test_backs_off_groups_vk_cannot_resolve(self, mock_fetch_info, db):
+        now = datetime.datetime(2026, 10, 18, 12)
+        unknown = Channel(channel_id='-1003', vk_group_id='unknown', owner_id='1', resolve_error_streak=2)
+        db.add(unknown)
+        db.commit()
+        mock_fetch_info.return_value = {}
+
+        resolve_channels_vk_groups([unknown], 'vk_token', Mock(), db, now=now)
+
+        assert_that(unknown.resolve_error_streak, equal_to(3))
+        assert_that(unknown.resolve_retry_at > now, is_(True))
+
+    @patch('vk_channelify.repost_worker.fetch_groups_posts')
+    @patch('vk_channelify.repost_worker.fetch_groups_info')
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_iteration_skips_channels_backing_off(self, mock_metrics, mock_fetch_info, mock_fetch, db):
+        add_channels(db, dict(channel_id='-1001', vk_group_id='unknown',
+                              resolve_error_streak=3, resolve_retry_at=datetime.datetime(2100, 1, 1)),
+                     dict(channel_id='-1002', vk_group_id='known'))
+        mock_fetch_info.return_value = {}
+        mock_fetch.return_value = {'known': []}
+
+        run_worker_iteration('vk_token', 'tg_token', db, bot=Mock())
+
+        assert_that(mock_fetch_info.call_args[0][0], equal_to(['known']))
+        assert_that(mock_fetch.call_args[0][0], equal_to(['known']))
+
+class TestUpdateVkGroupsStats:
+    def test_tracks_last_post_and_error_streak(self, db):
+        db.add_all([VkGroup(id=1, screen_name='ok', error_streak=2), VkGroup(id=2, screen_name='broken')])
+        db.commit()
+        channels_by_group = {'club1': [Mock(vk_group_ref=1)], 'club2': [Mock(vk_group_ref=2)]}
+        posts_by_group = {'club1': [{'id': 7}, {'id': 5}], 'club2': VkError(10, 'Internal server error', [])}
+
+        update_vk_groups_stats(posts_by_group, channels_by_group, db)
+
+        ok, broken = db.query(VkGroup).get(1), db.query(VkGroup).get(2)
+        assert_that(ok.last_vk_post_id, equal_to(7))
+        assert_that(ok.error_streak, equal_to(0))
+        assert_that(broken.error_streak, equal_to(1))
+        assert_that(broken.last_fetched_at is not None, is_(True))
+
+    def test_opens_breaker_after_repeated_failures_and_closes_it_on_success(self, db):
+        db.add_all([VkGroup(id=1, screen_name='recovered', error_streak=5, retry_at=datetime.datetime(2026, 1, 1)),
+                    VkGroup(id=2, screen_name='broken', error_streak=2)])
+        db.commit()
+        channels_by_group = {'club1': [Mock(vk_group_ref=1)], 'club2': [Mock(vk_group_ref=2)]}
+        posts_by_group = {'club1': [{'id': 7}], 'club2': VkError(10, 'Internal server error', [])}
+
+        update_vk_groups_stats(posts_by_group, channels_by_group, db)
+
+        recovered, broken = db.query(VkGroup).get(1), db.query(VkGroup).get(2)
+        assert_that(recovered.retry_at, equal_to(None))
+        assert_that(broken.retry_at > broken.last_fetched_at, is_(True))
+
+    def test_leaves_breaker_alone_on_token_errors(self, db):
+        db.add_all([VkGroup(id=1, screen_name='limited', error_streak=2),
+                    VkGroup(id=2, screen_name='probed', error_streak=5, retry_at=datetime.datetime(2026, 1, 1))])
+        db.commit()
+        channels_by_group = {'club1': [Mock(vk_group_ref=1)], 'club2': [Mock(vk_group_ref=2)]}
+        posts_by_group = {'club1': VkError(29, 'Rate limit reached', []), 'club2': VkError(6, 'Too many requests', [])}
+
+        update_vk_groups_stats(posts_by_group, channels_by_group, db)
+
+        limited, probed = db.query(VkGroup).get(1), db.query(VkGroup).get(2)
+        assert_that((limited.error_streak, limited.retry_at), equal_to((2, None)))
+        assert_that((probed.error_streak, probed.retry_at), equal_to((5, datetime.datetime(2026, 1, 1))))
+
+
+class TestSelectUnpushedGroups:
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_polls_pushing_groups_only_to_reconcile(self, mock_metrics, db):
+        now = datetime.datetime(2026, 10, 18, 12)
+        db.add_all([VkGroup(id=1, screen_name='pushing', callback_secret='s',
+                            last_fetched_at=now - datetime.timedelta(hours=1)),
+                    VkGroup(id=2, screen_name='unreconciled', callback_secret='s',
+                            last_fetched_at=now - datetime.timedelta(days=1)),
+                    VkGroup(id=3, screen_name='polled', last_fetched_at=now - datetime.timedelta(hours=1))])
+        db.commit()
+
+        groups = select_unpushed_groups(['club1', 'club2', 'club3', 'unresolved'], db, now)
+
+        assert_that(groups, equal_to(['club2', 'club3', 'unresolved']))
+        mock_metrics.pushed_groups_gauge.set.assert_called_once_with(1)
+
+
+class TestWaitDeliveringPushedPosts:
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_delivers_posts_pushed_while_waiting(self, mock_metrics, db):
+        add_channels(db, dict(channel_id='-1001', vk_group_id='club123', vk_group_ref=123, last_vk_post_id=10))
+        enqueue_deliveries([('-1001', {'id': 11, 'owner_id': -123, 'text': 'Pushed post'})], db)
+        bot = Mock()
+        pushed_posts.set()
+
+        wait_delivering_pushed_posts(0, lambda **kwargs: db, bot, SendScheduler())
+
+        bot.send_message.assert_called_once_with('-1001', 'https://vk.ru/wall-123_11\n\nPushed post')
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([]))
+        assert_that(pushed_posts.is_set(), is_(False))
+
+    def test_renews_leases_while_sleeping(self):
+        leases = Mock(renew_interval=0.01)
+        db_session_maker = Mock()
+
+        wait_delivering_pushed_posts(0.05, db_session_maker, Mock(), SendScheduler(), leases)
+
+        assert_that(leases.renew.call_count >= 3, is_(True))
+        leases.renew.assert_called_with(db_session_maker.return_value)
+
+
+class TestGroupChannelsByVkGroup:
+    def test_groups_channels_by_normalized_group(self):
+        first = Mock(vk_group_id='club123', vk_group_ref=None)
+        second = Mock(vk_group_id='public123', vk_group_ref=None)
+        third = Mock(vk_group_id='MyGroup', vk_group_ref=None)
+
+        channels_by_group = group_channels_by_vk_group([first, second, third])
+
+        assert_that(channels_by_group, equal_to({'club123': [first, second], 'mygroup': [third]}))
+
+
+class TestNormalizeGroup:
+    def test_public_is_normalized_to_club(self):
+        assert_that(normalize_group('public123'), equal_to('club123'))
+
+    def test_domain_is_lowercased(self):
+        assert_that(normalize_group('MyGroup'), equal_to('mygroup'))
+
+
+class TestIterateBatches:
+    def test_splits_into_batches_with_remainder(self):
+        assert_that(list(iterate_batches(range(5), 2)), equal_to([[0, 1], [2, 3], [4]]))
 
 
 class TestExtractGroupIdIfHas:
@@ -106,40 +763,41 @@ class TestExtractGroupIdIfHas:
         assert_that(extract_group_id_if_has('mygroup'), is_(none()))
 
 
-class TestIsPassingHashtagFilter:
-    def test_no_filter_always_passes(self):
-        assert_that(is_passing_hashtag_filter(None, {'text': 'Any text'}), is_(True))
-
-    def test_single_hashtag_match(self):
-        assert_that(is_passing_hashtag_filter('#news', {'text': 'Post with #news'}), is_(True))
+class TestUpdateChannelsGauges:
+    @patch('vk_channelify.repost_worker.metrics')
+    def test_sets_active_count_and_counts_disabled_channels(self, mock_metrics, db):
+        db.add(DisabledChannel(channel_id='-1003', vk_group_id='group', last_vk_post_id=0, owner_id='1'))
+        db.commit()
 
-    def test_single_hashtag_no_match(self):
-        assert_that(is_passing_hashtag_filter('#news', {'text': 'Post with #other'}), is_(False))
+        update_channels_gauges(2, db)
 
-    def test_multiple_hashtags_match(self):
-        assert_that(is_passing_hashtag_filter('#news, #update', {'text': 'Post with #update'}), is_(True))
+        mock_metrics.active_channels_gauge.set.assert_called_once_with(2)
+        mock_metrics.disabled_channels_gauge.set.assert_called_once_with(1)
 
 
 class TestDisableChannel:
     @patch('vk_channelify.repost_worker.metrics')
-    def test_disable_channel_success(self, mock_metrics):
-        mock_channel = Mock(channel_id='-100123456', vk_group_id='testgroup')
-        mock_db = Mock()
+    def test_disable_channel_success(self, mock_metrics, db):
+        channel, = add_channels(db, dict(channel_id='-100123456', vk_group_id='testgroup', last_vk_post_id=12))
+        enqueue_deliveries([('-100123456', {'id': 11, 'owner_id': -123, 'text': 'a'}),
+                            ('-100123456', {'id': 12, 'owner_id': -123, 'text': 'b'})], db)
         mock_bot = Mock()
 
-        disable_channel(mock_channel, mock_db, mock_bot)
+        disable_channel(channel, db, mock_bot)
 
-        mock_db.add.assert_called_once()
-        mock_db.delete.assert_called_once_with(mock_channel)
-        mock_db.commit.assert_called_once()
+        assert_that(db.query(Channel).count(), equal_to(0))
+        assert_that(db.query(Delivery).count(), equal_to(0))
+        disabled_channel = db.query(DisabledChannel).one()
+        assert_that(disabled_channel.channel_id, equal_to('-100123456'))
+        # Recovering the channel repeats the posts which weren't delivered
+        assert_that(disabled_channel.last_vk_post_id, equal_to(10))
 
     @patch('vk_channelify.repost_worker.metrics')
-    def test_disable_channel_rollback_on_error(self, mock_metrics):
-        mock_channel = Mock(channel_id='-100123456', vk_group_id='testgroup')
-        mock_db = Mock()
-        mock_db.commit.side_effect = Exception('DB Error')
+    def test_disable_channel_rollback_on_error(self, mock_metrics, db):
+        channel, = add_channels(db, dict(channel_id='-100123456', vk_group_id='testgroup'))
 
-        with pytest.raises(Exception):
-            disable_channel(mock_channel, mock_db, Mock())
+        with patch.object(db, 'commit', side_effect=Exception('DB Error')), patch.object(db, 'rollback') as mock_rollback:
+            with pytest.raises(Exception):
+                disable_channel(channel, db, Mock())
 
-        mock_db.rollback.assert_called_once()
+        mock_rollback.assert_called_once()
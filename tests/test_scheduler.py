@@ -0,0 +1,71 @@
+import datetime
+from unittest.mock import patch
+
+from hamcrest import assert_that, equal_to, contains_inanyorder
+
+from vk_channelify.scheduler import PollScheduler
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def post_at(minutes_ago, **kwargs):
+    date = NOW - datetime.timedelta(minutes=minutes_ago)
+    return dict(date=int(date.replace(tzinfo=datetime.timezone.utc).timestamp()), **kwargs)
+
+
+@patch('vk_channelify.scheduler.metrics')
+class TestPollScheduler:
+    def test_new_groups_are_due_at_once(self, mock_metrics, db):
+        scheduler = PollScheduler(60, 3600)
+
+        due_groups = scheduler.pop_due_groups(['club1', 'club2'], db, now=NOW)
+
+        assert_that(due_groups, contains_inanyorder('club1', 'club2'))
+
+    def test_rescheduled_group_is_due_after_its_interval(self, mock_metrics, db):
+        scheduler = PollScheduler(60, 3600)
+        scheduler.pop_due_groups(['club1'], db, now=NOW)
+        scheduler.reschedule('club1', [], now=NOW)
+
+        assert_that(scheduler.pop_due_groups(['club1'], db, now=NOW + datetime.timedelta(minutes=59)), equal_to([]))
+        assert_that(scheduler.pop_due_groups(['club1'], db, now=NOW + datetime.timedelta(minutes=60)), equal_to(['club1']))
+
+    def test_failed_poll_keeps_group_scheduled(self, mock_metrics, db):
+        scheduler = PollScheduler(60, 3600)
+        scheduler.pop_due_groups(['club1'], db, now=NOW)
+
+        assert_that(scheduler.pop_due_groups(['club1'], db, now=NOW + datetime.timedelta(seconds=60)), equal_to(['club1']))
+
+    def test_active_group_is_polled_often(self, mock_metrics):
+        scheduler = PollScheduler(60, 3600)
+        posts = [post_at(minutes) for minutes in (1, 11, 21, 31)]
+
+        scheduler.reschedule('club1', posts, now=NOW)
+
+        assert_that(scheduler.seconds_until_next_poll(now=NOW), equal_to(60))
+        assert_that(scheduler.estimate_poll_interval(sorted(p['date'] for p in posts), NOW), equal_to(300))
+
+    def test_silent_group_is_polled_rarely(self, mock_metrics):
+        scheduler = PollScheduler(60, 3600)
+        posts = [post_at(60 * 24 * 30 + minutes) for minutes in (1, 11, 21)]
+
+        assert_that(scheduler.estimate_poll_interval(sorted(p['date'] for p in posts), NOW), equal_to(3600))
+
+    def test_pinned_post_is_ignored(self, mock_metrics, db):
+        scheduler = PollScheduler(60, 3600)
+        posts = [post_at(60 * 24 * 365, is_pinned=1), post_at(1), post_at(11)]
+
+        scheduler.reschedule('club1', posts, now=NOW)
+
+        assert_that(scheduler.pop_due_groups(['club1'], db, now=NOW + datetime.timedelta(seconds=300)), equal_to(['club1']))
+
+    def test_schedule_survives_restart(self, mock_metrics, db):
+        scheduler = PollScheduler(60, 3600)
+        scheduler.pop_due_groups(['club1'], db, now=NOW)
+        scheduler.reschedule('club1', [], now=NOW)
+        scheduler.save(db)
+
+        restarted_scheduler = PollScheduler(60, 3600)
+
+        assert_that(restarted_scheduler.pop_due_groups(['club1'], db, now=NOW + datetime.timedelta(minutes=30)), equal_to([]))
+        assert_that(restarted_scheduler.pop_due_groups(['club1'], db, now=NOW + datetime.timedelta(minutes=60)), equal_to(['club1']))
@@ -0,0 +1,76 @@
+import pytest
+from unittest.mock import Mock, patch
+import telegram
+from hamcrest import assert_that, equal_to, close_to
+
+from vk_channelify.send_scheduler import SendScheduler
+
+
+@patch('vk_channelify.send_scheduler.metrics')
+@patch('vk_channelify.send_scheduler.time.sleep')
+class TestSendSchedulerCall:
+    def test_call_retries_after_retry_after(self, mock_sleep, mock_metrics):
+        send = Mock(side_effect=[telegram.error.RetryAfter(7), 'sent'])
+
+        result = SendScheduler().call('-1001', send, 'text')
+
+        assert_that(result, equal_to('sent'))
+        assert_that(send.call_count, equal_to(2))
+        mock_sleep.assert_any_call(7)
+        mock_metrics.telegram_retry_after_total.inc.assert_called_once_with()
+
+    def test_call_gives_up_after_max_retries(self, mock_sleep, mock_metrics):
+        send = Mock(side_effect=telegram.error.RetryAfter(1))
+
+        with pytest.raises(telegram.error.RetryAfter):
+            SendScheduler(max_retries=2).call('-1001', send)
+
+        assert_that(send.call_count, equal_to(3))
+
+    def test_call_waits_when_chat_is_over_limit(self, mock_sleep, mock_metrics):
+        scheduler = SendScheduler(chat_rate_per_minute=1)
+        scheduler.call('-1001', Mock())
+        mock_sleep.assert_not_called()
+
+        scheduler.call('-1001', Mock())
+
+        assert_that(mock_sleep.call_args[0][0], close_to(60, 0.1))
+
+
+    def test_call_skips_reserving_first_attempt_reserved_by_caller(self, mock_sleep, mock_metrics):
+        scheduler = SendScheduler()
+        scheduler.reserve = Mock(return_value=0)
+        send = Mock(side_effect=[telegram.error.RetryAfter(1), 'sent'])
+
+        scheduler.call('-1001', send, 'text', is_reserved=True)
+
+        scheduler.reserve.assert_called_once_with('-1001')
+        send.assert_called_with('text')
+
+@patch('vk_channelify.send_scheduler.metrics')
+class TestSendSchedulerRunFairly:
+    def test_chats_are_interleaved(self, mock_metrics):
+        sent = []
+
+        def steps(chat_id, count):
+            for i in range(count):
+                sent.append((chat_id, i))
+                yield
+
+        SendScheduler().run_fairly([('-1001', steps('-1001', 3)), ('-1002', steps('-1002', 2))])
+
+        assert_that(sent, equal_to([('-1001', 0), ('-1002', 0), ('-1001', 1), ('-1002', 1), ('-1001', 2)]))
+
+    def test_chat_over_its_limit_does_not_hold_back_others(self, mock_metrics):
+        scheduler = SendScheduler()
+        busy_limiter = scheduler.chat_limiter('-1001')
+        busy_limiter.delay = Mock(return_value=30)
+        sent = []
+
+        def steps(chat_id):
+            sent.append(chat_id)
+            yield
+
+        scheduler.run_fairly([('-1001', steps('-1001')), ('-1002', steps('-1002'))])
+
+        assert_that(sent, equal_to(['-1002', '-1001']))
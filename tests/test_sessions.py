@@ -0,0 +1,59 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+from hamcrest import assert_that, equal_to
+
+from vk_channelify.sessions import make_vk_session, make_counting_connection_cls, make_telegram_bot
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMakeVkSession:
+    @patch('vk_channelify.sessions.metrics')
+    def test_session_reuses_keep_alive_connection(self, mock_metrics):
+        server = HTTPServer(('127.0.0.1', 0), OkHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        session = make_vk_session(pool_size=2)
+        # The local server is plain http, the production pools are mounted for https only
+        session.mount('http://', session.get_adapter('https://'))
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+        try:
+            for _ in range(3):
+                session.get(url)
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+
+        counted_types = [c[1]['type'] for c in mock_metrics.http_connections_total.labels.call_args_list]
+        assert_that(counted_types, equal_to(['new', 'reused', 'reused']))
+
+
+class TestMakeCountingConnectionCls:
+    def test_keeps_base_class(self):
+        class Base:
+            pass
+
+        assert_that(issubclass(make_counting_connection_cls(Base, 'vk'), Base), equal_to(True))
+
+
+class TestMakeTelegramBot:
+    def test_bot_pool_uses_counting_connections(self):
+        bot = make_telegram_bot('123:abc', pool_size=3)
+
+        pool_cls = bot.request._con_pool.pool_classes_by_scheme['https']
+        assert_that(pool_cls.ConnectionCls.__name__.startswith('Counting'), equal_to(True))
+        assert_that(bot.request.con_pool_size, equal_to(3))
@@ -0,0 +1,99 @@
+import pytest
+from unittest.mock import patch
+from hamcrest import assert_that, equal_to, is_
+
+from vk_channelify import repost_worker
+from vk_channelify.models import Channel, VkGroup
+from vk_channelify.vk_callback import handle_callback_event, set_group_callback
+from tests.helpers import get_last_vk_post_id, get_pending_post_ids
+
+
+@pytest.fixture
+def db_session_maker(db_session_maker):
+    db = db_session_maker()
+    db.add_all([
+        VkGroup(id=123, screen_name='pushing', callback_secret='s3cret', callback_confirmation_code='abc123'),
+        VkGroup(id=456, screen_name='polled'),
+        Channel(channel_id='-1001', vk_group_id='pushing', vk_group_ref=123, last_vk_post_id=10, owner_id='1'),
+        Channel(channel_id='-1002', vk_group_id='pushing', vk_group_ref=123, last_vk_post_id=10, owner_id='1',
+                hashtag_filter='#cats'),
+    ])
+    db.commit()
+    db.close()
+    return db_session_maker
+
+
+def make_post_event(post_id, text='Пост', secret='s3cret', post_type='post'):
+    return {'type': 'wall_post_new', 'group_id': 123, 'secret': secret, 'event_id': 'e{}'.format(post_id),
+            'object': {'id': post_id, 'owner_id': -123, 'date': 1700000000, 'text': text, 'post_type': post_type}}
+
+
+@patch('vk_channelify.vk_callback.metrics')
+class TestHandleCallbackEvent:
+    def setup_method(self):
+        repost_worker.pushed_posts.clear()
+
+    def test_answers_confirmation_with_group_code(self, mock_metrics, db_session_maker):
+        result = handle_callback_event({'type': 'confirmation', 'group_id': 123, 'secret': 's3cret'}, db_session_maker)
+
+        assert_that(result, equal_to((200, 'abc123')))
+
+    def test_rejects_wrong_secret_and_groups_not_set_up(self, mock_metrics, db_session_maker, db):
+        assert_that(handle_callback_event(make_post_event(11, secret='guess'), db_session_maker)[0], equal_to(403))
+        assert_that(handle_callback_event(dict(make_post_event(11), group_id=456), db_session_maker)[0],
+                    equal_to(403))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([]))
+
+    def test_enqueues_new_post_for_channels_and_wakes_repost_worker(self, mock_metrics, db_session_maker, db):
+        result = handle_callback_event(make_post_event(11, 'Пост #cats'), db_session_maker)
+
+        assert_that(result, equal_to((200, 'ok')))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([11]))
+        assert_that(get_pending_post_ids(db, '-1002'), equal_to([11]))
+        assert_that(repost_worker.pushed_posts.is_set(), is_(True))
+
+    def test_applies_hashtag_filters_and_leaves_cursors(self, mock_metrics, db_session_maker, db):
+        handle_callback_event(make_post_event(11, 'Пост #dogs'), db_session_maker)
+
+        assert_that(get_pending_post_ids(db, '-1002'), equal_to([]))
+        assert_that(get_last_vk_post_id(db, '-1001'), equal_to(10))
+
+    def test_enqueues_resent_event_once(self, mock_metrics, db_session_maker, db):
+        handle_callback_event(make_post_event(11), db_session_maker)
+        handle_callback_event(make_post_event(11), db_session_maker)
+
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([11]))
+
+    def test_ignores_suggested_posts(self, mock_metrics, db_session_maker, db):
+        result = handle_callback_event(make_post_event(11, post_type='suggest'), db_session_maker)
+
+        assert_that(result, equal_to((200, 'ok')))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([]))
+        assert_that(repost_worker.pushed_posts.is_set(), is_(False))
+
+
+    @pytest.mark.parametrize('post', [None, 'Пост', {'id': '11', 'owner_id': -123, 'text': 'Пост'}, {'id': 11}])
+    def test_answers_ok_to_invalid_posts_without_enqueuing(self, mock_metrics, db_session_maker, db, post):
+        event = make_post_event(11)
+        if post is None:
+            del event['object']
+        else:
+            event['object'] = post
+
+        result = handle_callback_event(event, db_session_maker)
+
+        assert_that(result, equal_to((200, 'ok')))
+        assert_that(get_pending_post_ids(db, '-1001'), equal_to([]))
+        mock_metrics.vk_callback_events_total.labels.assert_called_with(type='wall_post_new', result='invalid')
+
+class TestSetGroupCallback:
+    def test_sets_up_group_by_screen_name_or_id(self, db):
+        set_group_callback('Polled', 'n3w', 'def456', db)
+        set_group_callback('club123', '', None, db)
+
+        polled, pushing = db.query(VkGroup).get(456), db.query(VkGroup).get(123)
+        assert_that((polled.callback_secret, polled.callback_confirmation_code), equal_to(('n3w', 'def456')))
+        assert_that((pushing.callback_secret, pushing.callback_confirmation_code), equal_to((None, None)))
+
+    def test_returns_none_for_unresolved_group(self, db):
+        assert_that(set_group_callback('unknown', 's3cret', 'abc', db), equal_to(None))
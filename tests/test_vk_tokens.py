@@ -0,0 +1,48 @@
+import pytest
+from unittest.mock import patch
+from hamcrest import assert_that, equal_to, is_
+
+from vk_channelify.vk_errors import VkError
+from vk_channelify.vk_tokens import VkTokenPool
+
+
+@patch('vk_channelify.vk_tokens.time.sleep')
+@patch('vk_channelify.rate_limit.time.monotonic')
+@patch('vk_channelify.vk_tokens.time.monotonic')
+class TestVkTokenPool:
+    def test_spreads_requests_over_tokens(self, mock_monotonic, mock_bucket_monotonic, mock_sleep):
+        mock_monotonic.return_value = mock_bucket_monotonic.return_value = 100.0
+        pool = VkTokenPool(['a', 'b', 'c'], requests_per_second=1)
+
+        tokens = [pool.acquire() for _ in range(3)]
+
+        assert_that(sorted(tokens), equal_to(['a', 'b', 'c']))
+        mock_sleep.assert_not_called()
+
+    def test_takes_rate_limited_token_out_of_rotation_for_cooldown(self, mock_monotonic, mock_bucket_monotonic,
+                                                                   mock_sleep):
+        mock_monotonic.return_value = mock_bucket_monotonic.return_value = 100.0
+        pool = VkTokenPool(['a', 'b'], requests_per_second=100)
+
+        is_reported = pool.report_error('a', {'error_code': 29, 'error_msg': 'Rate limit reached'})
+
+        assert_that(is_reported, is_(True))
+        assert_that({pool.acquire() for _ in range(5)}, equal_to({'b'}))
+        mock_monotonic.return_value = mock_bucket_monotonic.return_value = 100.0 + 60 * 60
+        assert_that({pool.acquire() for _ in range(5)}, equal_to({'a', 'b'}))
+
+    def test_raises_when_all_tokens_are_revoked(self, mock_monotonic, mock_bucket_monotonic, mock_sleep):
+        mock_monotonic.return_value = mock_bucket_monotonic.return_value = 100.0
+        pool = VkTokenPool(['a'])
+
+        pool.report_error('a', {'error_code': 5, 'error_msg': 'User authorization failed'})
+
+        with pytest.raises(VkError):
+            pool.acquire()
+
+    def test_keeps_token_after_other_errors(self, mock_monotonic, mock_bucket_monotonic, mock_sleep):
+        mock_monotonic.return_value = mock_bucket_monotonic.return_value = 100.0
+        pool = VkTokenPool(['a'])
+
+        assert_that(pool.report_error('a', {'error_code': 15, 'error_msg': 'Access denied'}), is_(False))
+        assert_that(pool.acquire(), equal_to('a'))
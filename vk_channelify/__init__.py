@@ -1,3 +1,8 @@
 from . import models, metrics
 from .manage_worker import run_worker as run_manage_worker
 from .repost_worker import run_worker as run_repost_worker
+from .async_repost_worker import run_worker as run_async_repost_worker
+from .scheduler import PollScheduler
+from .leases import GroupLeases
+from .vk_tokens import VkTokenPool
+from .conversation_state import MemoryStateStore, DbStateStore
@@ -0,0 +1,172 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import logging
+import requests
+import telegram
+from telegram.utils.request import Request
+
+from . import metrics, repost_worker
+from .media import TelegramFileCache
+from .outbox import DeliveredBatch, fetch_pending_deliveries, prune_deliveries
+from .repost_worker import VK_EXECUTE_MAX_CALLS, enqueue_new_posts, expunge_channels, fetch_groups_new_posts, \
+    get_group_cursor, handle_channel_error, iterate_batches, load_channels_with_pending_posts, load_groups_channels, \
+    notify_channel_disabled, select_iteration_groups, send_post, update_vk_groups_stats
+from .send_scheduler import SendScheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+
+
+def run_worker(iteration_delay, vk_service_code, telegram_token, db_session_maker, concurrency=DEFAULT_CONCURRENCY,
+               pool_size=None, scheduler=None, leases=None):
+    # Every concurrent request needs its own connection, otherwise the pools would discard them after use
+    pool_size = max(pool_size or 0, concurrency)
+    return repost_worker.run_worker(iteration_delay, vk_service_code, telegram_token, db_session_maker,
+                                    run_iteration=partial(run_worker_iteration, concurrency=concurrency),
+                                    pool_size=pool_size, scheduler=scheduler, leases=leases)
+
+
+def run_worker_iteration(vk_service_code, telegram_token, db, concurrency=DEFAULT_CONCURRENCY, bot=None,
+                         vk_session=requests, scheduler=None, send_scheduler=None, leases=None, file_cache=None):
+    asyncio.run(run_worker_iteration_async(vk_service_code, telegram_token, db, concurrency, bot, vk_session,
+                                           scheduler, send_scheduler, leases, file_cache))
+
+
+async def run_worker_iteration_async(vk_service_code, telegram_token, db, concurrency, bot=None, vk_session=requests,
+                                     scheduler=None, send_scheduler=None, leases=None, file_cache=None):
+    # VK fetches and Telegram sends are blocking, so they run on a bounded thread pool. The db session is
+    # only touched from the event loop thread, which keeps it single-threaded
+    if bot is None:
+        bot = telegram.Bot(telegram_token, request=Request(con_pool_size=concurrency))
+    if send_scheduler is None:
+        send_scheduler = SendScheduler()
+    if file_cache is None:
+        file_cache = TelegramFileCache()
+
+    prune_deliveries(db)
+
+    leased_groups, groups_to_poll, unresolved_channel_ids_by_group = select_iteration_groups(
+        vk_service_code, vk_session, db, scheduler, leases)
+
+    loop = asyncio.get_running_loop()
+    # Channels of a batch stay loaded until it is done, so the number of batches in flight bounds the memory
+    batches_semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        run_blocking = partial(loop.run_in_executor, executor)
+        try:
+            # Posts left pending by an interrupted iteration go first
+            channels = load_channels_with_pending_posts(leased_groups, db)
+            await deliver_pending_posts(channels, db, bot, run_blocking, send_scheduler, file_cache)
+            expunge_channels(channels, db)
+            file_cache.save(db)
+
+            await gather_raising_first(*(repost_groups(groups, unresolved_channel_ids_by_group, vk_service_code,
+                                                       vk_session, db, bot, run_blocking, scheduler, send_scheduler,
+                                                       file_cache, leases, batches_semaphore)
+                                         for groups in iterate_batches(groups_to_poll, VK_EXECUTE_MAX_CALLS)))
+        finally:
+            if scheduler is not None:
+                scheduler.save(db)
+
+
+async def repost_groups(groups, unresolved_channel_ids_by_group, vk_service_code, vk_session, db, bot, run_blocking,
+                        scheduler, send_scheduler, file_cache, leases, batches_semaphore):
+    async with batches_semaphore:
+        if leases is not None:
+            leases.renew(db)
+
+        channels_by_group = load_groups_channels(groups, unresolved_channel_ids_by_group, db)
+        groups = [group for group in groups if group in channels_by_group]
+        db.commit()
+
+        cursors = {group: get_group_cursor(channels_by_group[group]) for group in groups}
+        posts_by_group = await run_blocking(fetch_groups_new_posts, groups, cursors, vk_service_code, vk_session)
+        update_vk_groups_stats(posts_by_group, channels_by_group, db)
+
+        if scheduler is not None:
+            for group in groups:
+                scheduler.reschedule(group, posts_by_group[group])
+
+        for channel, error in enqueue_new_posts(groups, channels_by_group, posts_by_group, db):
+            await handle_channel_error_off_loop(channel, error, db, bot, run_blocking)
+        channels = [channel for group in groups for channel in channels_by_group[group]]
+        await deliver_pending_posts(channels, db, bot, run_blocking, send_scheduler, file_cache)
+        expunge_channels(channels, db)
+        file_cache.save(db)
+
+
+async def deliver_pending_posts(channels, db, bot, run_blocking, send_scheduler, file_cache=None):
+    deliveries_by_channel = fetch_pending_deliveries([channel.channel_id for channel in channels], db)
+    if not deliveries_by_channel:
+        return
+
+    delivered = DeliveredBatch(db)
+    try:
+        await gather_raising_first(*(deliver_channel_posts(channel, deliveries_by_channel[channel.channel_id], db, bot,
+                                                           run_blocking, send_scheduler, delivered, file_cache)
+                                     for channel in channels
+                                     if channel.channel_id in deliveries_by_channel))
+    finally:
+        delivered.flush()
+
+
+async def deliver_channel_posts(channel, deliveries, db, bot, run_blocking, send_scheduler, delivered,
+                                file_cache=None):
+    posts_sent = 0
+    metrics.telegram_send_queue_depth.inc(len(deliveries))
+    try:
+        for delivery_id, post in deliveries:
+            sent_methods = []
+            try:
+                await send_post_when_allowed(channel, post, bot, run_blocking, send_scheduler, file_cache,
+                                             sent_methods)
+            except telegram.error.TelegramError:
+                # A part of the post is out, the next iteration would send it again
+                if sent_methods:
+                    delivered.add(delivery_id)
+                raise
+            posts_sent += 1
+            metrics.telegram_send_queue_depth.dec()
+            delivered.add(delivery_id)
+
+        if posts_sent:
+            logger.info('Success sent {} posts on channel {} (id: {})'.format(posts_sent, channel.vk_group_id, channel.channel_id))
+
+    except telegram.error.TelegramError as e:
+        delivered.flush()
+        await handle_channel_error_off_loop(channel, e, db, bot, run_blocking)
+
+    finally:
+        metrics.telegram_send_queue_depth.dec(len(deliveries) - posts_sent)
+
+
+async def handle_channel_error_off_loop(channel, error, db, bot, run_blocking):
+    """Handles the error like handle_channel_error, but the owner of a channel it disables is notified from the
+    pool, so the Telegram calls don't block the loop. The db session is still only touched from the loop."""
+    handle_channel_error(channel, error, db, None)
+    # A disabled channel has left the session
+    if channel not in db:
+        await run_blocking(notify_channel_disabled, channel, bot)
+
+
+async def send_post_when_allowed(channel, post, bot, run_blocking, send_scheduler, file_cache=None,
+                                 sent_methods=None):
+    """Waits for the post's first send on the event loop instead of holding a pool thread, a post is a single
+    message mostly. The rest of its sends go through the scheduler from the pool thread."""
+    await asyncio.sleep(send_scheduler.reserve(channel.channel_id))
+    return await run_blocking(partial(send_post, channel, post, bot, send_scheduler, file_cache,
+                                      is_first_send_reserved=True, sent_methods=sent_methods))
+
+
+async def gather_raising_first(*aws):
+    """Waits for all awaitables, unlike asyncio.gather which leaves the rest running after the first error."""
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    for error in errors[1:]:
+        logger.error('Concurrent repost task was failed because of {}'.format(error))
+    if errors:
+        raise errors[0]
+    return results
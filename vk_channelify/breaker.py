@@ -0,0 +1,56 @@
+import datetime
+import random
+
+import logging
+
+from . import metrics
+from .models import VkGroup
+from .vk_tokens import TOKEN_ERROR_CODES
+
+logger = logging.getLogger(__name__)
+
+# Consecutive failed fetches after which a group's breaker opens
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_BASE_RETRY_DELAY = 5 * 60  # 5 minutes
+DEFAULT_MAX_RETRY_DELAY = 24 * 60 * 60  # 1 day
+
+
+def get_retry_at(error_streak, now, threshold=DEFAULT_FAILURE_THRESHOLD, base_delay=DEFAULT_BASE_RETRY_DELAY,
+                 max_delay=DEFAULT_MAX_RETRY_DELAY, jitter=random.random):
+    """Returns when a group with `error_streak` consecutive failures is probed again, None while its breaker is closed.
+
+    The delay doubles with every failure after the threshold up to max_delay. It is jittered down to a half of it,
+    so groups which broke at the same time aren't probed together.
+    """
+    if error_streak < threshold:
+        return None
+
+    delay = min(max_delay, base_delay * 2 ** (error_streak - threshold))
+    return now + datetime.timedelta(seconds=delay * (0.5 + jitter() / 2))
+
+
+def is_group_error(error):
+    """Whether a fetch error counts against the group's breaker. Errors of the token, like rate limits, say nothing
+    about the group, so they neither open nor close it."""
+    return error.code not in TOKEN_ERROR_CODES
+
+
+def select_closed_groups(groups, db, now=None):
+    """Returns the groups out of `groups` which may be polled, skipping ones with open breakers.
+
+    A breaker is open until its vk_groups.retry_at. After that the group is half-open: it's polled once more and
+    update_vk_groups_stats either closes the breaker or opens it for longer.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    open_groups = {'club{}'.format(vk_group_id)
+                   for vk_group_id, in db.query(VkGroup.id).filter(VkGroup.retry_at > now)}
+    closed_groups = [group for group in groups if group not in open_groups]
+
+    metrics.open_breakers_gauge.set(len(open_groups))
+    skipped_count = len(groups) - len(closed_groups)
+    if skipped_count:
+        logger.info('Skipped {} groups with open breakers'.format(skipped_count))
+
+    return closed_groups
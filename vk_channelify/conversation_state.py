@@ -0,0 +1,221 @@
+import datetime
+import json
+import time
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+import logging
+from telegram.ext import BasePersistence
+
+from . import metrics
+from .models import ConversationState
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_TTL = 60 * 60  # 1 hour
+DEFAULT_MAX_STATES = 10000
+# How often DbStateStore counts its rows for conversation_states_gauge
+DEFAULT_GAUGE_INTERVAL = 60
+
+
+class MemoryStateStore:
+    """Conversation states of the manage worker's users kept in memory, by user id.
+
+    A state expires `ttl` seconds after it was last used, and the least recently used states are dropped once
+    there are `max_size` of them, so conversations users abandon don't pile up. Supports the dict operations the
+    handlers use: `in`, get, set and del.
+    """
+
+    # Which step a conversation is at stays in the ConversationHandlers
+    persistence = None
+
+    def __init__(self, ttl=DEFAULT_STATE_TTL, max_size=DEFAULT_MAX_STATES):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._states = OrderedDict()  # user_id -> (state, expires_at)
+        self._lock = Lock()
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return self._get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        with self._lock:
+            state = self._get(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id, state):
+        with self._lock:
+            self._states.pop(user_id, None)
+            self._states[user_id] = (state, datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl))
+            self._evict_expired()
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+                metrics.conversation_states_evicted_total.labels(reason='lru').inc()
+            metrics.conversation_states_gauge.set(len(self._states))
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            del self._states[user_id]
+            metrics.conversation_states_gauge.set(len(self._states))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._states)
+
+    def _get(self, user_id):
+        if user_id not in self._states:
+            return None
+
+        state, expires_at = self._states[user_id]
+        if expires_at <= datetime.datetime.utcnow():
+            del self._states[user_id]
+            metrics.conversation_states_evicted_total.labels(reason='ttl').inc()
+            metrics.conversation_states_gauge.set(len(self._states))
+            return None
+
+        self._states[user_id] = (state, datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl))
+        self._states.move_to_end(user_id)
+        return state
+
+    def _evict_expired(self):
+        # Every use extends the ttl and moves the state to the end, so expired states are all at the beginning
+        now = datetime.datetime.utcnow()
+        while self._states:
+            user_id, (_, expires_at) = next(iter(self._states.items()))
+            if expires_at > now:
+                break
+            del self._states[user_id]
+            metrics.conversation_states_evicted_total.labels(reason='ttl').inc()
+
+
+class DbStateStore:
+    """Conversation states kept in conversation_states, so webhook replicas behind a load balancer share them.
+
+    The dispatcher has to be created with `persistence`, which keeps which step each conversation is at in the same
+    table, otherwise a replica would ignore the messages of conversations started on another one. States have to
+    be JSON-serializable. Expired rows are deleted whenever a state is written, the rows are counted for the gauge
+    once per `gauge_interval` seconds.
+    """
+
+    def __init__(self, db_session_maker, ttl=DEFAULT_STATE_TTL, gauge_interval=DEFAULT_GAUGE_INTERVAL):
+        self.db_session_maker = db_session_maker
+        self.ttl = ttl
+        self.gauge_interval = gauge_interval
+        self.persistence = DbConversationPersistence(self)
+        self._gauge_updated_at = None
+
+    def __contains__(self, user_id):
+        return self._get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        state = self._get(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id, state):
+        now = datetime.datetime.utcnow()
+        db = self.db_session_maker()
+        try:
+            db.merge(ConversationState(user_id=str(user_id), state=json.dumps(state),
+                                       expires_at=now + datetime.timedelta(seconds=self.ttl)))
+            evicted_count = db.query(ConversationState).filter(ConversationState.expires_at <= now) \
+                .delete(synchronize_session=False)
+            db.commit()
+            metrics.conversation_states_evicted_total.labels(reason='ttl').inc(evicted_count)
+            if self._gauge_updated_at is None or time.monotonic() - self._gauge_updated_at >= self.gauge_interval:
+                self._gauge_updated_at = time.monotonic()
+                metrics.conversation_states_gauge.set(db.query(ConversationState).count())
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def __delitem__(self, user_id):
+        db = self.db_session_maker()
+        try:
+            db.query(ConversationState).filter(ConversationState.user_id == str(user_id)) \
+                .delete(synchronize_session=False)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _get(self, user_id):
+        db = self.db_session_maker()
+        try:
+            state = db.query(ConversationState.state) \
+                .filter(ConversationState.user_id == str(user_id),
+                        ConversationState.expires_at > datetime.datetime.utcnow()) \
+                .scalar()
+        finally:
+            db.close()
+        return None if state is None else json.loads(state)
+
+
+class DbConversationPersistence(BasePersistence):
+    """Gives persistent ConversationHandlers a DbConversations of a DbStateStore instead of a dict loaded once, so
+    every replica reads the conversation's current step from the database. Nothing else is persisted."""
+
+    def __init__(self, users_state):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+        self.users_state = users_state
+
+    def get_conversations(self, name):
+        return DbConversations(self.users_state, name)
+
+    def update_conversation(self, name, key, new_state):
+        # DbConversations has written it already
+        pass
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return dict()
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+
+class DbConversations:
+    """Steps of the conversations of the ConversationHandler `name` by conversation key, kept in a DbStateStore.
+    They expire with the store's ttl, like the handlers' conversation_timeout would end them."""
+
+    def __init__(self, users_state, name):
+        self.users_state = users_state
+        self.name = name
+
+    def get(self, key, default=None):
+        state = self.users_state._get(self._get_state_key(key))
+        return default if state is None else state
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        return self.users_state[self._get_state_key(key)]
+
+    def __setitem__(self, key, state):
+        self.users_state[self._get_state_key(key)] = state
+
+    def __delitem__(self, key):
+        del self.users_state[self._get_state_key(key)]
+
+    def _get_state_key(self, key):
+        return 'conversation:{}:{}'.format(self.name, ':'.join(str(part) for part in key))
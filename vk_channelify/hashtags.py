@@ -0,0 +1,76 @@
+import re
+from functools import lru_cache
+
+# VK hashtags may be bound to a community like #news@durov, such a post is also found by #news
+HASHTAG_RE = re.compile(r'#(\w+)(@[\w.]+)?')
+
+# Hashtags of a filter are separated by commas, spaces are accepted too
+HASHTAG_FILTER_SEPARATOR_RE = re.compile(r'[,\s]+')
+
+HASHTAG_FILTERS_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=HASHTAG_FILTERS_CACHE_SIZE)
+def parse_hashtag_filter(hashtag_filter):
+    """Parses Channel.hashtag_filter into a frozenset of normalised hashtags, None means the channel has no filter.
+
+    Parsed filters are cached by their string, so channels reloaded every batch are parsed once.
+    """
+    if hashtag_filter is None:
+        return None
+
+    hashtags = frozenset(normalize_hashtag(hashtag) for hashtag in HASHTAG_FILTER_SEPARATOR_RE.split(hashtag_filter)
+                         if hashtag.strip('#'))
+    return hashtags or None
+
+
+def format_hashtag_filter(hashtags):
+    if hashtags is None:
+        return None
+
+    return ','.join(sorted(hashtags))
+
+
+def normalize_hashtag(hashtag):
+    return '#' + hashtag.lstrip('#').lower()
+
+
+def extract_hashtags(text):
+    """Returns the set of normalised hashtags of a post's text. A whole hashtag is matched, #cat isn't in #category."""
+    hashtags = set()
+    for match in HASHTAG_RE.finditer(text):
+        hashtag = '#' + match.group(1).lower()
+        hashtags.add(hashtag)
+        if match.group(2):
+            hashtags.add(hashtag + match.group(2).lower())
+    return hashtags
+
+
+class HashtagIndex:
+    """Inverted index from hashtags to the channels filtering by them.
+
+    Built once for the channels of a VK group, so a post's recipients are found with a lookup per hashtag of the
+    post instead of checking the post against every channel's filter.
+    """
+
+    def __init__(self, channels):
+        self.unfiltered_channels = []
+        self.channels_by_hashtag = dict()
+        for channel in channels:
+            hashtags = parse_hashtag_filter(channel.hashtag_filter)
+            if hashtags is None:
+                self.unfiltered_channels.append(channel)
+                continue
+            for hashtag in hashtags:
+                self.channels_by_hashtag.setdefault(hashtag, []).append(channel)
+
+    def find_channels(self, hashtags):
+        """Returns the channels which receive a post with the hashtags, each of them once."""
+        channels = list(self.unfiltered_channels)
+        matched_channel_ids = set()
+        for hashtag in hashtags:
+            for channel in self.channels_by_hashtag.get(hashtag, []):
+                if id(channel) not in matched_channel_ids:
+                    matched_channel_ids.add(id(channel))
+                    channels.append(channel)
+        return channels
@@ -0,0 +1,129 @@
+import datetime
+import math
+import os
+import socket
+
+import logging
+from sqlalchemy import case, or_
+from sqlalchemy.exc import IntegrityError
+
+from . import metrics
+from .models import GroupLease, RepostWorkerHeartbeat
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_DURATION = 10 * 60  # 10 minutes
+# A sleeping worker renews its leases this many times per lease duration, so one missed renewal doesn't lose them
+RENEWALS_PER_DURATION = 3
+
+
+def make_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class GroupLeases:
+    """Time-boxed leases on VK groups, so several repost workers share the groups without polling any of them twice.
+
+    Every live worker (one with a fresh heartbeat) claims an equal share of the groups out of the ones which are
+    free, expired or already its own, and gives up what is over its share so workers joining later get theirs.
+    Lease rows are locked with FOR UPDATE SKIP LOCKED, so workers claiming at the same time don't wait for each
+    other. Leases are renewed while the worker is busy with them and while it sleeps between iterations, the ones
+    of a dead worker are taken over once they expire.
+    """
+
+    def __init__(self, worker_id=None, duration=DEFAULT_LEASE_DURATION):
+        self.worker_id = worker_id or make_worker_id()
+        self.duration = datetime.timedelta(seconds=duration)
+
+    def claim(self, groups, db, now=None):
+        """Returns the groups out of `groups` leased to this worker until the next claim or renewal."""
+        if now is None:
+            now = datetime.datetime.utcnow()
+        groups = list(groups)
+        expires_at = now + self.duration
+
+        self._add_missing_leases(groups, db)
+
+        try:
+            db.merge(RepostWorkerHeartbeat(worker_id=self.worker_id, expires_at=expires_at))
+            db.query(RepostWorkerHeartbeat).filter(RepostWorkerHeartbeat.expires_at < now) \
+                .delete(synchronize_session=False)
+            workers_count = db.query(RepostWorkerHeartbeat).filter(RepostWorkerHeartbeat.expires_at >= now).count()
+            share = math.ceil(len(groups) / max(1, workers_count))
+
+            # Own leases go first, so groups stay with their worker while the number of workers doesn't change
+            claimable_leases = db.query(GroupLease) \
+                .filter(GroupLease.vk_group_id.in_(groups),
+                        or_(GroupLease.worker_id == self.worker_id,
+                            GroupLease.worker_id.is_(None),
+                            GroupLease.expires_at <= now)) \
+                .order_by(case((GroupLease.worker_id == self.worker_id, 0), else_=1), GroupLease.vk_group_id) \
+                .with_for_update(skip_locked=True)
+
+            leased_groups = []
+            released_count = 0
+            for lease in claimable_leases:
+                if len(leased_groups) < share:
+                    lease.worker_id = self.worker_id
+                    lease.expires_at = expires_at
+                    leased_groups.append(lease.vk_group_id)
+                elif lease.worker_id == self.worker_id:
+                    lease.worker_id = None
+                    lease.expires_at = None
+                    released_count += 1
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+        if released_count:
+            logger.info('Released {} groups for other {} workers'.format(released_count, workers_count - 1))
+        metrics.leased_groups_gauge.set(len(leased_groups))
+        metrics.repost_workers_gauge.set(workers_count)
+
+        return leased_groups
+
+    def renew(self, db, now=None):
+        """Extends the leases of this worker, call it more often than once per lease duration while working."""
+        if now is None:
+            now = datetime.datetime.utcnow()
+        expires_at = now + self.duration
+
+        try:
+            db.query(GroupLease).filter(GroupLease.worker_id == self.worker_id) \
+                .update({GroupLease.expires_at: expires_at, GroupLease.updated_at: now}, synchronize_session=False)
+            db.merge(RepostWorkerHeartbeat(worker_id=self.worker_id, expires_at=expires_at))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+    @property
+    def renew_interval(self):
+        """Seconds between renewals of a worker which keeps its leases while sleeping."""
+        return self.duration.total_seconds() / RENEWALS_PER_DURATION
+
+    def get_own_groups(self, db, now=None):
+        """Returns the groups leased to this worker, without claiming or renewing anything."""
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        return [group for group, in db.query(GroupLease.vk_group_id)
+                .filter(GroupLease.worker_id == self.worker_id, GroupLease.expires_at > now)]
+
+    def _add_missing_leases(self, groups, db):
+        existing_groups = {group for group, in db.query(GroupLease.vk_group_id).filter(GroupLease.vk_group_id.in_(groups))}
+        missing_groups = [group for group in groups if group not in existing_groups]
+        if not missing_groups:
+            return
+
+        try:
+            db.bulk_insert_mappings(GroupLease, [{'vk_group_id': group} for group in missing_groups])
+            db.commit()
+        except IntegrityError:
+            # Another worker has added them at the same time, they are claimable next time
+            db.rollback()
+            logger.info('Leases of new groups were added by another worker')
+        except:
+            db.rollback()
+            raise
@@ -5,10 +5,14 @@ from functools import partial, wraps
 import logging
 import telegram
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import CommandHandler, Updater, ConversationHandler, Filters, MessageHandler, RegexHandler
+from telegram.ext import CommandHandler, Updater, ConversationHandler, Filters, MessageHandler, RegexHandler, \
+    ChatMemberHandler
 
-from . import models, metrics
+from . import models, metrics, profiling
+from .conversation_state import MemoryStateStore
+from .hashtags import format_hashtag_filter, parse_hashtag_filter
 from .models import Channel, DisabledChannel
+from .vk_callback import serve_vk_callback
 
 logger = logging.getLogger(__name__)
 
@@ -17,15 +21,46 @@ ASKED_CHANNEL_ID_IN_FILTER_BY_HASHTAG, ASKED_HASHTAGS_IN_FILTER_BY_HASHTAG, \
 ASKED_CHANNEL_ID_IN_RECOVER = list(range(6))
 
 
-def run_worker(telegram_token, db_session_maker, use_webhook, webhook_domain='', webhook_port=''):
-    users_state = dict()
+def run_worker(telegram_token, db_session_maker, use_webhook, webhook_domain='', webhook_port='', users_state=None,
+               vk_callback_path=None):
+    """Starts the bot. `users_state` keeps the data of unfinished conversations, a MemoryStateStore by default or
+    a DbStateStore which webhook replicas share. Conversations end by themselves once their state expires.
+    With `vk_callback_path` the webhook server also receives posts pushed by the VK Callback API."""
+    if users_state is None:
+        users_state = MemoryStateStore()
 
-    updater = Updater(telegram_token)
+    updater = Updater(telegram_token, persistence=users_state.persistence)
+    add_handlers(updater.dispatcher, db_session_maker, users_state)
+
+    if use_webhook:
+        logger.info('Starting webhook at {}:{}'.format(webhook_domain, webhook_port))
+        updater.start_webhook('0.0.0.0', webhook_port, telegram_token)
+        updater.bot.set_webhook('https://{}/{}'.format(webhook_domain, telegram_token))
+        if vk_callback_path:
+            serve_vk_callback(updater, db_session_maker, vk_callback_path)
+    else:
+        logger.info('Starting long poll')
+        updater.start_polling()
+        if vk_callback_path:
+            logger.warning('VK Callback API is served by the webhook server only, groups are polled')
+
+    return updater
+
+
+def add_handlers(dp, db_session_maker, users_state=None):
+    """Sets up the commands and conversations on the dispatcher `dp`, which has to be created with
+    `users_state.persistence`."""
+    if users_state is None:
+        users_state = MemoryStateStore()
+    # A shared store keeps the conversations' steps too, they expire with it instead of by a replica's timeout job
+    persistent = users_state.persistence is not None
+    conversation_timeout = None if persistent else users_state.ttl
 
-    dp = updater.dispatcher
     dp.add_error_handler(on_error)
     dp.add_handler(CommandHandler('start', start))
     dp.add_handler(ConversationHandler(
+        name='new',
+        persistent=persistent,
         entry_points=[CommandHandler('new', new)],
         states={
             ASKED_VK_GROUP_LINK_IN_NEW: [
@@ -41,9 +76,12 @@ def run_worker(telegram_token, db_session_maker, use_webhook, webhook_domain='',
             ]
         },
         allow_reentry=True,
+        conversation_timeout=conversation_timeout,
         fallbacks=[CommandHandler('cancel', partial(cancel_new, users_state=users_state))]
     ))
     dp.add_handler(ConversationHandler(
+        name='filter_by_hashtag',
+        persistent=persistent,
         entry_points=[CommandHandler('filter_by_hashtag', partial(filter_by_hashtag,
                                                                   db_session_maker=db_session_maker, users_state=users_state))],
         states={
@@ -57,10 +95,13 @@ def run_worker(telegram_token, db_session_maker, use_webhook, webhook_domain='',
             ]
         },
         allow_reentry=True,
+        conversation_timeout=conversation_timeout,
         fallbacks=[CommandHandler('cancel', partial(cancel_filter_by_hashtag,
                                                     users_state=users_state))]
     ))
     dp.add_handler(ConversationHandler(
+        name='recover',
+        persistent=persistent,
         entry_points=[CommandHandler('recover', partial(recover,
                                                         db_session_maker=db_session_maker, users_state=users_state))],
         states={
@@ -70,19 +111,14 @@ def run_worker(telegram_token, db_session_maker, use_webhook, webhook_domain='',
             ]
         },
         allow_reentry=True,
+        conversation_timeout=conversation_timeout,
         fallbacks=[CommandHandler('cancel', partial(cancel_recover,
                                                     users_state=users_state))]
     ))
-
-    if use_webhook:
-        logger.info('Starting webhook at {}:{}'.format(webhook_domain, webhook_port))
-        updater.start_webhook('0.0.0.0', webhook_port, telegram_token)
-        updater.bot.set_webhook('https://{}/{}'.format(webhook_domain, telegram_token))
-    else:
-        logger.info('Starting long poll')
-        updater.start_polling()
-
-    return updater
+    dp.add_handler(MessageHandler(Filters.status_update.new_chat_title,
+                                  partial(update_channel_title, db_session_maker=db_session_maker)))
+    dp.add_handler(ChatMemberHandler(partial(update_channel_title, db_session_maker=db_session_maker),
+                                     ChatMemberHandler.MY_CHAT_MEMBER))
 
 
 def del_state(update, users_state):
@@ -104,7 +140,7 @@ def catch_exceptions(func):
     @wraps(func)
     def wrapper(update, context, *args, **kwargs):
         try:
-            return func(update, context, *args, **kwargs)
+            return profiling.manage_handlers.run(func, update, context, *args, **kwargs)
         except Exception as e:
             logger.error('Exception in {}: {}'.format(func.__name__, e))
             traceback.print_exc()
@@ -138,9 +174,11 @@ def make_db_session(func):
     @wraps(func)
     def wrapper(*args, db_session_maker, **kwargs):
         db = db_session_maker()
-        result = func(*args, **kwargs, db=db)
-        db.close()
-        return result
+        try:
+            return func(*args, **kwargs, db=db)
+        finally:
+            # Rolls back what the handler left uncommitted and returns the connection even if it raised
+            db.close()
 
     return wrapper
 
@@ -165,8 +203,8 @@ def new(update, context):
 def new_in_state_asked_vk_group_link(update, context, users_state):
     vk_url = update.message.text
     vk_domain = vk_url.split('/')[-1]
-    users_state[update.message.from_user.id] = dict()
-    users_state[update.message.from_user.id]['vk_domain'] = vk_domain
+    # States are replaced as a whole, a store may keep a copy instead of the dict itself
+    users_state[update.message.from_user.id] = {'vk_domain': vk_domain}
 
     update.message.reply_text('Отлично! Теперь:')
     update.message.reply_text('1. Создайте новый канал. Можно использовать существующий')
@@ -190,10 +228,12 @@ def new_in_state_asked_channel_message(update, context, db, users_state):
     user_id = update.message.from_user.id
     username = update.message.from_user.username
     channel_id = str(update.message.forward_from_chat.id)
+    title = update.message.forward_from_chat.title
     vk_group_id = users_state[user_id]['vk_domain']
 
     try:
-        channel = Channel(channel_id=channel_id, vk_group_id=vk_group_id, owner_id=user_id, owner_username=username)
+        channel = Channel(channel_id=channel_id, vk_group_id=vk_group_id, owner_id=user_id, owner_username=username,
+                          title=title)
         db.add(channel)
         db.commit()
         metrics.telegram_conversations_total.labels(type='new', status='completed').inc()
@@ -204,7 +244,9 @@ def new_in_state_asked_channel_message(update, context, db, users_state):
 
     try:
         db.query(DisabledChannel).filter(DisabledChannel.channel_id == channel_id).delete()
+        db.commit()
     except Exception:
+        db.rollback()
         logger.warning('Cannot delete disabled channel of {}'.format(channel_id))
         traceback.print_exc()
 
@@ -240,37 +282,57 @@ def filter_by_hashtag(update, context, db, users_state):
 
     metrics.telegram_conversations_total.labels(type='filter_by_hashtag', status='started').inc()
 
-    users_state[user_id] = dict()
-    users_state[user_id]['channels'] = dict()
+    channels = dict()
     keyboard = []
     keyboard_row = []
     for channel in db.query(Channel).filter(Channel.owner_id == str(user_id)).order_by(Channel.created_at.desc()):
-        try:
-            channel_chat = context.bot.get_chat(chat_id=channel.channel_id)
-            users_state[user_id]['channels'][channel_chat.title] = channel.channel_id
-            keyboard_row.append(channel_chat.title)
-            if len(keyboard_row) == 2:
-                keyboard.append(keyboard_row)
-                keyboard_row = []
-        except telegram.TelegramError:
-            logger.warning('filter_by_hashtag: cannot get title of channel {}'.format(channel.channel_id))
-            traceback.print_exc()
+        title = channel.title
+        if title is None:
+            title = fetch_channel_title(channel, context.bot, db)
+            if title is None:
+                continue
+        channels[title] = channel.channel_id
+        keyboard_row.append(title)
+        if len(keyboard_row) == 2:
+            keyboard.append(keyboard_row)
+            keyboard_row = []
     if len(keyboard_row) != 0:
         keyboard.append(keyboard_row)
+    users_state[user_id] = {'channels': channels}
 
     update.message.reply_text('Выберите канал', reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
 
     return ASKED_CHANNEL_ID_IN_FILTER_BY_HASHTAG
 
 
+def fetch_channel_title(channel, bot, db):
+    """Gets the title of a channel added before titles were stored and stores it, so it's fetched only once."""
+    try:
+        title = bot.get_chat(chat_id=channel.channel_id).title
+    except telegram.TelegramError:
+        logger.warning('filter_by_hashtag: cannot get title of channel {}'.format(channel.channel_id))
+        traceback.print_exc()
+        return None
+
+    try:
+        channel.title = title
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+    return title
+
+
 @catch_exceptions
 @make_db_session
 def filter_by_hashtag_in_state_asked_channel_id(update, context, db, users_state):
     user_id = update.message.from_user.id
     channel_title = update.message.text
-    channel_id = str(users_state[user_id]['channels'][channel_title])
+    state = users_state[user_id]
+    channel_id = str(state['channels'][channel_title])
     channel = db.query(Channel).get(channel_id)
-    users_state[user_id]['channel'] = channel
+    users_state[user_id] = dict(state, channel_id=channel_id)
 
     if channel.hashtag_filter is not None:
         update.message.reply_text('Текущий фильтр по хештегам:')
@@ -284,10 +346,10 @@ def filter_by_hashtag_in_state_asked_channel_id(update, context, db, users_state
 @make_db_session
 def filter_by_hashtag_in_state_asked_hashtags(update, context, db, users_state):
     user_id = update.message.from_user.id
-    channel = users_state[user_id]['channel']
+    channel = db.query(Channel).get(users_state[user_id]['channel_id'])
 
     try:
-        channel.hashtag_filter = ','.join(h.strip() for h in update.message.text.split(','))
+        channel.hashtag_filter = format_hashtag_filter(parse_hashtag_filter(update.message.text))
         db.commit()
         metrics.telegram_conversations_total.labels(type='filter_by_hashtag', status='completed').inc()
     except:
@@ -323,13 +385,12 @@ def recover(update, context, db, users_state):
 
     metrics.telegram_conversations_total.labels(type='recover', status='started').inc()
 
-    users_state[user_id] = dict()
-    users_state[user_id]['channels'] = dict()
+    channels = dict()
     keyboard = []
     keyboard_row = []
     for channel in db.query(DisabledChannel).filter(DisabledChannel.owner_id == str(user_id)).order_by(DisabledChannel.created_at.desc()):
         title = '{} ({})'.format(channel.vk_group_id, channel.channel_id)
-        users_state[user_id]['channels'][title] = channel.channel_id
+        channels[title] = channel.channel_id
         keyboard_row.append(title)
         if len(keyboard_row) == 2:
             keyboard.append(keyboard_row)
@@ -343,6 +404,7 @@ def recover(update, context, db, users_state):
 
         return ConversationHandler.END
     else:
+        users_state[user_id] = {'channels': channels}
         update.message.reply_text('Выберите канал', reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
 
         return ASKED_CHANNEL_ID_IN_RECOVER
@@ -362,7 +424,8 @@ def recover_in_state_asked_channel_id(update, context, db, users_state):
                        last_vk_post_id=disabled_channel.last_vk_post_id,
                        owner_id=disabled_channel.owner_id,
                        owner_username=disabled_channel.owner_username,
-                       hashtag_filter=disabled_channel.hashtag_filter))
+                       hashtag_filter=disabled_channel.hashtag_filter,
+                       title=disabled_channel.title))
         db.delete(disabled_channel)
         db.commit()
         metrics.telegram_conversations_total.labels(type='recover', status='completed').inc()
@@ -391,3 +454,19 @@ def cancel_recover(update, context, users_state):
     del_state(update, users_state)
 
     return ConversationHandler.END
+
+
+@catch_exceptions
+@make_db_session
+def update_channel_title(update, context, db):
+    """Keeps the stored title of a channel up to date. The bot gets an update when a channel it administers is
+    renamed or the bot's membership in it changes."""
+    chat = update.effective_chat
+
+    try:
+        db.query(Channel).filter(Channel.channel_id == str(chat.id)) \
+            .update({Channel.title: chat.title}, synchronize_session=False)
+        db.commit()
+    except:
+        db.rollback()
+        raise
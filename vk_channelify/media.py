@@ -0,0 +1,165 @@
+import datetime
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+import logging
+import telegram
+from telegram import InputMediaPhoto
+
+from . import metrics
+from .models import TelegramFile
+
+logger = logging.getLogger(__name__)
+
+MEDIA_GROUP_MAX_SIZE = 10
+CAPTION_MAX_LENGTH = 1024
+DEFAULT_FILE_CACHE_SIZE = 10000
+
+Attachment = namedtuple('Attachment', ['attachment_id', 'type', 'url'])
+
+
+def get_post_attachments(post):
+    """Returns photos and documents of a VK post, other attachments can't be forwarded to Telegram by url."""
+    attachments = []
+    for attachment in post.get('attachments', []):
+        if attachment['type'] == 'photo':
+            photo = attachment['photo']
+            largest_size = max(photo['sizes'], key=lambda size: size.get('width', 0) * size.get('height', 0))
+            attachments.append(Attachment('photo{}_{}'.format(photo['owner_id'], photo['id']), 'photo',
+                                          largest_size['url']))
+        elif attachment['type'] == 'doc':
+            doc = attachment['doc']
+            attachments.append(Attachment('doc{}_{}'.format(doc['owner_id'], doc['id']), 'document', doc['url']))
+    return attachments
+
+
+class TelegramFileCache:
+    """Bounded LRU cache of Telegram file_ids of VK attachments, persisted in telegram_files.
+
+    A photo is uploaded once, by its url, and every other channel gets the file_id Telegram gave it. Sends may
+    happen on other threads, so the cache is thread-safe, it is loaded and saved on the worker's thread.
+    """
+
+    def __init__(self, max_size=DEFAULT_FILE_CACHE_SIZE):
+        self.max_size = max_size
+        self._file_ids = OrderedDict()  # attachment_id -> (file_id, last_used_at)
+        self._changed_attachment_ids = set()
+        self._is_loaded = False
+        self._lock = Lock()
+
+    def load(self, db):
+        files = db.query(TelegramFile).order_by(TelegramFile.last_used_at.desc()).limit(self.max_size)
+        with self._lock:
+            for file in reversed(list(files)):
+                self._file_ids[file.vk_attachment_id] = (file.file_id, file.last_used_at)
+            self._changed_attachment_ids.clear()
+            self._is_loaded = True
+        logger.info('Loaded {} Telegram file ids'.format(len(self._file_ids)))
+
+    def save(self, db):
+        if not self._is_loaded:
+            self.load(db)
+
+        with self._lock:
+            changed_files = [(attachment_id, self._file_ids[attachment_id])
+                             for attachment_id in self._changed_attachment_ids if attachment_id in self._file_ids]
+            self._changed_attachment_ids.clear()
+        if not changed_files:
+            return
+
+        try:
+            for attachment_id, (file_id, last_used_at) in changed_files:
+                db.merge(TelegramFile(vk_attachment_id=attachment_id, file_id=file_id, last_used_at=last_used_at))
+            db.flush()
+            # Rows beyond max_size are the least recently used ones, the same which were evicted from memory
+            oldest_kept_used_at = db.query(TelegramFile.last_used_at) \
+                .order_by(TelegramFile.last_used_at.desc()) \
+                .offset(self.max_size - 1).limit(1).scalar()
+            if oldest_kept_used_at is not None:
+                db.query(TelegramFile).filter(TelegramFile.last_used_at < oldest_kept_used_at) \
+                    .delete(synchronize_session=False)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+    def get(self, attachment_id):
+        with self._lock:
+            if attachment_id not in self._file_ids:
+                metrics.telegram_file_cache_requests_total.labels(result='miss').inc()
+                return None
+
+            file_id, _ = self._file_ids.pop(attachment_id)
+            self._file_ids[attachment_id] = (file_id, datetime.datetime.utcnow())
+            self._changed_attachment_ids.add(attachment_id)
+            metrics.telegram_file_cache_requests_total.labels(result='hit').inc()
+            return file_id
+
+    def put(self, attachment_id, file_id):
+        with self._lock:
+            self._file_ids.pop(attachment_id, None)
+            self._file_ids[attachment_id] = (file_id, datetime.datetime.utcnow())
+            self._changed_attachment_ids.add(attachment_id)
+            while len(self._file_ids) > self.max_size:
+                self._file_ids.popitem(last=False)
+
+    def discard(self, attachment_id):
+        with self._lock:
+            self._file_ids.pop(attachment_id, None)
+
+
+def send_post_messages(call, chat_id, text, attachments, file_cache=None):
+    """Sends a post's text and attachments to the chat.
+
+    Photos are sent as albums of up to MEDIA_GROUP_MAX_SIZE, documents one by one. The text is the caption of
+    the first attachment if it fits, otherwise it's sent as a message before them. Attachments are sent by their
+    cached file_id or by url, so their bytes never pass through the worker. If Telegram can't take them, only
+    the text is sent. `call(method, *args, **kwargs)` calls the Bot method with the given name.
+    """
+    if file_cache is None:
+        file_cache = TelegramFileCache()
+
+    caption = text if attachments and len(text) <= CAPTION_MAX_LENGTH else None
+    if caption is None:
+        call('send_message', chat_id, text)
+
+    try:
+        for method, attachments_part in iterate_attachments_parts(attachments):
+            send_attachments(call, chat_id, method, attachments_part, caption, file_cache)
+            caption = None
+    except telegram.error.BadRequest as e:
+        logger.warning('Cannot send attachments to {}: {}'.format(chat_id, e))
+        for attachment in attachments:
+            file_cache.discard(attachment.attachment_id)
+        if caption is not None:
+            # Nothing has been sent yet, the text goes alone. If the chat itself is the problem, this raises again
+            call('send_message', chat_id, text)
+
+
+def iterate_attachments_parts(attachments):
+    photos = [attachment for attachment in attachments if attachment.type == 'photo']
+    for i in range(0, len(photos), MEDIA_GROUP_MAX_SIZE):
+        photos_part = photos[i:i + MEDIA_GROUP_MAX_SIZE]
+        yield ('send_photo' if len(photos_part) == 1 else 'send_media_group'), photos_part
+
+    for attachment in attachments:
+        if attachment.type == 'document':
+            yield 'send_document', [attachment]
+
+
+def send_attachments(call, chat_id, method, attachments, caption, file_cache):
+    media = [file_cache.get(attachment.attachment_id) or attachment.url for attachment in attachments]
+
+    if method == 'send_media_group':
+        messages = call(method, chat_id,
+                        [InputMediaPhoto(m, caption=caption if i == 0 else None) for i, m in enumerate(media)])
+        file_ids = [message.photo[-1].file_id for message in messages]
+    elif method == 'send_photo':
+        message = call(method, chat_id, media[0], caption=caption)
+        file_ids = [message.photo[-1].file_id]
+    else:
+        message = call(method, chat_id, media[0], caption=caption)
+        file_ids = [message.document.file_id]
+
+    for attachment, file_id in zip(attachments, file_ids):
+        file_cache.put(attachment.attachment_id, file_id)
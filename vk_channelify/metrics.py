@@ -1,5 +1,52 @@
+import zlib
+
 from prometheus_client import Counter, Gauge, Histogram, Info
 
+# Labels which get a value per channel or VK group, see configure_label_cardinality()
+HIGH_CARDINALITY_LABELS = ('channel_id', 'vk_group_id')
+LABEL_CARDINALITY_MODES = ('full', 'hash', 'drop')
+DEFAULT_LABEL_BUCKETS = 64
+
+label_cardinality = {'mode': 'full', 'buckets': DEFAULT_LABEL_BUCKETS}
+
+
+def configure_label_cardinality(mode, buckets=DEFAULT_LABEL_BUCKETS):
+    """Bounds the number of series of metrics labelled by channel and group ids.
+
+    'full' keeps the ids, 'hash' maps each of them to one of `buckets` values and 'drop' leaves them empty. Every
+    increment still goes to some series, so totals summed over the labels stay exact. Has to be called before
+    anything is counted, series already created are kept.
+    """
+    if mode not in LABEL_CARDINALITY_MODES:
+        raise ValueError('Unknown label cardinality mode {}, expected one of {}'.format(mode, LABEL_CARDINALITY_MODES))
+    label_cardinality['mode'] = mode
+    label_cardinality['buckets'] = buckets
+
+
+def bound_label_value(value):
+    mode = label_cardinality['mode']
+    if mode == 'full' or not value:
+        return value
+    if mode == 'drop':
+        return ''
+    # crc32 is the same in every process, unlike hash() of a str
+    return 'bucket{}'.format(zlib.crc32(str(value).encode()) % label_cardinality['buckets'])
+
+
+class BoundedLabels:
+    """Wraps a metric, so the values of its HIGH_CARDINALITY_LABELS are bounded by bound_label_value()."""
+
+    def __init__(self, metric):
+        self._metric = metric
+
+    def labels(self, **labels):
+        return self._metric.labels(**{name: bound_label_value(value) if name in HIGH_CARDINALITY_LABELS else value
+                                      for name, value in labels.items()})
+
+    def __getattr__(self, name):
+        return getattr(self._metric, name)
+
+
 app_info = Info('vk_channelify', 'VK Channelify bot information')
 app_info.info({'version': '1.0.0', 'description': 'VK to Telegram channel reposter'})
 
@@ -13,30 +60,95 @@ repost_iteration_duration_seconds = Histogram(
     'Duration of repost worker iterations in seconds',
     buckets=(1, 5, 10, 30, 60, 120, 300, 600)
 )
-repost_posts_sent_total = Counter(
+repost_posts_sent_total = BoundedLabels(Counter(
     'vk_channelify_posts_sent_total',
     'Total number of posts sent to Telegram channels',
     ['channel_id', 'vk_group_id']
-)
-repost_errors_total = Counter(
+))
+repost_errors_total = BoundedLabels(Counter(
     'vk_channelify_repost_errors_total',
     'Total number of errors during reposting',
     ['error_type', 'channel_id', 'vk_group_id']
-)
-vk_api_requests_total = Counter(
+))
+vk_api_requests_total = BoundedLabels(Counter(
     'vk_channelify_vk_api_requests_total',
     'Total number of VK API requests',
     ['method', 'status', 'vk_group_id']
-)
-telegram_api_requests_total = Counter(
+))
+telegram_api_requests_total = BoundedLabels(Counter(
     'vk_channelify_telegram_api_requests_total',
     'Total number of Telegram API requests',
     ['method', 'status', 'channel_id', 'vk_group_id']
-)
-channels_disabled_total = Counter(
+))
+channels_disabled_total = BoundedLabels(Counter(
     'vk_channelify_channels_disabled_total',
     'Total number of channels disabled',
     ['channel_id', 'vk_group_id']
+))
+vk_api_request_duration_seconds = Histogram(
+    'vk_channelify_vk_api_request_duration_seconds',
+    'Duration of VK API requests in seconds, without waiting for the rate limit',
+    ['method'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+)
+vk_rate_limit_wait_seconds = Histogram(
+    'vk_channelify_vk_rate_limit_wait_seconds',
+    'Time VK API requests waited for the rate limit in seconds',
+    buckets=(0, 0.05, 0.1, 0.25, 0.5, 1, 3, 10)
+)
+telegram_api_request_duration_seconds = Histogram(
+    'vk_channelify_telegram_api_request_duration_seconds',
+    'Duration of Telegram Bot API requests in seconds, without waiting for rate limits',
+    ['method'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+)
+db_commit_duration_seconds = Histogram(
+    'vk_channelify_db_commit_duration_seconds',
+    'Duration of database commits in seconds, including the flush before them',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+post_delivery_delay_seconds = Histogram(
+    'vk_channelify_post_delivery_delay_seconds',
+    'Time from the publication of a VK post to its delivery to a Telegram channel in seconds',
+    buckets=(30, 60, 2 * 60, 5 * 60, 10 * 60, 15 * 60, 30 * 60, 60 * 60, 2 * 60 * 60, 6 * 60 * 60, 24 * 60 * 60)
+)
+telegram_send_queue_depth = Gauge(
+    'vk_channelify_telegram_send_queue_depth',
+    'Current number of posts selected for sending which are not sent yet'
+)
+telegram_send_wait_seconds = Histogram(
+    'vk_channelify_telegram_send_wait_seconds',
+    'Time sends waited for Telegram rate limits and RetryAfter in seconds',
+    buckets=(0, 0.05, 0.1, 0.5, 1, 3, 10, 30, 60)
+)
+telegram_retry_after_total = Counter(
+    'vk_channelify_telegram_retry_after_total',
+    'Total number of RetryAfter errors returned by Telegram'
+)
+telegram_file_cache_requests_total = Counter(
+    'vk_channelify_telegram_file_cache_requests_total',
+    'Total number of lookups of Telegram file ids of VK attachments, a miss uploads the attachment by url',
+    ['result']
+)
+vk_token_requests_total = Counter(
+    'vk_channelify_vk_token_requests_total',
+    'Total number of VK API requests made with each service token, labelled by its position in VK_TOKENS',
+    ['token']
+)
+vk_token_errors_total = Counter(
+    'vk_channelify_vk_token_errors_total',
+    'Total number of times a VK service token was taken out of rotation',
+    ['token', 'reason']
+)
+vk_token_available_gauge = Gauge(
+    'vk_channelify_vk_token_available',
+    'Whether a VK service token is in rotation, 1 or 0',
+    ['token']
+)
+http_connections_total = Counter(
+    'vk_channelify_http_connections_total',
+    'Total number of HTTP connections used by pooled sessions, new ones cost a TCP and TLS handshake',
+    ['upstream', 'type']
 )
 
 # Channel state metrics
@@ -49,6 +161,59 @@ disabled_channels_gauge = Gauge(
     'Current number of disabled channels'
 )
 
+# Poll scheduler metrics
+scheduled_groups_gauge = Gauge(
+    'vk_channelify_scheduled_groups',
+    'Current number of VK groups in the poll schedule'
+)
+due_groups_gauge = Gauge(
+    'vk_channelify_due_groups',
+    'Number of VK groups which were due to be polled in the last iteration'
+)
+
+# Group lease metrics
+leased_groups_gauge = Gauge(
+    'vk_channelify_leased_groups',
+    'Number of VK groups leased to this repost worker'
+)
+repost_workers_gauge = Gauge(
+    'vk_channelify_repost_workers',
+    'Number of live repost workers sharing the VK groups'
+)
+
+# Circuit breaker metrics
+open_breakers_gauge = Gauge(
+    'vk_channelify_open_breakers',
+    'Number of VK groups which are not polled because their fetches keep failing'
+)
+breaker_probes_total = Counter(
+    'vk_channelify_breaker_probes_total',
+    'Total number of polls of VK groups whose breakers were half-open',
+    ['result']
+)
+
+# VK Callback API metrics
+vk_callback_events_total = Counter(
+    'vk_channelify_vk_callback_events_total',
+    'Total number of events received from the VK Callback API',
+    ['type', 'result']
+)
+pushed_groups_gauge = Gauge(
+    'vk_channelify_pushed_groups',
+    'Number of VK groups of this repost worker which are not polled because they push their posts'
+)
+
+# Database metrics
+db_pool_checked_out_gauge = Gauge(
+    'vk_channelify_db_pool_checked_out_connections',
+    'Number of database connections currently checked out of the pool'
+)
+db_pool_wait_seconds = Histogram(
+    'vk_channelify_db_pool_wait_seconds',
+    'Time taken to check a database connection out of the pool in seconds, including opening a new one',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+
 # Manage worker metrics
 telegram_commands_total = Counter(
     'vk_channelify_telegram_commands_total',
@@ -66,3 +231,12 @@ telegram_conversations_total = Counter(
     'Total number of Telegram conversations',
     ['type', 'status']
 )
+conversation_states_gauge = Gauge(
+    'vk_channelify_conversation_states',
+    'Number of stored states of unfinished conversations'
+)
+conversation_states_evicted_total = Counter(
+    'vk_channelify_conversation_states_evicted_total',
+    'Total number of states of abandoned conversations dropped from the store',
+    ['reason']
+)
@@ -1,6 +1,11 @@
-from sqlalchemy import create_engine
+import time
+
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+
+from .. import metrics
 
 from .time_stamp_mixin import TimeStampMixin
 
@@ -12,9 +17,74 @@ class Base(TimeStampMixin):
 Base = declarative_base(cls=Base)
 
 from .channel import Channel
+from .conversation_state import ConversationState
+from .delivery import Delivery
 from .disabled_channel import DisabledChannel
+from .group_lease import GroupLease
+from .repost_worker_heartbeat import RepostWorkerHeartbeat
+from .telegram_file import TelegramFile
+from .vk_group import VkGroup
+from .vk_group_schedule import VkGroupSchedule
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool which exports how long checkouts wait for a connection, a full pool makes them wait."""
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.db_pool_wait_seconds.observe(time.perf_counter() - start_time)
+
+
+def make_session_maker(url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=-1, pool_pre_ping=False,
+                       pgbouncer=False):
+    """Makes sessions of a new engine. The defaults are SQLAlchemy's own.
+
+    With `pgbouncer` connections aren't pooled here at all, PgBouncer pools them, so a connection is never kept
+    after the transaction it was taken for and transaction pooling works.
+    """
+    if pgbouncer:
+        engine = create_engine(url, poolclass=NullPool, pool_pre_ping=pool_pre_ping)
+    else:
+        engine = create_engine(url, poolclass=TimedQueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                               pool_timeout=pool_timeout, pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+    observe_pool(engine)
+    session_maker = sessionmaker(bind=engine)
+    observe_commits(session_maker)
+    return session_maker
+
+
+def observe_commits(session_maker):
+    @event.listens_for(session_maker, 'before_commit')
+    def on_before_commit(session):
+        session.info['commit_started_at'] = time.perf_counter()
+
+    @event.listens_for(session_maker, 'after_commit')
+    def on_after_commit(session):
+        started_at = session.info.pop('commit_started_at', None)
+        if started_at is not None:
+            metrics.db_commit_duration_seconds.observe(time.perf_counter() - started_at)
+
+
+def observe_pool(engine):
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.db_pool_checked_out_gauge.inc()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        metrics.db_pool_checked_out_gauge.dec()
+
 
+def estimate_count(db, model):
+    """Returns the number of rows of the model's table estimated by PostgreSQL statistics, without scanning it
+    like COUNT(*) does. Other databases and tables which haven't been analyzed yet are counted exactly."""
+    if db.get_bind().dialect.name == 'postgresql':
+        estimate = db.execute(text('SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+                              {'table': model.__tablename__}).scalar()
+        if estimate is not None and estimate > 0:
+            return estimate
 
-def make_session_maker(url):
-    engine = create_engine(url)
-    return sessionmaker(bind=engine)
+    return db.query(model).count()
@@ -1,10 +1,13 @@
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Index
+from sqlalchemy.orm import relationship
 
 from . import Base
 
 
 class Channel(Base):
     __tablename__ = 'channels'
+    # /filter_by_hashtag lists the user's channels, newest first
+    __table_args__ = (Index('ix_channels_owner_id_created_at', 'owner_id', 'created_at'),)
 
     channel_id = Column(String, primary_key=True, nullable=False)
     vk_group_id = Column(String, nullable=False)
@@ -12,3 +15,12 @@ class Channel(Base):
     owner_id = Column(String, nullable=False)
     owner_username = Column(String)
     hashtag_filter = Column(String)
+    # Title of the Telegram channel for keyboards, kept up to date from the bot's updates
+    title = Column(String)
+    # Numeric id of vk_group_id, resolved by the repost worker
+    vk_group_ref = Column(Integer, ForeignKey('vk_groups.id'), index=True)
+    # Failed resolutions of vk_group_id in a row, the channel isn't resolved nor polled until resolve_retry_at
+    resolve_error_streak = Column(Integer, nullable=False, server_default='0', default=0)
+    resolve_retry_at = Column(DateTime)
+
+    vk_group = relationship('VkGroup')
@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, DateTime, Text
+
+from . import Base
+
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_states'
+
+    user_id = Column(String, primary_key=True, nullable=False)
+    # State of the user's conversation with the manage worker as JSON
+    state = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,16 @@
+from sqlalchemy import Column, String, Integer, DateTime, Text, UniqueConstraint
+
+from . import Base
+
+
+class Delivery(Base):
+    __tablename__ = 'deliveries'
+    # A post is delivered to a channel at most once, whatever happens to the worker in between
+    __table_args__ = (UniqueConstraint('channel_id', 'vk_post_id', name='deliveries_channel_id_vk_post_id_key'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    channel_id = Column(String, nullable=False)
+    vk_post_id = Column(Integer, nullable=False)
+    # The VK post as JSON, formatted when it is sent
+    post = Column(Text, nullable=False)
+    delivered_at = Column(DateTime, index=True)
@@ -1,15 +1,18 @@
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, Index
 
 from . import Base
 
 
 class DisabledChannel(Base):
     __tablename__ = 'disabled_channels'
+    # /recover lists the user's disabled channels, newest first
+    __table_args__ = (Index('ix_disabled_channels_owner_id_created_at', 'owner_id', 'created_at'),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    channel_id = Column(String, nullable=False)
+    channel_id = Column(String, nullable=False, index=True)
     vk_group_id = Column(String, nullable=False)
     last_vk_post_id = Column(Integer, nullable=False, server_default='0')
     owner_id = Column(String, nullable=False)
     owner_username = Column(String)
     hashtag_filter = Column(String)
+    title = Column(String)
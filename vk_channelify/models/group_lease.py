@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, DateTime
+
+from . import Base
+
+
+class GroupLease(Base):
+    __tablename__ = 'group_leases'
+
+    vk_group_id = Column(String, primary_key=True, nullable=False)
+    # The repost worker which polls the group until expires_at, nobody while it is null
+    worker_id = Column(String, index=True)
+    expires_at = Column(DateTime)
@@ -0,0 +1,10 @@
+from sqlalchemy import Column, String, DateTime
+
+from . import Base
+
+
+class RepostWorkerHeartbeat(Base):
+    __tablename__ = 'repost_worker_heartbeats'
+
+    worker_id = Column(String, primary_key=True, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, DateTime
+
+from . import Base
+
+
+class TelegramFile(Base):
+    __tablename__ = 'telegram_files'
+
+    # Like photo-1_456239017 or doc-1_437503523
+    vk_attachment_id = Column(String, primary_key=True, nullable=False)
+    file_id = Column(String, nullable=False)
+    last_used_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,18 @@
+from sqlalchemy import Column, String, Integer, DateTime
+
+from . import Base
+
+
+class VkGroup(Base):
+    __tablename__ = 'vk_groups'
+
+    id = Column(Integer, primary_key=True, autoincrement=False, nullable=False)
+    screen_name = Column(String, nullable=False)
+    last_vk_post_id = Column(Integer, nullable=False, server_default='0', default=0)
+    last_fetched_at = Column(DateTime)
+    error_streak = Column(Integer, nullable=False, server_default='0', default=0)
+    # The group isn't polled until then because of its error_streak, see breaker.py
+    retry_at = Column(DateTime, index=True)
+    # Set up for groups which push new posts to the VK Callback API endpoint, see vk_callback.py
+    callback_secret = Column(String)
+    callback_confirmation_code = Column(String)
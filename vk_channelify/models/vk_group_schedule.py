@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, Integer, DateTime
+
+from . import Base
+
+
+class VkGroupSchedule(Base):
+    __tablename__ = 'vk_group_schedules'
+
+    vk_group_id = Column(String, primary_key=True, nullable=False)
+    poll_interval = Column(Integer, nullable=False)
+    next_poll_at = Column(DateTime, nullable=False)
+    last_post_at = Column(DateTime)
@@ -0,0 +1,131 @@
+import datetime
+import json
+
+import logging
+from sqlalchemy import func
+
+from .models import Channel, Delivery
+
+logger = logging.getLogger(__name__)
+
+DELIVERED_COMMIT_BATCH_SIZE = 20
+DELIVERED_RETENTION = datetime.timedelta(days=1)
+
+
+def enqueue_deliveries(channel_posts, db):
+    """Stores (channel_id, post) pairs as pending deliveries with one bulk insert and commits the session.
+
+    Cursors moved on the session's channels are committed in the same transaction, so a post is either enqueued
+    and passed by its channel's cursor, or neither of them. Posts pushed by the VK Callback API are enqueued without
+    moving cursors, so pairs already enqueued are skipped when polling fetches them again, and so are pairs repeated
+    in `channel_posts`.
+    """
+    try:
+        channel_posts = skip_enqueued(channel_posts, db)
+        if channel_posts:
+            db.bulk_insert_mappings(Delivery, [
+                {'channel_id': channel_id, 'vk_post_id': post['id'], 'post': json.dumps(post, ensure_ascii=False)}
+                for channel_id, post in channel_posts
+            ])
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+
+def skip_enqueued(channel_posts, db):
+    """Drops pairs enqueued before and repeated ones, so the bulk insert doesn't hit the unique constraint."""
+    if not channel_posts:
+        return channel_posts
+
+    enqueued = set(db.query(Delivery.channel_id, Delivery.vk_post_id)
+                   .filter(Delivery.channel_id.in_({channel_id for channel_id, _ in channel_posts}),
+                           Delivery.vk_post_id.in_({post['id'] for _, post in channel_posts})))
+    new_channel_posts = []
+    for channel_id, post in channel_posts:
+        if (channel_id, post['id']) not in enqueued:
+            enqueued.add((channel_id, post['id']))
+            new_channel_posts.append((channel_id, post))
+    return new_channel_posts
+
+
+def fetch_pending_deliveries(channel_ids, db):
+    """Returns a dict mapping channel ids to their pending (delivery_id, post) pairs, oldest posts first."""
+    if not channel_ids:
+        return dict()
+
+    # Plain rows instead of entities, they don't expire and reload when delivered posts are committed
+    rows = db.query(Delivery.id, Delivery.channel_id, Delivery.post) \
+        .filter(Delivery.channel_id.in_(channel_ids), Delivery.delivered_at.is_(None)) \
+        .order_by(Delivery.channel_id, Delivery.vk_post_id)
+
+    deliveries_by_channel = dict()
+    for delivery_id, channel_id, post in rows:
+        deliveries_by_channel.setdefault(channel_id, []).append((delivery_id, json.loads(post)))
+    return deliveries_by_channel
+
+
+class DeliveredBatch:
+    """Collects ids of sent deliveries and marks them delivered in one transaction per `size` sends."""
+
+    def __init__(self, db, size=DELIVERED_COMMIT_BATCH_SIZE):
+        self.db = db
+        self.size = size
+        self._delivery_ids = []
+
+    def add(self, delivery_id):
+        self._delivery_ids.append(delivery_id)
+        if len(self._delivery_ids) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self._delivery_ids:
+            return
+
+        now = datetime.datetime.utcnow()
+        try:
+            self.db.query(Delivery).filter(Delivery.id.in_(self._delivery_ids)) \
+                .update({Delivery.delivered_at: now, Delivery.updated_at: now}, synchronize_session=False)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+
+        self._delivery_ids = []
+
+
+def get_last_delivered_post_id(channel, db):
+    """Returns the id of the last post delivered to the channel, which is behind its cursor while posts are pending."""
+    first_pending_post_id = db.query(func.min(Delivery.vk_post_id)) \
+        .filter(Delivery.channel_id == channel.channel_id, Delivery.delivered_at.is_(None)) \
+        .scalar()
+    if first_pending_post_id is None:
+        return channel.last_vk_post_id
+
+    return first_pending_post_id - 1
+
+
+def delete_channel_deliveries(channel_id, db):
+    """Deletes deliveries of the channel without committing, so it can be part of the caller's transaction."""
+    db.query(Delivery).filter(Delivery.channel_id == channel_id).delete(synchronize_session=False)
+
+
+def prune_deliveries(db, now=None):
+    """Deletes deliveries delivered more than DELIVERED_RETENTION ago and ones of channels which are gone."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    try:
+        delivered_count = db.query(Delivery) \
+            .filter(Delivery.delivered_at < now - DELIVERED_RETENTION) \
+            .delete(synchronize_session=False)
+        orphaned_count = db.query(Delivery) \
+            .filter(Delivery.channel_id.notin_(db.query(Channel.channel_id))) \
+            .delete(synchronize_session=False)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+    if delivered_count or orphaned_count:
+        logger.info('Pruned {} delivered and {} orphaned deliveries'.format(delivered_count, orphaned_count))
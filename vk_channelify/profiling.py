@@ -0,0 +1,231 @@
+"""Profiles the running workers on demand. With profiling enabled the metrics server also serves:
+
+    /debug/threads                                      stacks of all threads
+    /debug/profile/repost?iterations=1                  profile of the next repost iterations
+    /debug/profile/manage?seconds=30                    profile of the manage worker handlers for 30 seconds
+
+Profiles are cProfile stats as text by default, `format=pstats` returns them dumped for pstats.Stats and
+`mode=sample` samples stacks instead and returns them collapsed, like flamegraph.pl and speedscope read them.
+Only the threads running the profiled code are profiled, not the ones it hands work to.
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from prometheus_client import make_wsgi_app
+from prometheus_client.exposition import ThreadingWSGIServer
+
+DEFAULT_SAMPLE_INTERVAL = 0.01
+DEFAULT_TIMEOUT = 15 * 60
+MAX_SECONDS = 10 * 60
+PSTATS_LIMIT = 50
+MODES = ('cprofile', 'sample')
+
+
+class ProfilingBusyError(Exception):
+    pass
+
+
+class ProfileCapture:
+    """Profiles the calls made through `run` while a capture is open. One capture at a time, it ends after
+    `calls` calls or when `stop` is called. Every call is profiled on its own and only the calls which finished
+    while the capture was open make it into the result, so calls running when a capture times out can't touch it."""
+
+    def __init__(self, sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._capture_id = 0
+        self._mode = None
+        self._calls_left = None
+        self._profiles = []
+        self._stacks = None
+        self._thread_ids = set()
+        self._sampler = None
+        self._done = threading.Event()
+
+    def run(self, func, *args, **kwargs):
+        with self._lock:
+            mode = self._mode
+            capture_id = self._capture_id
+            thread_ids = self._thread_ids
+            if mode is not None:
+                thread_ids.add(threading.get_ident())
+
+        if mode is None:
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile() if mode == 'cprofile' else None
+        try:
+            if profile is not None:
+                return profile.runcall(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                thread_ids.discard(threading.get_ident())
+                if self._mode is not None and self._capture_id == capture_id:
+                    if profile is not None:
+                        self._profiles.append(profile)
+                    if self._calls_left is not None:
+                        self._calls_left -= 1
+                        if self._calls_left <= 0:
+                            self._done.set()
+
+    def start(self, mode, calls=None):
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode {}'.format(mode))
+
+        with self._lock:
+            if self._mode is not None:
+                raise ProfilingBusyError('Another profile is being captured')
+            self._capture_id += 1
+            self._mode = mode
+            self._calls_left = calls
+            self._profiles = []
+            self._stacks = Counter()
+            self._thread_ids = set()
+            self._done = threading.Event()
+            if mode == 'sample':
+                self._sampler = threading.Thread(target=self._sample,
+                                                 args=(self._done, self._thread_ids, self._stacks),
+                                                 name='profiling_sampler', daemon=True)
+                self._sampler.start()
+
+    def wait(self, timeout):
+        """Waits for the calls of the capture to finish, returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def stop(self):
+        """Ends the capture and returns pstats.Stats of the profiled calls or the Counter of collapsed stacks."""
+        with self._lock:
+            mode = self._mode
+            self._mode = None
+            self._done.set()
+            profiles, stacks, sampler = self._profiles, self._stacks, self._sampler
+            self._profiles, self._sampler = [], None
+        if sampler is not None:
+            sampler.join()
+        return pstats.Stats(*profiles) if mode == 'cprofile' else stacks
+
+    def _sample(self, done, thread_ids, stacks):
+        while not done.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self._lock:
+                sampled_thread_ids = list(thread_ids)
+            for thread_id in sampled_thread_ids:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stacks[format_collapsed_stack(frame)] += 1
+
+
+# Hooks of the workers, the repost worker runs its iterations and the manage worker its handlers through them
+repost_iterations = ProfileCapture()
+manage_handlers = ProfileCapture()
+
+
+def format_collapsed_stack(frame):
+    return ';'.join('{}:{}'.format(frame_summary.filename, frame_summary.name)
+                    for frame_summary in traceback.extract_stack(frame))
+
+
+def format_profile(result, format='text'):
+    """Returns (content type, body) of a ProfileCapture result."""
+    if isinstance(result, Counter):
+        lines = ['{} {}'.format(stack, count) for stack, count in result.most_common()]
+        return 'text/plain; charset=utf-8', '\n'.join(lines).encode()
+
+    if not result.stats:
+        return 'text/plain; charset=utf-8', b'No calls were profiled'
+
+    if format == 'pstats':
+        return 'application/octet-stream', marshal.dumps(result.stats)
+
+    stream = io.StringIO()
+    result.stream = stream
+    result.sort_stats('cumulative').print_stats(PSTATS_LIMIT)
+    return 'text/plain; charset=utf-8', stream.getvalue().encode()
+
+
+def format_thread_stacks():
+    frames = sys._current_frames()
+    parts = []
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        if frame is None:
+            continue
+        parts.append('Thread {} (id: {}, daemon: {}):\n{}'.format(thread.name, thread.ident, thread.daemon,
+                                                                 ''.join(traceback.format_stack(frame))))
+    return '\n'.join(parts)
+
+
+def capture_profile(capture, mode, calls=None, seconds=None, timeout=DEFAULT_TIMEOUT):
+    capture.start(mode, calls)
+    try:
+        if calls is not None:
+            capture.wait(timeout)
+        else:
+            time.sleep(seconds)
+    finally:
+        result = capture.stop()
+    return result
+
+
+def make_profiling_app(metrics_app):
+    """Serves the profiling endpoints and passes everything else to `metrics_app`."""
+
+    def app(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith('/debug/'):
+            return metrics_app(environ, start_response)
+
+        params = {key: values[0] for key, values in parse_qs(environ.get('QUERY_STRING', '')).items()}
+        try:
+            if path == '/debug/threads':
+                content_type, body = 'text/plain; charset=utf-8', format_thread_stacks().encode()
+            elif path == '/debug/profile/repost':
+                result = capture_profile(repost_iterations, params.get('mode', 'cprofile'),
+                                         calls=int(params.get('iterations', 1)),
+                                         timeout=float(params.get('timeout', DEFAULT_TIMEOUT)))
+                content_type, body = format_profile(result, params.get('format', 'text'))
+            elif path == '/debug/profile/manage':
+                result = capture_profile(manage_handlers, params.get('mode', 'cprofile'),
+                                         seconds=min(float(params.get('seconds', 30)), MAX_SECONDS))
+                content_type, body = format_profile(result, params.get('format', 'text'))
+            else:
+                start_response('404 Not Found', [('Content-Type', 'text/plain')])
+                return [b'Not found']
+        except ProfilingBusyError as e:
+            start_response('409 Conflict', [('Content-Type', 'text/plain')])
+            return [str(e).encode()]
+        except ValueError as e:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [str(e).encode()]
+
+        start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        return [body]
+
+    return app
+
+
+class SilentRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, profiling=False):
+    """Starts the Prometheus metrics server like prometheus_client.start_http_server, with the profiling endpoints
+    if `profiling` is on."""
+    app = make_wsgi_app()
+    if profiling:
+        app = make_profiling_app(app)
+    httpd = make_server('0.0.0.0', port, app, ThreadingWSGIServer, handler_class=SilentRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd, thread
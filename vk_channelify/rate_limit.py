@@ -0,0 +1,43 @@
+import time
+from threading import Lock
+
+
+class TokenBucket:
+    """Thread-safe token bucket which allows `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self):
+        """Takes a token and returns how many seconds the caller has to wait before using it."""
+        with self._lock:
+            self._refill()
+
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def delay(self):
+        """Returns how many seconds a reservation made now would wait, without taking a token."""
+        with self._lock:
+            self._refill()
+
+            if self._tokens >= 1:
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
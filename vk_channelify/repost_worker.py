@@ -1,38 +1,90 @@
 import datetime
+import json
 import time
 import traceback
-from threading import Thread
+from threading import Event, Thread
 
 import logging
 import requests
 import telegram
+from sqlalchemy import func, or_
 
 from vk_channelify.models.disabled_channel import DisabledChannel
 from vk_channelify.vk_errors import VkError, VkWallAccessDeniedError
-from .models import Channel
-from . import metrics
+from .breaker import get_retry_at, is_group_error, select_closed_groups
+from .hashtags import HashtagIndex, extract_hashtags
+from .media import TelegramFileCache, get_post_attachments, send_post_messages
+from .models import Channel, Delivery, VkGroup, estimate_count
+from .outbox import DeliveredBatch, delete_channel_deliveries, enqueue_deliveries, fetch_pending_deliveries, \
+    get_last_delivered_post_id, prune_deliveries
+from .rate_limit import TokenBucket
+from .send_scheduler import SendScheduler
+from .sessions import DEFAULT_POOL_SIZE, make_telegram_bot, make_vk_session
+from .vk_tokens import TOKEN_ERROR_CODES, VkTokenPool
+from . import metrics, profiling
 
 logger = logging.getLogger(__name__)
 
+VK_EXECUTE_MAX_CALLS = 25
+VK_GROUPS_GET_BY_ID_MAX_IDS = 500
+VK_WALL_ACCESS_DENIED_ERROR_CODES = [15, 18, 19, 100]
+VK_REQUESTS_PER_SECOND = 3
+WALL_DEFAULT_PAGE_SIZE = 10
+WALL_MIN_PAGE_SIZE = 3
+WALL_MAX_PAGE_SIZE = 100
+WALL_MAX_POSTS = 300
+# Groups pushing their posts are still polled this often, to catch posts whose Callback API events were lost
+PUSHED_GROUPS_RECONCILE_INTERVAL = datetime.timedelta(hours=6)
 
-def run_worker(iteration_delay, vk_service_code, telegram_token, db_session_maker):
+# Shared by every engine, so concurrent fetches stay within VK's per-second limit together. A VkTokenPool passed
+# as vk_service_code limits each of its tokens instead
+vk_rate_limiter = TokenBucket(VK_REQUESTS_PER_SECOND)
+
+# Set when posts pushed by the VK Callback API are enqueued, so the worker delivers them without waiting for its
+# next iteration. It wakes the worker of this process only, other replicas get the posts on their next iteration
+pushed_posts = Event()
+
+# Size of the first wall.get page of each group, adapted to how many new posts the group had last time
+wall_page_sizes = dict()
+
+
+def run_worker(iteration_delay, vk_service_code, telegram_token, db_session_maker, run_iteration=None,
+               pool_size=DEFAULT_POOL_SIZE, scheduler=None, leases=None):
     thread = Thread(target=run_worker_inside_thread,
-                    args=(iteration_delay, vk_service_code, telegram_token, db_session_maker),
+                    args=(iteration_delay, vk_service_code, telegram_token, db_session_maker, run_iteration, pool_size,
+                          scheduler, leases),
                     daemon=True)
     thread.start()
     return thread
 
 
-def run_worker_inside_thread(iteration_delay, vk_service_code, telegram_token, db_session_maker):
+def run_worker_inside_thread(iteration_delay, vk_service_code, telegram_token, db_session_maker, run_iteration=None,
+                             pool_size=DEFAULT_POOL_SIZE, scheduler=None, leases=None):
+    """Runs iterations forever. Without a scheduler every group is polled each `iteration_delay` seconds,
+    with a PollScheduler only due groups are polled and the worker wakes up when the next one is due.
+    With GroupLeases only the groups leased to this worker are polled, the rest are left to other replicas."""
+    if run_iteration is None:
+        run_iteration = run_worker_iteration
+
+    # Kept for the whole life of the worker, so keep-alive connections are reused across iterations
+    bot = make_telegram_bot(telegram_token, pool_size)
+    vk_session = make_vk_session(pool_size)
+    # Per-chat limits have to outlive iterations, a chat may be near its limit when an iteration ends
+    send_scheduler = SendScheduler()
+    file_cache = TelegramFileCache()
+
     while True:
         start_time = datetime.datetime.now()
         logger.info('New iteration {}'.format(start_time))
         metrics.repost_iterations_total.inc()
 
         try:
-            db = db_session_maker()
+            # Channels are loaded and dropped batch by batch, so they don't have to be reloaded after every commit
+            db = db_session_maker(expire_on_commit=False)
             with metrics.repost_iteration_duration_seconds.time():
-                run_worker_iteration(vk_service_code, telegram_token, db)
+                profiling.repost_iterations.run(run_iteration, vk_service_code, telegram_token, db, bot=bot,
+                                                vk_session=vk_session, scheduler=scheduler,
+                                                send_scheduler=send_scheduler, leases=leases, file_cache=file_cache)
         except Exception as e:
             logger.error('Iteration was failed because of {}'.format(e))
             traceback.print_exc()
@@ -47,109 +99,700 @@ def run_worker_inside_thread(iteration_delay, vk_service_code, telegram_token, d
         end_time = datetime.datetime.now()
         logger.info('Finished iteration {} ({})'.format(end_time, end_time - start_time))
 
-        time.sleep(iteration_delay)
+        delay = iteration_delay if scheduler is None else scheduler.seconds_until_next_poll()
+        wait_delivering_pushed_posts(delay, db_session_maker, bot, send_scheduler, leases, file_cache)
 
 
-def run_worker_iteration(vk_service_code, telegram_token, db):
-    bot = telegram.Bot(telegram_token)
+def wait_delivering_pushed_posts(delay, db_session_maker, bot, send_scheduler, leases=None, file_cache=None):
+    """Sleeps for `delay` seconds, delivering posts pushed by the VK Callback API meanwhile as soon as they are
+    enqueued. With GroupLeases only posts of this worker's groups are delivered, the rest wait for their workers,
+    and the leases are renewed while sleeping, so they don't expire however long the delay is."""
+    deadline = time.monotonic() + delay
+    renew_at = None if leases is None else time.monotonic() + leases.renew_interval
+    while True:
+        wake_at = deadline if renew_at is None else min(deadline, renew_at)
+        if pushed_posts.wait(max(0, wake_at - time.monotonic())):
+            pushed_posts.clear()
+            deliver_pushed_posts(db_session_maker, bot, send_scheduler, leases, file_cache)
+
+        if renew_at is not None and time.monotonic() >= renew_at:
+            renew_leases(leases, db_session_maker)
+            renew_at = time.monotonic() + leases.renew_interval
 
-    active_count = db.query(Channel).count()
-    disabled_count = db.query(DisabledChannel).count()
+        if time.monotonic() >= deadline:
+            return
+
+
+def deliver_pushed_posts(db_session_maker, bot, send_scheduler, leases=None, file_cache=None):
+    db = db_session_maker(expire_on_commit=False)
+    try:
+        groups = None if leases is None else leases.get_own_groups(db)
+        channels = load_channels_with_pending_posts(groups, db)
+        deliver_pending_posts(channels, db, bot, send_scheduler, file_cache)
+        expunge_channels(channels, db)
+        if file_cache is not None:
+            file_cache.save(db)
+    except Exception as e:
+        logger.error('Delivery of pushed posts was failed because of {}'.format(e))
+        traceback.print_exc()
+        metrics.repost_errors_total.labels(error_type='push_delivery_failed', channel_id='', vk_group_id='').inc()
+    finally:
+        db.close()
+
+
+def renew_leases(leases, db_session_maker):
+    db = db_session_maker()
+    try:
+        leases.renew(db)
+    except Exception as e:
+        logger.error('Renewal of leases was failed because of {}'.format(e))
+        traceback.print_exc()
+    finally:
+        db.close()
+
+
+def run_worker_iteration(vk_service_code, telegram_token, db, bot=None, vk_session=requests, scheduler=None,
+                         send_scheduler=None, leases=None, file_cache=None):
+    if bot is None:
+        bot = telegram.Bot(telegram_token)
+    if send_scheduler is None:
+        send_scheduler = SendScheduler()
+    if file_cache is None:
+        file_cache = TelegramFileCache()
+
+    prune_deliveries(db)
+
+    leased_groups, groups_to_poll, unresolved_channel_ids_by_group = select_iteration_groups(
+        vk_service_code, vk_session, db, scheduler, leases)
+
+    try:
+        # Posts left pending by an interrupted iteration go first
+        channels = load_channels_with_pending_posts(leased_groups, db)
+        deliver_pending_posts(channels, db, bot, send_scheduler, file_cache)
+        expunge_channels(channels, db)
+        file_cache.save(db)
+
+        for groups in iterate_batches(groups_to_poll, VK_EXECUTE_MAX_CALLS):
+            if leases is not None:
+                leases.renew(db)
+
+            channels_by_group = load_groups_channels(groups, unresolved_channel_ids_by_group, db)
+            groups = [group for group in groups if group in channels_by_group]
+            # Nothing is written until the walls are fetched, so no transaction is kept open meanwhile
+            db.commit()
+
+            cursors = {group: get_group_cursor(channels_by_group[group]) for group in groups}
+            posts_by_group = fetch_groups_new_posts(groups, cursors, vk_service_code, vk_session)
+            update_vk_groups_stats(posts_by_group, channels_by_group, db)
+
+            if scheduler is not None:
+                for group in groups:
+                    scheduler.reschedule(group, posts_by_group[group])
+
+            for channel, error in enqueue_new_posts(groups, channels_by_group, posts_by_group, db):
+                handle_channel_error(channel, error, db, bot)
+            channels = [channel for group in groups for channel in channels_by_group[group]]
+            deliver_pending_posts(channels, db, bot, send_scheduler, file_cache)
+            expunge_channels(channels, db)
+            file_cache.save(db)
+    finally:
+        if scheduler is not None:
+            scheduler.save(db)
+
+
+def select_iteration_groups(vk_service_code, vk_session, db, scheduler=None, leases=None):
+    """Returns groups of this worker, the ones of them to poll now, and ids of channels not linked to vk_groups
+    by their groups.
+
+    Only group keys and counts are loaded here, channels themselves are loaded batch by batch, so the worker's
+    memory doesn't grow with the number of channels.
+    """
+    # Channels whose groups VK couldn't resolve lately are left out, like groups with open breakers
+    unresolved_channels = list(db.query(Channel).filter(
+        Channel.vk_group_ref.is_(None),
+        or_(Channel.resolve_retry_at.is_(None), Channel.resolve_retry_at <= datetime.datetime.utcnow())))
+    resolve_channels_vk_groups(unresolved_channels, vk_service_code, vk_session, db)
+    unresolved_channel_ids_by_group = {
+        group: [channel.channel_id for channel in channels]
+        for group, channels in group_channels_by_vk_group(channel for channel in unresolved_channels
+                                                          if channel.vk_group_ref is None).items()
+    }
+    expunge_channels(unresolved_channels, db)
+
+    channels_count_by_group = count_channels_by_vk_group(unresolved_channel_ids_by_group, db)
+    update_channels_gauges(sum(channels_count_by_group.values()), db)
+
+    groups = select_leased_groups(list(channels_count_by_group), db, leases)
+    # Groups with open breakers still get posts pending from before, they are just not fetched
+    groups_to_poll = select_closed_groups(select_unpushed_groups(select_groups_to_poll(groups, db, scheduler), db), db)
+    return groups, groups_to_poll, unresolved_channel_ids_by_group
+
+
+def count_channels_by_vk_group(unresolved_channel_ids_by_group, db):
+    channels_count_by_group = {
+        'club{}'.format(vk_group_ref): channels_count
+        for vk_group_ref, channels_count in db.query(Channel.vk_group_ref, func.count())
+            .filter(Channel.vk_group_ref.isnot(None))
+            .group_by(Channel.vk_group_ref)
+    }
+    for group, channel_ids in unresolved_channel_ids_by_group.items():
+        channels_count_by_group[group] = channels_count_by_group.get(group, 0) + len(channel_ids)
+    return channels_count_by_group
+
+
+def load_groups_channels(groups, unresolved_channel_ids_by_group, db):
+    """Loads channels of the groups and returns them by group, groups which have no channels anymore are left out."""
+    vk_group_refs = [int(extract_group_id_if_has(group)) for group in groups if extract_group_id_if_has(group)]
+    unresolved_channel_ids = [channel_id for group in groups for channel_id in unresolved_channel_ids_by_group.get(group, [])]
+
+    channels = db.query(Channel) \
+        .filter(or_(Channel.vk_group_ref.in_(vk_group_refs), Channel.channel_id.in_(unresolved_channel_ids))) \
+        .order_by(Channel.vk_group_ref, Channel.channel_id)
+    return group_channels_by_vk_group(channels)
+
+
+def load_channels_with_pending_posts(groups, db):
+    """Loads channels of the groups which have pending posts, of all groups if `groups` is None."""
+    pending_channel_ids = db.query(Delivery.channel_id).filter(Delivery.delivered_at.is_(None)).distinct()
+    channels = db.query(Channel).filter(Channel.channel_id.in_(pending_channel_ids)).order_by(Channel.channel_id)
+
+    if groups is None:
+        return list(channels)
+    groups = set(groups)
+    return [channel for channel in channels if get_vk_group_key(channel) in groups]
+
+
+def expunge_channels(channels, db):
+    """Drops processed channels from the session's identity map. Disabled channels have already left it."""
+    for channel in channels:
+        if channel in db:
+            db.expunge(channel)
+
+
+def update_channels_gauges(active_count, db):
+    # Active channels are counted by group anyway, disabled ones are only counted for the gauge, so an estimate is enough
     metrics.active_channels_gauge.set(active_count)
-    metrics.disabled_channels_gauge.set(disabled_count)
+    metrics.disabled_channels_gauge.set(estimate_count(db, DisabledChannel))
 
-    for channel in db.query(Channel):
-        try:
-            log_id = '{} (id: {})'.format(channel.vk_group_id, channel.channel_id)
-            metrics_kwargs = {'channel_id': channel.channel_id, 'vk_group_id': channel.vk_group_id}
 
-            posts = fetch_group_posts(channel.vk_group_id, vk_service_code)
-            posts_sent = 0
+def resolve_channels_vk_groups(channels, vk_service_code, vk_session, db, now=None):
+    """Links channels to vk_groups rows, resolving their screen names to numeric ids with groups.getById.
 
-            for post in sorted(posts, key=lambda p: p['id']):
-                if post['id'] <= channel.last_vk_post_id:
-                    continue
-                if not is_passing_hashtag_filter(channel.hashtag_filter, post):
-                    continue
+    A channel whose group VK can't resolve backs off the way breakers of vk_groups do, see breaker.py, so dead
+    screen names aren't requested one by one every iteration.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
 
-                post_url = 'https://vk.ru/wall{}_{}'.format(post['owner_id'], post['id'])
-                text = '{}\n\n{}'.format(post_url, post['text'])
-                if len(text) > 4000:
-                    text = text[0:4000] + '...'
-
-                try:
-                    bot.send_message(channel.channel_id, text)
-                    metrics.telegram_api_requests_total.labels(method='send_message', status='success', **metrics_kwargs).inc()
-                    posts_sent += 1
-                    metrics.repost_posts_sent_total.labels(**metrics_kwargs).inc()
-                except telegram.error.TelegramError as send_error:
-                    metrics.telegram_api_requests_total.labels(method='send_message', status='error', **metrics_kwargs).inc()
-                    raise send_error
-
-                try:
-                    channel.last_vk_post_id = post['id']
-                    db.commit()
-                except:
-                    db.rollback()
-                    raise
-
-            if posts_sent:
-                logger.info('Success sent {} posts on channel {}'.format(posts_sent, log_id))
-
-        except telegram.error.BadRequest as e:
-            if 'chat not found' in e.message.lower():
-                logger.warning('Disabling channel {} because of telegram error: {}'.format(log_id, e))
-                traceback.print_exc()
-                metrics.repost_errors_total.labels(error_type='telegram_chat_not_found', **metrics_kwargs).inc()
-                disable_channel(channel, db, bot)
+    unresolved_channels = [channel for channel in channels if channel.vk_group_ref is None]
+    if not unresolved_channels:
+        return
+
+    groups = list(dict.fromkeys(normalize_group(channel.vk_group_id) for channel in unresolved_channels))
+    infos_by_group = dict()
+    for groups_batch in iterate_batches(groups, VK_GROUPS_GET_BY_ID_MAX_IDS):
+        infos_by_group.update(fetch_groups_info(groups_batch, vk_service_code, vk_session))
+
+    try:
+        for info in infos_by_group.values():
+            db.merge(VkGroup(id=info['id'], screen_name=info['screen_name']))
+        for channel in unresolved_channels:
+            info = infos_by_group.get(normalize_group(channel.vk_group_id))
+            if info is not None:
+                channel.vk_group_ref = info['id']
+                channel.resolve_error_streak = 0
+                channel.resolve_retry_at = None
             else:
-                metrics.repost_errors_total.labels(error_type='telegram_bad_request', **metrics_kwargs).inc()
-                raise e
+                channel.resolve_error_streak += 1
+                channel.resolve_retry_at = get_retry_at(channel.resolve_error_streak, now)
+                if channel.resolve_retry_at is not None:
+                    logger.warning('Group {} has not been resolved {} times in a row, it is not resolved until {}'
+                                   .format(channel.vk_group_id, channel.resolve_error_streak, channel.resolve_retry_at))
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+    logger.info('Resolved {} of {} VK groups'.format(len(infos_by_group), len(groups)))
+
+
+def group_channels_by_vk_group(channels):
+    channels_by_group = dict()
+    for channel in channels:
+        channels_by_group.setdefault(get_vk_group_key(channel), []).append(channel)
+    return channels_by_group
+
+
+def get_vk_group_key(channel):
+    if channel.vk_group_ref is not None:
+        return 'club{}'.format(channel.vk_group_ref)
+
+    return normalize_group(channel.vk_group_id)
+
+
+def update_vk_groups_stats(posts_by_group, channels_by_group, db):
+    vk_group_ids = [channels_by_group[group][0].vk_group_ref for group in posts_by_group]
+    vk_group_ids = [vk_group_id for vk_group_id in vk_group_ids if vk_group_id is not None]
+    if not vk_group_ids:
+        return
+
+    now = datetime.datetime.utcnow()
+    vk_groups = list(db.query(VkGroup).filter(VkGroup.id.in_(vk_group_ids)))
+    try:
+        for vk_group in vk_groups:
+            posts = posts_by_group['club{}'.format(vk_group.id)]
+            if isinstance(posts, VkError) and not is_group_error(posts):
+                # The wall wasn't fetched because of the token, the group is fetched again next time
+                continue
+
+            vk_group.last_fetched_at = now
+            if vk_group.retry_at is not None:
+                metrics.breaker_probes_total.labels(
+                    result='failure' if isinstance(posts, VkError) else 'success').inc()
+
+            if isinstance(posts, VkError):
+                vk_group.error_streak += 1
+                vk_group.retry_at = get_retry_at(vk_group.error_streak, now)
+                if vk_group.retry_at is not None:
+                    logger.warning('Group {} has failed {} times in a row, it is not polled until {}'.format(
+                        vk_group.screen_name, vk_group.error_streak, vk_group.retry_at))
+            else:
+                vk_group.error_streak = 0
+                vk_group.retry_at = None
+                vk_group.last_vk_post_id = max([vk_group.last_vk_post_id] + [post['id'] for post in posts])
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+    for vk_group in vk_groups:
+        db.expunge(vk_group)
+
+
+def select_leased_groups(groups, db, leases=None):
+    if leases is None:
+        return groups
+
+    return leases.claim(groups, db)
+
+
+def select_groups_to_poll(groups, db, scheduler=None):
+    if scheduler is None:
+        return groups
+
+    return scheduler.pop_due_groups(groups, db)
 
-        except telegram.error.Unauthorized as e:
-            logger.warning('Disabling channel {} because of telegram error: {}'.format(log_id, e))
-            traceback.print_exc()
-            metrics.repost_errors_total.labels(error_type='telegram_unauthorized', **metrics_kwargs).inc()
-            disable_channel(channel, db, bot)
 
-        except telegram.error.TimedOut as e:
-            logger.warning('Got telegram TimedOut error on channel {}'.format(log_id))
-            metrics.repost_errors_total.labels(error_type='telegram_timeout', **metrics_kwargs).inc()
+def select_unpushed_groups(groups, db, now=None):
+    """Returns the groups out of `groups` which have to be polled. Groups set up for the VK Callback API push their
+    posts, they are only polled once per PUSHED_GROUPS_RECONCILE_INTERVAL."""
+    if now is None:
+        now = datetime.datetime.utcnow()
 
-        except VkWallAccessDeniedError as e:
-            logger.warning('Disabling channel {} because of vk error: {}'.format(log_id, e))
+    pushed_groups = {'club{}'.format(vk_group_id) for vk_group_id, in db.query(VkGroup.id).filter(
+        VkGroup.callback_secret.isnot(None), VkGroup.last_fetched_at > now - PUSHED_GROUPS_RECONCILE_INTERVAL)}
+    unpushed_groups = [group for group in groups if group not in pushed_groups]
+
+    metrics.pushed_groups_gauge.set(len(groups) - len(unpushed_groups))
+    return unpushed_groups
+
+
+def enqueue_new_posts(groups, channels_by_group, posts_by_group, db):
+    """Writes new posts of the groups' channels to the outbox and moves the channels' cursors past the fetched posts.
+
+    Both are committed in one transaction, so a post is never enqueued twice. Returns (channel, error) pairs of
+    groups whose fetch failed, for the caller to handle after the commit.
+    """
+    channel_posts = []
+    failed_channels = []
+    for group in groups:
+        posts = posts_by_group[group]
+        # Disabled earlier in the iteration
+        channels = [channel for channel in channels_by_group[group] if channel in db]
+        if isinstance(posts, VkError):
+            failed_channels.extend((channel, posts) for channel in channels)
+            continue
+
+        for channel, post in select_channels_new_posts(channels, posts):
+            channel_posts.append((channel.channel_id, post))
+        for channel in channels:
+            channel.last_vk_post_id = max([channel.last_vk_post_id] + [post['id'] for post in posts])
+
+    enqueue_deliveries(channel_posts, db)
+    return failed_channels
+
+
+def deliver_pending_posts(channels, db, bot, send_scheduler, file_cache=None):
+    deliveries_by_channel = fetch_pending_deliveries([channel.channel_id for channel in channels], db)
+    if not deliveries_by_channel:
+        return
+
+    delivered = DeliveredBatch(db)
+    try:
+        send_scheduler.run_fairly([
+            (channel.channel_id, iterate_channel_deliveries(channel, deliveries_by_channel[channel.channel_id], db,
+                                                            bot, send_scheduler, delivered, file_cache))
+            for channel in channels
+            if channel.channel_id in deliveries_by_channel
+        ])
+    finally:
+        delivered.flush()
+
+
+def iterate_channel_deliveries(channel, deliveries, db, bot, send_scheduler, delivered, file_cache=None):
+    """Sends pending posts to the channel, yielding after every sent post so sends to channels can be interleaved."""
+    posts_sent = 0
+    metrics.telegram_send_queue_depth.inc(len(deliveries))
+    try:
+        for delivery_id, post in deliveries:
+            sent_methods = []
+            try:
+                send_post(channel, post, bot, send_scheduler, file_cache, sent_methods=sent_methods)
+            except telegram.error.TelegramError:
+                # A part of the post is out, the next iteration would send it again
+                if sent_methods:
+                    delivered.add(delivery_id)
+                raise
+            posts_sent += 1
+            metrics.telegram_send_queue_depth.dec()
+            delivered.add(delivery_id)
+            yield
+
+        if posts_sent:
+            logger.info('Success sent {} posts on channel {} (id: {})'.format(posts_sent, channel.vk_group_id, channel.channel_id))
+
+    except telegram.error.TelegramError as e:
+        # Sent posts are marked first, so a disabled channel is recovered right after them
+        delivered.flush()
+        handle_channel_error(channel, e, db, bot)
+
+    finally:
+        metrics.telegram_send_queue_depth.dec(len(deliveries) - posts_sent)
+
+
+def select_channels_new_posts(channels, posts):
+    """Yields (channel, post) pairs of posts newer than the channels' cursors and passing their hashtag filters.
+
+    Hashtags of every post are extracted once and looked up in an index of the channels' filters.
+    """
+    posts = sorted(posts, key=lambda p: p['id'])
+    # A new channel starts with the latest posts instead of everything fetched for other channels of the group
+    latest_post_ids = {post['id'] for post in posts[-WALL_DEFAULT_PAGE_SIZE:]}
+    hashtag_index = HashtagIndex(channels)
+
+    for post in posts:
+        # Posts aren't tokenised at all when none of the channels filters them
+        hashtags = extract_hashtags(post['text']) if hashtag_index.channels_by_hashtag else set()
+        for channel in hashtag_index.find_channels(hashtags):
+            if post['id'] <= channel.last_vk_post_id:
+                continue
+            if not channel.last_vk_post_id and post['id'] not in latest_post_ids:
+                continue
+            yield channel, post
+
+
+def format_post_text(post):
+    post_url = 'https://vk.ru/wall{}_{}'.format(post['owner_id'], post['id'])
+    text = '{}\n\n{}'.format(post_url, post['text'])
+    if len(text) > 4000:
+        text = text[0:4000] + '...'
+    return text
+
+
+def send_post(channel, post, bot, send_scheduler=None, file_cache=None, is_first_send_reserved=False,
+              sent_methods=None):
+    """Sends the post's text with its photos and documents, a request is counted for every Bot API call.
+
+    With `is_first_send_reserved` the caller has waited for the first send in `send_scheduler` already. Names of
+    the Bot methods which succeeded are appended to `sent_methods`, so a caller can tell whether a failed post
+    was sent in part.
+    """
+    metrics_kwargs = {'channel_id': channel.channel_id, 'vk_group_id': channel.vk_group_id}
+
+    def send(method, *args, **kwargs):
+        with metrics.telegram_api_request_duration_seconds.labels(method=method).time():
+            return getattr(bot, method)(*args, **kwargs)
+
+    def call(method, *args, **kwargs):
+        nonlocal is_first_send_reserved
+        is_reserved, is_first_send_reserved = is_first_send_reserved, False
+        try:
+            if send_scheduler is None:
+                result = send(method, *args, **kwargs)
+            else:
+                result = send_scheduler.call(channel.channel_id, send, method, *args, is_reserved=is_reserved,
+                                             **kwargs)
+        except telegram.error.TelegramError:
+            metrics.telegram_api_requests_total.labels(method=method, status='error', **metrics_kwargs).inc()
+            raise
+        metrics.telegram_api_requests_total.labels(method=method, status='success', **metrics_kwargs).inc()
+        if sent_methods is not None:
+            sent_methods.append(method)
+        return result
+
+    send_post_messages(call, channel.channel_id, format_post_text(post), get_post_attachments(post), file_cache)
+    metrics.repost_posts_sent_total.labels(**metrics_kwargs).inc()
+    if post.get('date'):
+        metrics.post_delivery_delay_seconds.observe(max(0, time.time() - post['date']))
+
+
+def handle_channel_error(channel, error, db, bot):
+    """Disables the channel or swallows the error the way the repost loop always did. Unknown errors are re-raised."""
+    log_id = '{} (id: {})'.format(channel.vk_group_id, channel.channel_id)
+    metrics_kwargs = {'channel_id': channel.channel_id, 'vk_group_id': channel.vk_group_id}
+
+    if isinstance(error, telegram.error.BadRequest):
+        if 'chat not found' in error.message.lower():
+            logger.warning('Disabling channel {} because of telegram error: {}'.format(log_id, error))
             traceback.print_exc()
-            metrics.repost_errors_total.labels(error_type='vk_wall_access_denied', **metrics_kwargs).inc()
+            metrics.repost_errors_total.labels(error_type='telegram_chat_not_found', **metrics_kwargs).inc()
             disable_channel(channel, db, bot)
+        else:
+            # The post stays pending, the channel's other posts wait for it, the other channels don't
+            logger.warning('Got telegram error on channel {}: {}'.format(log_id, error))
+            metrics.repost_errors_total.labels(error_type='telegram_bad_request', **metrics_kwargs).inc()
+
+    elif isinstance(error, telegram.error.Unauthorized):
+        logger.warning('Disabling channel {} because of telegram error: {}'.format(log_id, error))
+        traceback.print_exc()
+        metrics.repost_errors_total.labels(error_type='telegram_unauthorized', **metrics_kwargs).inc()
+        disable_channel(channel, db, bot)
 
+    elif isinstance(error, telegram.error.RetryAfter):
+        # SendScheduler has run out of retries, the post stays pending until the next iteration
+        logger.warning('Got telegram RetryAfter error on channel {}'.format(log_id))
+        metrics.repost_errors_total.labels(error_type='telegram_retry_after', **metrics_kwargs).inc()
 
-def fetch_group_posts(group, vk_service_code):
-    time.sleep(0.35)
+    elif isinstance(error, telegram.error.TimedOut):
+        logger.warning('Got telegram TimedOut error on channel {}'.format(log_id))
+        metrics.repost_errors_total.labels(error_type='telegram_timeout', **metrics_kwargs).inc()
 
-    group_id = extract_group_id_if_has(group)
-    is_group_domain_passed = group_id is None
+    elif isinstance(error, VkWallAccessDeniedError):
+        logger.warning('Disabling channel {} because of vk error: {}'.format(log_id, error))
+        traceback.print_exc()
+        metrics.repost_errors_total.labels(error_type='vk_wall_access_denied', **metrics_kwargs).inc()
+        disable_channel(channel, db, bot)
+
+    elif isinstance(error, VkError):
+        # Only the group's wall has failed, update_vk_groups_stats has recorded it in the group's breaker
+        logger.warning('Got vk error on channel {}: {}'.format(log_id, error))
+        metrics.repost_errors_total.labels(error_type='vk_error', **metrics_kwargs).inc()
 
-    if is_group_domain_passed:
-        url = 'https://api.vk.ru/method/wall.get?domain={}&count=10&access_token={}&v=5.131'.format(group, vk_service_code)
-        r = requests.get(url)
     else:
-        url = 'https://api.vk.ru/method/wall.get?owner_id=-{}&count=10&access_token={}&v=5.131'.format(group_id, vk_service_code)
-        r = requests.get(url)
-    j = r.json()
+        raise error
+
+
+def iterate_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fetch_groups_new_posts(groups, cursors, vk_service_code, session=requests):
+    """Fetches posts of `groups` newer than their cursors, paging through the walls with offset.
+
+    `cursors` maps a group to the oldest last_vk_post_id of its channels, or None if only the latest page is needed.
+    The first page of every group is sized after its recent rate (see wall_page_sizes), further pages are fetched
+    in execute batches only for the groups which haven't reached their cursor yet, up to WALL_MAX_POSTS posts.
+    A post published between pages shifts the offsets, so posts seen on the previous page are skipped.
+    """
+    posts_by_group = {group: [] for group in groups}
+    seen_post_ids = {group: set() for group in groups}
+    fetched_counts = {group: 0 for group in groups}
+    page_params = {group: {'count': wall_page_sizes.get(group, WALL_DEFAULT_PAGE_SIZE), 'offset': 0}
+                   for group in groups}
+    has_pinned_post = dict()
+
+    groups_to_fetch = list(groups)
+    while groups_to_fetch:
+        next_groups_to_fetch = []
+        for groups_batch in iterate_batches(groups_to_fetch, VK_EXECUTE_MAX_CALLS):
+            fetched_posts_by_group = fetch_groups_posts(groups_batch, vk_service_code, session, page_params)
+
+            for group in groups_batch:
+                posts = fetched_posts_by_group[group]
+                if isinstance(posts, VkError):
+                    # Posts of the previous pages are kept, the older ones are skipped like they were before paging
+                    if not posts_by_group[group]:
+                        posts_by_group[group] = posts
+                    continue
+
+                posts_by_group[group].extend(post for post in posts if post['id'] not in seen_post_ids[group])
+                seen_post_ids[group].update(post['id'] for post in posts)
+                fetched_counts[group] += len(posts)
+                if page_params[group]['offset'] == 0:
+                    has_pinned_post[group] = any(post.get('is_pinned') for post in posts)
+                if is_wall_page_needed(posts_by_group[group], posts, page_params[group]['count'], cursors.get(group)):
+                    page_params[group] = {'count': WALL_MAX_PAGE_SIZE, 'offset': fetched_counts[group]}
+                    next_groups_to_fetch.append(group)
+
+        groups_to_fetch = next_groups_to_fetch
+
+    for group in groups:
+        if not isinstance(posts_by_group[group], VkError):
+            wall_page_sizes[group] = estimate_wall_page_size(posts_by_group[group], cursors.get(group),
+                                                             has_pinned_post.get(group, False))
+
+    return posts_by_group
+
+
+def is_wall_page_needed(posts, last_page_posts, last_page_size, cursor):
+    if cursor is None or len(last_page_posts) < last_page_size or len(posts) >= WALL_MAX_POSTS:
+        return False
+
+    # The pinned post is shown first whatever its age, so it doesn't tell whether the cursor is reached
+    not_pinned_post_ids = [post['id'] for post in last_page_posts if not post.get('is_pinned')]
+    return not not_pinned_post_ids or min(not_pinned_post_ids) > cursor
+
+
+def estimate_wall_page_size(posts, cursor, has_pinned_post):
+    if cursor is None:
+        return WALL_DEFAULT_PAGE_SIZE
+
+    new_posts_count = sum(1 for post in posts if post['id'] > cursor and not post.get('is_pinned'))
+    # Twice the last number of new posts leaves room for a burst, paging catches up with anything bigger
+    page_size = max(WALL_MIN_PAGE_SIZE, 2 * new_posts_count) + (1 if has_pinned_post else 0)
+    return min(WALL_MAX_PAGE_SIZE, page_size)
+
+
+def get_group_cursor(channels):
+    """Returns the oldest cursor of the channels. New channels only need the latest posts, so they are skipped."""
+    cursors = [channel.last_vk_post_id for channel in channels if channel.last_vk_post_id]
+    return min(cursors) if cursors else None
+
+
+def fetch_groups_posts(groups, vk_service_code, session=requests, page_params=None):
+    """Fetches walls of up to VK_EXECUTE_MAX_CALLS groups with a single execute request.
+
+    Returns a dict mapping each group to its list of posts, or to the VkError its wall.get call failed with.
+    Errors of the execute request itself are raised. Pass a pooled session to reuse connections between calls.
+    `page_params` maps a group to the count and offset of its wall.get call, by default the latest 10 posts are
+    fetched. With a VkTokenPool, calls failed because of the token are fetched again with another one.
+    """
+    if page_params is None:
+        page_params = dict()
+    groups = list(dict.fromkeys(groups))
+    if len(groups) > VK_EXECUTE_MAX_CALLS:
+        raise ValueError('execute accepts at most {} calls, got {}'.format(VK_EXECUTE_MAX_CALLS, len(groups)))
+
+    code = 'return [{}];'.format(','.join(make_wall_get_call(group, **page_params.get(group, {})) for group in groups))
+    j = request_vk('execute', lambda token: session.post('https://api.vk.ru/method/execute',
+                                                         data={'code': code, 'access_token': token, 'v': '5.131'}),
+                   vk_service_code)
 
     if 'response' not in j:
         logger.error('VK responded with {}'.format(j))
-        metrics.vk_api_requests_total.labels(method='wall.get', status='error', vk_group_id=group).inc()
-
-        error_code = int(j['error']['error_code'])
-        if error_code in [15, 18, 19, 100]:
-            raise VkWallAccessDeniedError(error_code, j['error']['error_msg'], j['error']['request_params'])
+        metrics.vk_api_requests_total.labels(method='execute', status='error', vk_group_id='').inc()
+        raise make_vk_error(j['error'])
+
+    metrics.vk_api_requests_total.labels(method='execute', status='success', vk_group_id='').inc()
+
+    # Failed calls are returned as false, their errors are listed in execute_errors in the same order
+    execute_errors = iter(j.get('execute_errors', []))
+    posts_by_group = dict()
+    for group, response in zip(groups, j['response']):
+        if response:
+            metrics.vk_api_requests_total.labels(method='wall.get', status='success', vk_group_id=group).inc()
+            posts_by_group[group] = response['items']
         else:
-            raise VkError(error_code, j['error']['error_msg'], j['error']['request_params'])
+            error = next(execute_errors, {'error_code': 0, 'error_msg': 'Unknown execute error'})
+            logger.error('VK responded to wall.get of {} with {}'.format(group, error))
+            metrics.vk_api_requests_total.labels(method='wall.get', status='error', vk_group_id=group).inc()
+            posts_by_group[group] = make_vk_error(error)
+
+    # request_vk has taken the token out of rotation, so the next execute gets another one
+    retry_groups = [group for group, posts in posts_by_group.items()
+                    if isinstance(posts, VkError) and posts.code in TOKEN_ERROR_CODES]
+    if retry_groups and isinstance(vk_service_code, VkTokenPool):
+        try:
+            posts_by_group.update(fetch_groups_posts(retry_groups, vk_service_code, session, page_params))
+        except VkError as e:
+            logger.error('Cannot fetch walls of {} groups again: {}'.format(len(retry_groups), e))
+
+    return posts_by_group
+
+
+def fetch_groups_info(groups, vk_service_code, session=requests):
+    """Resolves up to VK_GROUPS_GET_BY_ID_MAX_IDS groups with groups.getById.
+
+    Returns a dict mapping each resolved group to its info. Groups VK doesn't know are left out. If VK rejects
+    the whole batch, the groups are resolved one by one so a single bad screen name doesn't block the others.
+    """
+    group_ids = [extract_group_id_if_has(group) or group for group in groups]
+
+    j = request_vk('groups.getById',
+                   lambda token: session.get('https://api.vk.ru/method/groups.getById',
+                                             params={'group_ids': ','.join(group_ids), 'access_token': token,
+                                                     'v': '5.131'}),
+                   vk_service_code)
 
-    metrics.vk_api_requests_total.labels(method='wall.get', status='success', vk_group_id=group).inc()
+    if 'response' not in j:
+        logger.error('VK responded with {}'.format(j))
+        metrics.vk_api_requests_total.labels(method='groups.getById', status='error', vk_group_id='').inc()
+        if len(groups) == 1:
+            return dict()
+        infos_by_group = dict()
+        for group in groups:
+            infos_by_group.update(fetch_groups_info([group], vk_service_code, session))
+        return infos_by_group
+
+    metrics.vk_api_requests_total.labels(method='groups.getById', status='success', vk_group_id='').inc()
+
+    requested_groups = set(groups)
+    infos_by_group = dict()
+    for info in j['response']:
+        for group in (normalize_group(info['screen_name']), 'club{}'.format(info['id'])):
+            if group in requested_groups:
+                infos_by_group[group] = info
+    return infos_by_group
+
+
+def request_vk(method, send_request, vk_service_code):
+    """Calls `send_request(token)` for the VK API `method` once the rate limit allows it and returns the response's
+    JSON.
+
+    `vk_service_code` is a single token or a VkTokenPool. A token of the pool VK rejects because of its rate limit
+    or revocation is taken out of rotation and the request is made again with another one. So is a token an execute
+    call failed with, but the caller retries such calls, the response has the others' results.
+    """
+    if not isinstance(vk_service_code, VkTokenPool):
+        metrics.vk_rate_limit_wait_seconds.observe(vk_rate_limiter.acquire())
+        with metrics.vk_api_request_duration_seconds.labels(method=method).time():
+            return send_request(vk_service_code).json()
+
+    for attempt in range(len(vk_service_code)):
+        token = vk_service_code.acquire()
+        with metrics.vk_api_request_duration_seconds.labels(method=method).time():
+            j = send_request(token).json()
+        if 'error' not in j or not vk_service_code.report_error(token, j['error']):
+            break
+    if 'error' not in j:
+        for error in j.get('execute_errors', []):
+            if vk_service_code.report_error(token, error):
+                break
+    return j
+
+
+def make_wall_get_call(group, count=WALL_DEFAULT_PAGE_SIZE, offset=0):
+    group_id = extract_group_id_if_has(group)
+    if group_id is None:
+        params = {'domain': group, 'count': count}
+    else:
+        params = {'owner_id': -int(group_id), 'count': count}
+    if offset:
+        params['offset'] = offset
+    return 'API.wall.get({})'.format(json.dumps(params))
 
-    return j['response']['items']
+
+def make_vk_error(error):
+    error_code = int(error['error_code'])
+    error_cls = VkWallAccessDeniedError if error_code in VK_WALL_ACCESS_DENIED_ERROR_CODES else VkError
+    return error_cls(error_code, error['error_msg'], error.get('request_params', []))
 
 
 def extract_group_id_if_has(group_name):
@@ -163,14 +806,17 @@ def extract_group_id_if_has(group_name):
     return None
 
 
-def is_passing_hashtag_filter(hashtag_filter, post):
-    if hashtag_filter is None:
-        return True
+def normalize_group(group_name):
+    group_id = extract_group_id_if_has(group_name)
+    if group_id is not None:
+        return 'club{}'.format(group_id)
 
-    return any(hashtag.strip() in post['text'] for hashtag in hashtag_filter.split(','))
+    return group_name.lower()
 
 
 def disable_channel(channel, db, bot):
+    """Moves the channel to disabled_channels and tells its owner how to recover it. Without a bot the owner isn't
+    told, the caller does it with notify_channel_disabled."""
     log_id = '{} (id: {})'.format(channel.vk_group_id, channel.channel_id)
     metrics_kwargs = {'channel_id': channel.channel_id, 'vk_group_id': channel.vk_group_id}
 
@@ -178,18 +824,27 @@ def disable_channel(channel, db, bot):
     metrics.channels_disabled_total.labels(**metrics_kwargs).inc()
 
     try:
+        # Pending posts are dropped with the channel, its recovered cursor points right before them
+        last_vk_post_id = get_last_delivered_post_id(channel, db)
+        delete_channel_deliveries(channel.channel_id, db)
         db.add(DisabledChannel(channel_id=channel.channel_id,
                                vk_group_id=channel.vk_group_id,
-                               last_vk_post_id=channel.last_vk_post_id,
+                               last_vk_post_id=last_vk_post_id,
                                owner_id=channel.owner_id,
                                owner_username=channel.owner_username,
-                               hashtag_filter=channel.hashtag_filter))
+                               hashtag_filter=channel.hashtag_filter,
+                               title=channel.title))
         db.delete(channel)
         db.commit()
     except:
         db.rollback()
         raise
 
+    if bot is not None:
+        notify_channel_disabled(channel, bot)
+
+
+def notify_channel_disabled(channel, bot):
     try:
         bot.send_message(channel.owner_id, 'Канал https://vk.ru/{} отключен'.format(channel.vk_group_id))
         bot.send_message(channel.owner_id, 'Так как не удается отправить в него сообщение')
@@ -0,0 +1,130 @@
+import datetime
+import heapq
+
+import logging
+
+from . import metrics
+from .models import VkGroupSchedule
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_POLL_INTERVAL = 2 * 60  # 2 minutes
+DEFAULT_MAX_POLL_INTERVAL = 2 * 60 * 60  # 2 hours
+
+# Poll twice per expected post, so a new post waits half of the posting gap on average
+POLL_INTERVAL_FRACTION = 0.5
+
+
+class PollScheduler:
+    """Priority queue of VK groups keyed by the time they are due to be polled.
+
+    Each group's interval follows its posting rate within [min_interval, max_interval]. The schedule is persisted
+    in vk_group_schedules, so a restarted worker continues where it stopped.
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_POLL_INTERVAL, max_interval=DEFAULT_MAX_POLL_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._schedules = dict()  # group -> (poll_interval, next_poll_at, last_post_at)
+        self._heap = []
+        self._changed_groups = set()
+        self._is_loaded = False
+
+    def load(self, db):
+        for schedule in db.query(VkGroupSchedule):
+            self._set(schedule.vk_group_id, schedule.poll_interval, schedule.next_poll_at, schedule.last_post_at)
+        self._changed_groups.clear()
+        self._is_loaded = True
+        logger.info('Loaded {} group schedules'.format(len(self._schedules)))
+
+    def save(self, db):
+        if not self._changed_groups:
+            return
+
+        try:
+            for group in self._changed_groups & set(self._schedules):
+                poll_interval, next_poll_at, last_post_at = self._schedules[group]
+                db.merge(VkGroupSchedule(vk_group_id=group, poll_interval=poll_interval,
+                                         next_poll_at=next_poll_at, last_post_at=last_post_at))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+        self._changed_groups.clear()
+
+    def pop_due_groups(self, groups, db, now=None):
+        """Returns the groups out of `groups` which are due now. Groups seen for the first time are due at once."""
+        if not self._is_loaded:
+            self.load(db)
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        groups = set(groups)
+        for group in groups:
+            if group not in self._schedules:
+                self._set(group, self.min_interval, now, None)
+
+        # Groups left without channels are forgotten, their rows are kept in case someone subscribes again
+        for group in set(self._schedules) - groups:
+            del self._schedules[group]
+
+        due_groups = []
+        while self._heap and self._heap[0][0] <= now:
+            next_poll_at, group = heapq.heappop(self._heap)
+            if self._is_current(next_poll_at, group):
+                due_groups.append(group)
+                # Stays scheduled even if the poll fails before reschedule() is called
+                poll_interval, _, last_post_at = self._schedules[group]
+                self._set(group, poll_interval, now + datetime.timedelta(seconds=poll_interval), last_post_at)
+
+        metrics.scheduled_groups_gauge.set(len(self._schedules))
+        metrics.due_groups_gauge.set(len(due_groups))
+
+        return due_groups
+
+    def reschedule(self, group, posts, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        poll_interval, _, last_post_at = self._schedules.get(group, (self.min_interval, now, None))
+        if isinstance(posts, list):
+            post_dates = sorted(post['date'] for post in posts if not post.get('is_pinned'))
+            if post_dates:
+                last_post_at = datetime.datetime.utcfromtimestamp(post_dates[-1])
+            poll_interval = self.estimate_poll_interval(post_dates, now)
+
+        self._set(group, poll_interval, now + datetime.timedelta(seconds=poll_interval), last_post_at)
+
+    def estimate_poll_interval(self, post_dates, now):
+        if len(post_dates) < 2:
+            return self.max_interval
+
+        average_gap = (post_dates[-1] - post_dates[0]) / (len(post_dates) - 1)
+        since_last_post = (now - datetime.datetime.utcfromtimestamp(post_dates[-1])).total_seconds()
+        # A group that has been silent for longer than it usually is won't post more often than its silence suggests
+        expected_gap = max(average_gap, since_last_post)
+
+        return int(min(self.max_interval, max(self.min_interval, expected_gap * POLL_INTERVAL_FRACTION)))
+
+    def seconds_until_next_poll(self, now=None):
+        """Seconds to sleep before polling again, capped by min_interval so new channels are picked up quickly."""
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        while self._heap and not self._is_current(*self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return self.min_interval
+
+        until_next_poll = (self._heap[0][0] - now).total_seconds()
+        return min(self.min_interval, max(0, until_next_poll))
+
+    def _is_current(self, next_poll_at, group):
+        return group in self._schedules and self._schedules[group][1] == next_poll_at
+
+    def _set(self, group, poll_interval, next_poll_at, last_post_at):
+        # Superseded heap entries are skipped lazily when popped
+        self._schedules[group] = (poll_interval, next_poll_at, last_post_at)
+        self._changed_groups.add(group)
+        heapq.heappush(self._heap, (next_poll_at, group))
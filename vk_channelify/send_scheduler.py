@@ -0,0 +1,102 @@
+import time
+from collections import deque
+from threading import Lock
+
+import logging
+import telegram
+
+from . import metrics
+from .rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and 20 messages per minute in a group or channel
+GLOBAL_MESSAGES_PER_SECOND = 30
+CHAT_MESSAGES_PER_MINUTE = 20
+MAX_RETRY_AFTER_RETRIES = 3
+
+
+class SendScheduler:
+    """Keeps Telegram sends within the global and per-chat limits and retries them after RetryAfter."""
+
+    def __init__(self, global_rate=GLOBAL_MESSAGES_PER_SECOND, chat_rate_per_minute=CHAT_MESSAGES_PER_MINUTE,
+                 max_retries=MAX_RETRY_AFTER_RETRIES):
+        self.global_limiter = TokenBucket(global_rate)
+        self.chat_rate_per_minute = chat_rate_per_minute
+        self.max_retries = max_retries
+        self._chat_limiters = dict()
+        self._lock = Lock()
+
+    def chat_limiter(self, chat_id):
+        with self._lock:
+            if chat_id not in self._chat_limiters:
+                self._chat_limiters[chat_id] = TokenBucket(self.chat_rate_per_minute / 60,
+                                                           capacity=self.chat_rate_per_minute)
+            return self._chat_limiters[chat_id]
+
+    def delay(self, chat_id):
+        """Seconds until a message to the chat could be sent, without reserving it."""
+        return max(self.chat_limiter(chat_id).delay(), self.global_limiter.delay())
+
+    def reserve(self, chat_id):
+        """Reserves a send to the chat and returns how many seconds the caller has to wait before sending."""
+        delay = max(self.chat_limiter(chat_id).reserve(), self.global_limiter.reserve())
+        metrics.telegram_send_wait_seconds.observe(delay)
+        return delay
+
+    def wait(self, chat_id):
+        """Reserves a send to the chat and sleeps until it may be sent."""
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+
+    def call(self, chat_id, func, *args, is_reserved=False, **kwargs):
+        """Calls func (a send to chat_id) once the limits allow it, sleeping and retrying on RetryAfter.
+
+        With `is_reserved` the caller has reserved the first attempt and waited for it already.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt or not is_reserved:
+                self.wait(chat_id)
+
+            try:
+                return func(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.on_retry_after(chat_id, e)
+                time.sleep(e.retry_after)
+
+    def on_retry_after(self, chat_id, error):
+        logger.warning('Telegram asked to retry sending to {} after {} seconds'.format(chat_id, error.retry_after))
+        metrics.telegram_retry_after_total.inc()
+        metrics.telegram_send_wait_seconds.observe(error.retry_after)
+
+    def run_fairly(self, steps_by_chat):
+        """Runs generators of sends round-robin, one step at a time.
+
+        `steps_by_chat` is a list of (chat_id, generator) pairs, a generator yields after every send to its chat.
+        The next step is taken from the first chat in round-robin order which is within its per-chat limit, or
+        from the chat which gets there the soonest, so a chat waiting for its limit doesn't hold back the others.
+        """
+        queue = deque(steps_by_chat)
+        while queue:
+            index = self._find_soonest_chat(queue)
+            chat_id, steps = queue[index]
+            del queue[index]
+
+            try:
+                next(steps)
+            except StopIteration:
+                continue
+            queue.append((chat_id, steps))
+
+    def _find_soonest_chat(self, queue):
+        soonest_index, soonest_delay = 0, None
+        for index, (chat_id, _) in enumerate(queue):
+            delay = self.chat_limiter(chat_id).delay()
+            if delay == 0:
+                return index
+            if soonest_delay is None or delay < soonest_delay:
+                soonest_index, soonest_delay = index, delay
+        return soonest_index
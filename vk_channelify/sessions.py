@@ -0,0 +1,61 @@
+import requests
+import telegram
+from requests.adapters import HTTPAdapter
+from telegram.utils.request import Request
+
+from . import metrics
+
+DEFAULT_POOL_SIZE = 8
+
+
+def make_vk_session(pool_size=DEFAULT_POOL_SIZE):
+    session = requests.Session()
+    session.mount('https://', CountingHTTPAdapter('vk', pool_connections=1, pool_maxsize=pool_size))
+    return session
+
+
+def make_telegram_bot(telegram_token, pool_size=DEFAULT_POOL_SIZE):
+    request = Request(con_pool_size=pool_size)
+    # Request has no hook for custom pools, so count connections by swapping the classes of its pool manager
+    count_pool_manager_connections(request._con_pool, 'telegram')
+    return telegram.Bot(telegram_token, request=request)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def __init__(self, upstream, *args, **kwargs):
+        self.upstream = upstream
+        super(CountingHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        count_pool_manager_connections(self.poolmanager, self.upstream)
+
+
+def count_pool_manager_connections(pool_manager, upstream):
+    pool_manager.pool_classes_by_scheme = {
+        scheme: type(pool_cls.__name__, (pool_cls,),
+                     {'ConnectionCls': make_counting_connection_cls(pool_cls.ConnectionCls, upstream)})
+        for scheme, pool_cls in pool_manager.pool_classes_by_scheme.items()
+    }
+
+
+def make_counting_connection_cls(connection_cls, upstream):
+    class CountingConnection(connection_cls):
+        # Set between a handshake and the first request on it, the handshake may happen before or inside request()
+        is_fresh = False
+
+        def connect(self):
+            super(CountingConnection, self).connect()
+            self.is_fresh = True
+            metrics.http_connections_total.labels(upstream=upstream, type='new').inc()
+
+        def request(self, *args, **kwargs):
+            if self.sock is not None and not self.is_fresh:
+                metrics.http_connections_total.labels(upstream=upstream, type='reused').inc()
+            try:
+                return super(CountingConnection, self).request(*args, **kwargs)
+            finally:
+                self.is_fresh = False
+
+    CountingConnection.__name__ = 'Counting' + connection_cls.__name__
+    return CountingConnection
@@ -0,0 +1,167 @@
+"""Receives new posts pushed by the VK Callback API, so they are delivered right away instead of on the next poll.
+
+A group is set up for it in vk_groups: callback_secret is the secret key and callback_confirmation_code the string
+VK expects back when it checks the server. The operator sets them with
+
+    DATABASE_URL=... scripts/set_vk_callback <group> <secret key> <confirmation string>
+
+and the group's admins point its Callback API server to the webhook domain with the VK_CALLBACK_PATH path and enable
+wall_post_new events. Such groups are still polled, but only once per repost_worker.PUSHED_GROUPS_RECONCILE_INTERVAL.
+
+Pushed posts are enqueued in the database, but only the repost worker of the process which received the event is
+woken up. With several replicas, or with GroupLeases giving the group to another worker, the post waits for the
+next iteration of the worker which delivers it, as pending posts of its groups go first.
+"""
+import hmac
+import json
+import os
+import sys
+
+import logging
+import tornado.web
+from tornado.ioloop import IOLoop
+
+from . import metrics, models, repost_worker
+from .models import VkGroup
+from .outbox import enqueue_deliveries
+
+logger = logging.getLogger(__name__)
+
+
+def serve_vk_callback(updater, db_session_maker, path):
+    """Serves the VK Callback API at `path` of the Telegram webhook server `updater` has started."""
+    # The webhook server is a tornado Application, which accepts handlers while it runs
+    updater.httpd.http_server.request_callback.add_handlers(r'.*', [
+        (r'{}/?'.format(path.rstrip('/')), VkCallbackHandler, {'db_session_maker': db_session_maker})
+    ])
+    logger.info('Serving VK Callback API at {}'.format(path))
+
+
+class VkCallbackHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, db_session_maker):
+        self.db_session_maker = db_session_maker
+
+    async def post(self):
+        try:
+            event = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return self.finish('Invalid JSON')
+        if not isinstance(event, dict):
+            self.set_status(400)
+            return self.finish('Invalid event')
+
+        # Handled in a thread of the executor, so the database doesn't block the Telegram webhook
+        status, body = await IOLoop.current().run_in_executor(None, handle_callback_event, event,
+                                                              self.db_session_maker)
+        self.set_status(status)
+        self.set_header('Content-Type', 'text/plain')
+        self.finish(body)
+
+
+def handle_callback_event(event, db_session_maker):
+    """Handles a Callback API event and returns (HTTP status, body). VK resends events until it gets "ok"."""
+    event_type = str(event.get('type'))
+    db = db_session_maker()
+    try:
+        vk_group = db.query(VkGroup).get(event.get('group_id')) if isinstance(event.get('group_id'), int) else None
+        if vk_group is None or vk_group.callback_secret is None:
+            metrics.vk_callback_events_total.labels(type=event_type, result='unknown_group').inc()
+            return 403, 'Unknown group'
+        if not hmac.compare_digest(str(event.get('secret', '')), vk_group.callback_secret):
+            logger.warning('VK Callback API event of group {} has a wrong secret'.format(vk_group.id))
+            metrics.vk_callback_events_total.labels(type=event_type, result='wrong_secret').inc()
+            return 403, 'Wrong secret'
+
+        if event_type == 'confirmation':
+            metrics.vk_callback_events_total.labels(type=event_type, result='ok').inc()
+            return 200, vk_group.callback_confirmation_code or ''
+
+        if event_type == 'wall_post_new' and not is_valid_post(event.get('object')):
+            logger.warning('VK Callback API event of group {} has an invalid post: {}'.format(
+                vk_group.id, event.get('object')))
+            metrics.vk_callback_events_total.labels(type=event_type, result='invalid').inc()
+            return 200, 'ok'
+
+        if event_type == 'wall_post_new' and event['object'].get('post_type', 'post') == 'post':
+            enqueued_count = enqueue_pushed_post(vk_group.id, event['object'], db)
+            if enqueued_count:
+                repost_worker.pushed_posts.set()
+            metrics.vk_callback_events_total.labels(type=event_type, result='ok').inc()
+            return 200, 'ok'
+
+        # Suggested and postponed posts and other events aren't delivered, VK only has to stop resending them
+        metrics.vk_callback_events_total.labels(type=event_type, result='ignored').inc()
+        return 200, 'ok'
+    finally:
+        db.close()
+
+
+def is_valid_post(post):
+    """Whether the post has what delivering it takes. VK would resend an event failing with an error forever, so
+    an invalid one is answered "ok" and dropped, polling gets the post if there is one."""
+    return isinstance(post, dict) and isinstance(post.get('id'), int) and isinstance(post.get('owner_id'), int) \
+        and isinstance(post.get('text'), str)
+
+
+def enqueue_pushed_post(vk_group_id, post, db):
+    """Enqueues the post for the group's channels and returns how many deliveries were enqueued.
+
+    Cursors aren't moved, so posts whose events were lost are still delivered by the next reconciliation poll.
+    Channels whose groups aren't resolved yet get the post from polling too.
+    """
+    group = 'club{}'.format(vk_group_id)
+    channels = repost_worker.load_groups_channels([group], dict(), db).get(group, [])
+    channel_posts = [(channel.channel_id, channel_post)
+                     for channel, channel_post in repost_worker.select_channels_new_posts(channels, [post])]
+    enqueue_deliveries(channel_posts, db)
+
+    if channel_posts:
+        logger.info('Enqueued pushed post {} of group {} for {} channels'.format(post['id'], group,
+                                                                                len(channel_posts)))
+    return len(channel_posts)
+
+
+def set_group_callback(group, secret, confirmation_code, db):
+    """Sets up the group, a screen name or clubID of vk_groups, for the Callback API. An empty secret turns it off,
+    so the group is polled again. Returns the VkGroup, or None if the group hasn't been resolved yet."""
+    group = repost_worker.normalize_group(group)
+    group_id = repost_worker.extract_group_id_if_has(group)
+    try:
+        if group_id is not None:
+            vk_group = db.query(VkGroup).get(int(group_id))
+        else:
+            vk_group = db.query(VkGroup).filter(VkGroup.screen_name == group).first()
+        if vk_group is None:
+            return None
+
+        vk_group.callback_secret = secret or None
+        vk_group.callback_confirmation_code = (confirmation_code or None) if secret else None
+        db.commit()
+    except:
+        db.rollback()
+        raise
+    return vk_group
+
+
+def main(args):
+    """Runs scripts/set_vk_callback."""
+    if len(args) not in (2, 3):
+        print('Usage: scripts/set_vk_callback <group> <secret key> <confirmation string>\n'
+              '       scripts/set_vk_callback <group> ""    turns the Callback API off', file=sys.stderr)
+        return 2
+
+    db = models.make_session_maker(os.getenv('DATABASE_URL'))()
+    try:
+        vk_group = set_group_callback(args[0], args[1], args[2] if len(args) == 3 else None, db)
+        if vk_group is None:
+            print('Group {} is not in vk_groups yet, it is added once a channel of it is polled'.format(args[0]),
+                  file=sys.stderr)
+            return 1
+        print('VK Callback API of group {} (id: {}) is {}'.format(vk_group.screen_name, vk_group.id,
+                                                               'on' if args[1] else 'off'))
+        return 0
+    finally:
+        db.close()
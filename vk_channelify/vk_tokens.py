@@ -0,0 +1,88 @@
+import time
+from threading import Lock
+
+import logging
+
+from . import metrics
+from .rate_limit import TokenBucket
+from .vk_errors import VkError
+
+logger = logging.getLogger(__name__)
+
+VK_AUTHORIZATION_FAILED_ERROR_CODE = 5
+VK_TOO_MANY_REQUESTS_ERROR_CODE = 6
+VK_FLOOD_CONTROL_ERROR_CODE = 9
+VK_RATE_LIMIT_REACHED_ERROR_CODE = 29
+# Errors of the token a request is made with rather than of what is requested
+TOKEN_ERROR_CODES = (VK_AUTHORIZATION_FAILED_ERROR_CODE, VK_TOO_MANY_REQUESTS_ERROR_CODE, VK_FLOOD_CONTROL_ERROR_CODE,
+                     VK_RATE_LIMIT_REACHED_ERROR_CODE)
+
+DEFAULT_REQUESTS_PER_SECOND = 3
+# A per-second limit is over quickly, a daily one isn't, so such a token is only tried again in an hour
+TOO_MANY_REQUESTS_COOLDOWN = 1
+RATE_LIMIT_REACHED_COOLDOWN = 60 * 60
+
+
+class VkTokenPool:
+    """VK service tokens requests are spread over, each of them with its own per-second limit.
+
+    A request gets the token which is allowed to make it soonest. A token VK rate limits is out of rotation for a
+    cooldown, a revoked one until the worker is restarted. Tokens are labelled in metrics by their position in the
+    pool, so the tokens themselves never get to the metrics.
+    """
+
+    def __init__(self, tokens, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+        self.tokens = list(dict.fromkeys(tokens))
+        if not self.tokens:
+            raise ValueError('VkTokenPool needs at least one token')
+
+        self._limiters = {token: TokenBucket(requests_per_second) for token in self.tokens}
+        self._labels = {token: str(i) for i, token in enumerate(self.tokens)}
+        self._unavailable_until = dict()  # token -> time.monotonic() when it is back in rotation
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def acquire(self):
+        """Waits until one of the available tokens may make a request and returns it.
+
+        Raises VkError if all tokens are out of rotation, the request would fail with any of them anyway.
+        """
+        with self._lock:
+            now = time.monotonic()
+            available_tokens = [token for token in self.tokens if self._unavailable_until.get(token, 0) <= now]
+            for token in self.tokens:
+                metrics.vk_token_available_gauge.labels(token=self._labels[token]).set(token in available_tokens)
+            if not available_tokens:
+                raise VkError(VK_RATE_LIMIT_REACHED_ERROR_CODE, 'All {} VK tokens are rate limited or revoked'
+                              .format(len(self.tokens)), [])
+
+            token = min(available_tokens, key=lambda t: self._limiters[t].delay())
+            delay = self._limiters[token].reserve()
+
+        metrics.vk_token_requests_total.labels(token=self._labels[token]).inc()
+        metrics.vk_rate_limit_wait_seconds.observe(delay)
+        if delay > 0:
+            time.sleep(delay)
+        return token
+
+    def report_error(self, token, error):
+        """Takes the token out of rotation if VK rejected it. Returns whether it did, so the request can be retried."""
+        error_code = int(error['error_code'])
+        if error_code == VK_AUTHORIZATION_FAILED_ERROR_CODE:
+            reason, cooldown = 'revoked', float('inf')
+        elif error_code == VK_TOO_MANY_REQUESTS_ERROR_CODE:
+            reason, cooldown = 'too_many_requests', TOO_MANY_REQUESTS_COOLDOWN
+        elif error_code in (VK_FLOOD_CONTROL_ERROR_CODE, VK_RATE_LIMIT_REACHED_ERROR_CODE):
+            reason, cooldown = 'rate_limit_reached', RATE_LIMIT_REACHED_COOLDOWN
+        else:
+            return False
+
+        label = self._labels[token]
+        logger.warning('VK token {} is out of rotation for {} s: {}'.format(label, cooldown, error.get('error_msg')))
+        metrics.vk_token_errors_total.labels(token=label, reason=reason).inc()
+        metrics.vk_token_available_gauge.labels(token=label).set(0)
+        with self._lock:
+            self._unavailable_until[token] = time.monotonic() + cooldown
+        return True